@@ -0,0 +1,242 @@
+import json
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from scrappers.fetch import Fetcher, RateBudget
+
+
+def to_base36(number: int) -> str:
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    result = ''
+    while True:
+        number, digit = divmod(number, 36)
+        result = digits[digit] + result
+        if number == 0:
+            return result
+
+
+class SyntheticPushshift:
+    """
+    Deterministic pushshift data: every sub has posts_per_sub submissions created
+    interval seconds apart, submission i of a sub has i % max_comments comments
+    """
+
+    def __init__(self, subs: [], posts_per_sub: int, start: int = 1451606400,
+                 interval: int = 60, max_comments: int = 20):
+        self.subs = subs
+        self.posts_per_sub = posts_per_sub
+        self.start = start
+        self.interval = interval
+        self.max_comments = max_comments
+
+    def post_number(self, sub_name: str, i: int) -> int:
+        return (self.subs.index(sub_name) + 1) * 10 ** 8 + i
+
+    def submission(self, sub_name: str, i: int) -> dict:
+        return {
+            'id': to_base36(self.post_number(sub_name, i)),
+            'subreddit': sub_name,
+            'created_utc': self.start + i * self.interval,
+            'title': 'Synthetic submission {}'.format(i),
+            'selftext': 'x' * 200,
+            'score': i % 100,
+            'num_comments': i % self.max_comments
+        }
+
+    def locate(self, post_id: str) -> tuple:
+        number = int(post_id, 36)
+        return self.subs[number // 10 ** 8 - 1], number % 10 ** 8
+
+    def submissions(self, sub_name: str, after: int, before: int, limit: int) -> []:
+        first = max(0, (after - self.start) // self.interval + 1)
+        last = self.posts_per_sub if before is None else min(self.posts_per_sub,
+                                                              (before - 1 - self.start) // self.interval + 1)
+        return [self.submission(sub_name, i) for i in range(first, min(last, first + limit))]
+
+    def comment_ids(self, post_id: str) -> []:
+        sub_name, i = self.locate(post_id)
+        return ['{}_{}'.format(post_id, j) for j in range(i % self.max_comments)]
+
+    def comments(self, ids: []) -> []:
+        comments = []
+        for comment_id in ids:
+            post_id, j = comment_id.split('_')
+            sub_name, i = self.locate(post_id)
+            comments.append({
+                'id': comment_id,
+                'link_id': 't3_' + post_id,
+                'created_utc': self.start + i * self.interval + int(j),
+                'body': 'y' * 100,
+                'score': int(j)
+            })
+        return comments
+
+
+class PushshiftServer:
+    """
+    Local HTTP server serving SyntheticPushshift data on the pushshift api paths,
+    with latency seconds of simulated delay per request
+    """
+
+    def __init__(self, data: SyntheticPushshift, latency: float = 0.0):
+        self.data = data
+        self.latency = latency
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are sent in separate writes, with Nagle every response waits for delayed ack
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                params = {key: values[0] for key, values in parse_qs(parts.query).items()}
+                response = server.handle(parts.path, params)
+                if server.latency > 0:
+                    time.sleep(server.latency)
+                body = json.dumps({'data': response}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def handle(self, path: str, params: dict) -> []:
+        if path.startswith('/reddit/search/submission'):
+            before = int(params['before']) if 'before' in params else None
+            return self.data.submissions(params['subreddit'], int(params['after']), before, int(params['limit']))
+        if path.startswith('/reddit/submission/comment_ids/'):
+            return self.data.comment_ids(path.rsplit('/', 1)[1])
+        if path.startswith('/reddit/comment/search'):
+            return self.data.comments(params['ids'].split(','))
+        return []
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RedirectingFetcher(Fetcher):
+    """
+    Fetcher sending pushshift requests to a local server, recording latency of every request
+    """
+
+    def __init__(self, base_url: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.base_url = base_url
+        self.latencies = []
+
+    def get(self, url: str) -> bytes:
+        parts = urlsplit(url)
+        local = self.base_url + parts.path + ('?' + parts.query if parts.query else '')
+        start = time.perf_counter()
+        body = super().get(local)
+        self.latencies.append(time.perf_counter() - start)
+        return body
+
+
+class FakeComment:
+    def __init__(self, i: int):
+        self.created = 1546300800 + i
+        self.score = 100 - i
+        self.body = 'z' * 100
+        self.replies = []
+
+
+class FakeSubmission:
+    """
+    Stand-in for praw Submission, comments are loaded with a simulated request on first access
+    """
+
+    def __init__(self, reddit: 'FakeReddit', submission_id: str, i: int = 0):
+        self.reddit = reddit
+        self.id = submission_id
+        self.created_utc = 1546300800.0 + i
+        self.title = 'Synthetic hot submission {}'.format(i)
+        self.selftext = 'x' * 200
+        self.score = i
+        self.upvote_ratio = 0.9
+        self.permalink = '/r/bench/comments/' + submission_id
+        self.num_comments = int(submission_id, 36) % 20
+        self.comment_sort = 'confidence'
+        self.comment_limit = None
+        self.loaded = None
+
+    @property
+    def comments(self) -> []:
+        if self.loaded is None:
+            self.reddit.request()
+            count = min(self.num_comments, self.comment_limit or self.num_comments)
+            self.loaded = [FakeComment(i) for i in range(count)]
+            self.reddit.comment_loads.append(count)
+        return self.loaded
+
+
+class FakeSubreddit:
+    def __init__(self, reddit: 'FakeReddit', name: str):
+        self.reddit = reddit
+        self.name = name
+
+    def hot(self, limit: int = 100) -> []:
+        count = min(limit, self.reddit.posts_per_sub)
+        # Listings are fetched in pages of 100
+        for _ in range(0, count, 100):
+            self.reddit.request()
+        # crc32 is the same in every process, unlike hash() of a str
+        base = (zlib.crc32(self.name.encode()) % 1000 + 1) * 10 ** 6
+        return [FakeSubmission(self.reddit, to_base36(base + i), i) for i in range(count)]
+
+
+class FakeUser:
+    @staticmethod
+    def me() -> str:
+        return 'benchmark'
+
+
+class FakeReddit:
+    """
+    Stand-in for praw Reddit. Every simulated request spends the rate budget like
+    BudgetedRequestor does, sleeps latency seconds and its latency is recorded, as is
+    the number of comments of every loaded comment tree
+    """
+
+    def __init__(self, posts_per_sub: int = 100, latency: float = 0.0, latencies: [] = None,
+                 budget: RateBudget = None, comment_loads: [] = None):
+        self.posts_per_sub = posts_per_sub
+        self.latency = latency
+        self.latencies = latencies if latencies is not None else []
+        self.comment_loads = comment_loads if comment_loads is not None else []
+        self.budget = budget
+        self.user = FakeUser()
+
+    def request(self) -> None:
+        start = time.perf_counter()
+        if self.budget is not None:
+            self.budget.acquire()
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self.latencies.append(time.perf_counter() - start)
+
+    def subreddit(self, name: str) -> FakeSubreddit:
+        return FakeSubreddit(self, name)
+
+    def submission(self, id: str) -> FakeSubmission:
+        return FakeSubmission(self, id)
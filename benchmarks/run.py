@@ -0,0 +1,318 @@
+"""
+Offline benchmarks of the history scrapper, the live scrapper and the Bittrex loader.
+Pushshift, Reddit and Mongo are replaced with the local stand-ins from benchmarks.fakes,
+so no credentials or network are needed. Every case runs in its own process, so peak
+RSS is measured per case. Results are written as json, e.g.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --baseline results.json
+
+With --baseline, the run exits with status 1 if any throughput dropped, or latency
+or peak RSS grew, by more than --tolerance
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+from pathlib import Path
+
+import checkpoints
+import metrics
+from benchmarks.fakes import FakeReddit, PushshiftServer, RedirectingFetcher, SyntheticPushshift
+from tests.fakes import FakeMongoClient
+
+root_path = str(Path(__file__).parents[1])
+
+# Metrics where a higher value is a regression, all the other ones are throughputs
+lower_is_better = ['latency_p50', 'latency_p99', 'peak_rss_mb']
+# Latencies below that are timer noise and are not compared
+min_latency = 0.001
+
+
+def percentile(values: [], q: float) -> float:
+    """
+    Returns q-th percentile of values, using the nearest rank method
+    :param values:
+    :param q: percentile in [0, 100]
+    :return:
+    """
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered))) - 1))]
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def get_subs(args: argparse.Namespace) -> []:
+    return ['bench{}'.format(i) for i in range(args.subs)]
+
+
+def bench_history(args: argparse.Namespace, tmp: str) -> dict:
+    from scrappers import history
+    client = FakeMongoClient()
+    history.get_remote_client = lambda server_type: client
+    history.CheckpointStore = partial(checkpoints.CheckpointStore, tmp + '/checkpoints.db')
+    data = SyntheticPushshift(get_subs(args), args.posts)
+    with PushshiftServer(data, latency=args.latency) as server:
+        scrapper = history.HistoricalRedditScrapper(max_workers=args.workers)
+        scrapper.config = {'subreddits': [{'name': sub_name} for sub_name in data.subs]}
+        scrapper.comments_storage = args.comments_storage
+        scrapper.start_date = str(data.start - 1)
+        scrapper.silent = True
+        scrapper.fetcher.close()
+        scrapper.fetcher = RedirectingFetcher(server.url, max_connections=args.workers,
+                                              requests_per_second=args.rate, burst=args.workers)
+        start = time.perf_counter()
+        scrapper.scrap_all()
+        scrapper.writer.flush()
+        submissions_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for sub_name in data.subs:
+            scrapper.get_comments_from_sub(sub_name)
+        comments_time = time.perf_counter() - start
+        scrapper.close()
+    collections = [client.reddit[sub_name + '_history'] for sub_name in data.subs]
+    submissions = sum(len(collection.docs) for collection in collections)
+    if args.comments_storage == 'collection':
+        comments = sum(len(client.reddit[sub_name + '_comments'].docs) for sub_name in data.subs)
+    else:
+        comments = sum(len(post.get('comments', [])) for collection in collections
+                       for post in collection.docs.values())
+    return {
+        'submissions': submissions,
+        'submissions_per_second': submissions / submissions_time,
+        'comments': comments,
+        'comments_per_second': comments / comments_time,
+        'requests': len(scrapper.fetcher.latencies),
+        'latency_p50': percentile(scrapper.fetcher.latencies, 50),
+        'latency_p99': percentile(scrapper.fetcher.latencies, 99)
+    }
+
+
+def bench_live(args: argparse.Namespace, tmp: str) -> dict:
+    from scrappers import reddit
+    from scrappers.storage import create_storage
+    latencies = []
+    comment_loads = []
+    rows = []
+
+    class BenchmarkRedditScrapper(reddit.RedditScrapper):
+        def create_reddit(self) -> FakeReddit:
+            return FakeReddit(args.posts, latency=args.latency, latencies=latencies, budget=self.budget,
+                              comment_loads=comment_loads)
+
+        def update_submissions(self, sub_name: str, submissions: []):
+            super().update_submissions(sub_name, submissions)
+            rows.extend(submissions)
+
+    scrapper = BenchmarkRedditScrapper()
+    scrapper.config = {'subreddits': [{'name': sub_name} for sub_name in get_subs(args)]}
+    scrapper.data_path = tmp + '/'
+    scrapper.storage = create_storage('csv', scrapper.data_path)
+    scrapper.create_dirs()
+    scrapper.create_sub_files()
+    start = time.perf_counter()
+    scrapper.start(silent=True, workers=args.workers)
+    elapsed = time.perf_counter() - start
+    comments = sum(len(row['comments']['top']) + len(row['comments']['controversial']) for row in rows)
+    return {
+        'submissions': len(rows),
+        'submissions_per_second': len(rows) / elapsed,
+        'comments': comments,
+        'comments_per_second': comments / elapsed,
+        'requests': len(latencies),
+        'comments_loaded': sum(comment_loads),
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99)
+    }
+
+
+def write_bittrex_files(args: argparse.Namespace, path: str) -> int:
+    """
+    Writes synthetic Bittrex hourly market files in the downloaded format
+    :param args:
+    :param path: directory of market files
+    :return: number of rows written
+    """
+    import numpy as np
+    import pandas as pd
+    os.makedirs(path)
+    rng = np.random.default_rng(0)
+    dates = pd.date_range('2017-01-01', periods=args.rows, freq='h').strftime('%Y-%m-%d %I-%p')
+    for i in range(args.files):
+        close = 100 + rng.random(args.rows).cumsum()
+        df = pd.DataFrame({
+            'Date': dates[::-1],
+            'Symbol': 'BENCH{}BTC'.format(i),
+            'Open': close * 0.99,
+            'High': close * 1.01,
+            'Low': close * 0.98,
+            'Close': close,
+            'Volume BENCH{}'.format(i): rng.random(args.rows) * 1000,
+            'Volume BTC': rng.random(args.rows) * 10
+        })
+        with open(path + 'Bittrex_BENCH{}BTC_1h.csv'.format(i), 'w') as f:
+            f.write('https://www.CryptoDataDownload.com\n')
+            df.to_csv(f, index=False)
+    return args.files * args.rows
+
+
+def bench_bittrex(args: argparse.Namespace, tmp: str, mode: str) -> dict:
+    from loaders import bittrex
+    rows = write_bittrex_files(args, tmp + '/bittrex/')
+    start = time.perf_counter()
+    if mode == 'master':
+        bittrex.update_bittrex_master(tmp + '/bittrex/', tmp + '/master/', workers=args.workers)
+    else:
+        chunksize = args.chunksize if mode == 'stream' else None
+        bittrex.load_bittrex_data(tmp + '/bittrex/', tmp + '/master.csv', workers=args.workers, chunksize=chunksize)
+    elapsed = time.perf_counter() - start
+    return {
+        'rows': rows,
+        'rows_per_second': rows / elapsed
+    }
+
+
+cases = {
+    'history': bench_history,
+    'live': bench_live,
+    'bittrex': partial(bench_bittrex, mode='full'),
+    'bittrex_stream': partial(bench_bittrex, mode='stream'),
+    'bittrex_master': partial(bench_bittrex, mode='master')
+}
+
+
+def run_case(name: str, args: argparse.Namespace) -> dict:
+    """
+    Runs single case in the current process, output of the scrappers is discarded
+    :param name:
+    :param args:
+    :return: case metrics
+    """
+    if args.metrics:
+        metrics.enable()
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            result = cases[name](args, tmp)
+            result['seconds'] = time.perf_counter() - start
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def spawn_case(name: str, argv: []) -> dict:
+    """
+    Runs single case in a child process
+    :param name:
+    :param argv: benchmark arguments passed to the child
+    :return: case metrics, or error message if the case failed
+    """
+    process = subprocess.run([sys.executable, '-m', 'benchmarks.run', '--case', name] + argv,
+                             cwd=root_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        return {'error': process.stderr.strip().splitlines()[-1] if process.stderr.strip() else 'failed'}
+    return json.loads(process.stdout)
+
+
+def get_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root_path,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> []:
+    """
+    Compares results with baseline results of the same cases
+    :param results:
+    :param baseline:
+    :param tolerance: allowed relative change, e.g. 0.2 for 20%
+    :return: list of regression descriptions
+    """
+    regressions = []
+    for name, case_metrics in results.items():
+        for metric, old in baseline.get(name, {}).items():
+            new = case_metrics.get(metric)
+            if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or old == 0:
+                continue
+            if metric.startswith('latency') and max(old, new) < min_latency:
+                continue
+            if metric in lower_is_better:
+                change = (new - old) / old
+            elif metric.endswith('_per_second'):
+                change = (old - new) / old
+            else:
+                continue
+            if change > tolerance:
+                regressions.append('{} {}: {:.4g} -> {:.4g} ({:+.0%})'.format(name, metric, old, new,
+                                                                              (new - old) / old))
+    return regressions
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Runs offline benchmarks')
+    parser.add_argument('--cases', nargs='+', choices=sorted(cases), default=list(cases))
+    parser.add_argument('--subs', type=int, default=4, help='number of synthetic subs')
+    parser.add_argument('--posts', type=int, default=5000, help='submissions per sub')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per request')
+    parser.add_argument('--rate', type=float, default=1e6, help='pushshift requests per second')
+    parser.add_argument('--comments-storage', choices=['embedded', 'collection'], default='embedded')
+    parser.add_argument('--files', type=int, default=20, help='number of Bittrex market files')
+    parser.add_argument('--rows', type=int, default=20000, help='rows per Bittrex market file')
+    parser.add_argument('--chunksize', type=int, default=10000, help='rows per chunk in streaming mode')
+    parser.add_argument('--metrics', action='store_true', help='run with metrics enabled, to measure their overhead')
+    parser.add_argument('--output', help='path of results json, printed when not given')
+    parser.add_argument('--baseline', help='path of results json to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--case', choices=sorted(cases), help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv: [] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    args = get_parser().parse_args(argv)
+    if args.case is not None:
+        print(json.dumps(run_case(args.case, args)))
+        return 0
+    parameters = ['subs', 'posts', 'workers', 'latency', 'rate', 'comments_storage', 'files', 'rows', 'chunksize']
+    child_argv = ['--metrics'] if args.metrics else []
+    for parameter in parameters:
+        child_argv += ['--' + parameter.replace('_', '-'), str(getattr(args, parameter))]
+    report = {
+        'revision': get_revision(),
+        'python': platform.python_version(),
+        'timestamp': int(time.time()),
+        'parameters': {parameter: getattr(args, parameter) for parameter in parameters + ['metrics']},
+        'results': {name: spawn_case(name, child_argv) for name in args.cases}
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(report['results'], baseline['results'], args.tolerance)
+    for regression in regressions:
+        print('Regression: ' + regression, file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
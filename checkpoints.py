@@ -0,0 +1,63 @@
+import json
+import sqlite3
+import threading
+from typing import Any
+
+from credsmanager import config_path
+
+checkpoints_path = config_path + 'checkpoints.db'
+
+
+class CheckpointStore:
+    """
+    Scrapping cursor state, kept apart from the static config files. Backed by an SQLite
+    database in WAL mode, so every update is a small atomic transaction instead of a
+    rewrite of the whole config. With synchronous=NORMAL commits are fsynced in batches
+    at WAL checkpoints; a crash can lose the latest updates but never corrupts the store.
+    Safe to use from many threads, and from many processes thanks to the busy timeout
+    """
+
+    def __init__(self, path: str = checkpoints_path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS checkpoints ('
+                                'scope TEXT NOT NULL, '
+                                'key TEXT NOT NULL, '
+                                'value TEXT NOT NULL, '
+                                'PRIMARY KEY (scope, key))')
+
+    def get(self, scope: str, key: str, default: Any = None) -> Any:
+        """
+        Returns value stored under key in scope, e.g. a sub name
+        :param scope:
+        :param key:
+        :param default: returned when nothing is stored
+        :return:
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM checkpoints WHERE scope = ? AND key = ?',
+                                          (scope, key)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set(self, scope: str, key: str, value: Any) -> None:
+        """
+        Atomically stores JSON serializable value under key in scope
+        :param scope:
+        :param key:
+        :param value:
+        :return:
+        """
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO checkpoints (scope, key, value) VALUES (?, ?, ?)',
+                                    (scope, key, json.dumps(value)))
+
+    def delete(self, scope: str, key: str) -> None:
+        with self.lock:
+            self.connection.execute('DELETE FROM checkpoints WHERE scope = ? AND key = ?', (scope, key))
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
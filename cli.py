@@ -0,0 +1,244 @@
+"""
+Single entry point of all the scrappers and loaders, e.g.
+
+    python cli.py live --workers 4
+    python cli.py daemon --workers 4
+    python cli.py backfill --shards 4
+    python cli.py hydrate --subs Bitcoin
+    python cli.py load-bittrex --incremental
+    python cli.py load-prices
+    python cli.py refresh-views --assets Ripple
+
+Only argparse is imported at start, modules of a subcommand, and with them
+praw, pymongo or pandas, are imported when the subcommand runs
+"""
+import argparse
+import os
+import signal
+import sys
+
+
+def get_subs(args: argparse.Namespace, config: dict) -> []:
+    """
+    Returns names of subs given with --subs, or of all the subs from config
+    :param args:
+    :param config:
+    :return:
+    """
+    names = [sub['name'] for sub in config['subreddits']]
+    if not args.subs:
+        return names
+    unknown = [name for name in args.subs if name not in names]
+    if unknown:
+        raise SystemExit('Unknown subs: {}, add them to config/reddit.json first'.format(', '.join(unknown)))
+    return args.subs
+
+
+def as_dir(path: str) -> str:
+    """
+    Returns directory path ending with a separator, as the loaders expect, or None
+    :param path:
+    :return:
+    """
+    return os.path.join(path, '') if path is not None else None
+
+
+def start_metrics(config: dict) -> None:
+    import metrics
+    metrics.configure(config.get('metrics'))
+
+
+def live(args: argparse.Namespace) -> None:
+    from scrappers.reddit import RedditScrapper
+    scrapper = RedditScrapper()
+    start_metrics(scrapper.config)
+    scrapper.connect()
+    scrapper.create_dirs()
+    scrapper.create_sub_files()
+    scrapper.start(silent=args.silent, workers=args.workers)
+
+
+def daemon(args: argparse.Namespace) -> None:
+    from scrappers.daemon import ScrapperDaemon
+    from scrappers.reddit import RedditScrapper
+    scrapper = RedditScrapper()
+    scrapper.silent = args.silent
+    start_metrics(scrapper.config)
+    scrapper.connect()
+    scrapper.create_dirs()
+    scrapper.create_sub_files()
+    scrapper_daemon = ScrapperDaemon.from_config(scrapper, workers=args.workers)
+    signal.signal(signal.SIGTERM, lambda *_: scrapper_daemon.stop())
+    try:
+        scrapper_daemon.run()
+    except KeyboardInterrupt:
+        scrapper_daemon.stop()
+
+
+def create_history_scrapper(args: argparse.Namespace):
+    from scrappers.history import HistoricalRedditScrapper
+    scrapper = HistoricalRedditScrapper(max_workers=args.workers, requests_per_second=args.rate,
+                                        cache_mode=args.cache, server_type=args.server)
+    scrapper.silent = args.silent
+    start_metrics(scrapper.config)
+    return scrapper
+
+
+def backfill(args: argparse.Namespace) -> None:
+    scrapper = create_history_scrapper(args)
+    try:
+        if args.gaps:
+            for sub_name in get_subs(args, scrapper.config):
+                scrapper.scrap_sub_gaps(sub_name)
+        elif args.subs:
+            for sub_name in get_subs(args, scrapper.config):
+                if args.shards > 1:
+                    scrapper.scrap_sub_sharded(sub_name, args.shards)
+                else:
+                    scrapper.scrap_sub(sub_name)
+        else:
+            scrapper.scrap_all(shards=args.shards)
+    finally:
+        scrapper.close()
+
+
+def hydrate(args: argparse.Namespace) -> None:
+    scrapper = create_history_scrapper(args)
+    try:
+        for sub_name in get_subs(args, scrapper.config):
+            scrapper.get_comments_from_sub(sub_name, resume=not args.restart)
+    finally:
+        scrapper.close()
+
+
+def migrate_comments(args: argparse.Namespace) -> None:
+    scrapper = create_history_scrapper(args)
+    try:
+        for sub_name in get_subs(args, scrapper.config):
+            scrapper.migrate_comments(sub_name, page_size=args.page_size)
+    finally:
+        scrapper.close()
+
+
+def load_bittrex(args: argparse.Namespace) -> None:
+    from loaders.bittrex import load_bittrex_data, update_bittrex_master
+    if args.incremental:
+        update_bittrex_master(as_dir(args.path), as_dir(args.output), workers=args.workers)
+    else:
+        load_bittrex_data(as_dir(args.path), args.output, workers=args.workers, chunksize=args.chunksize)
+
+
+def load_prices(args: argparse.Namespace) -> None:
+    from loaders.candles import update_bittrex_prices
+    from scrappers.history import get_remote_client
+    candles = update_bittrex_prices(get_remote_client(args.server).exchanges, as_dir(args.master), full=args.full)
+    print("Written {} hourly candles".format(candles))
+
+
+def load_coinmarketcap(args: argparse.Namespace) -> None:
+    from loaders.bittrex import load_coinmarketcap_data
+    from loaders.ohlcv import build_ohlcv_store
+    build_ohlcv_store(load_coinmarketcap_data(args.path), as_dir(args.output))
+
+
+def refresh_views(args: argparse.Namespace) -> None:
+    from loaders.views import AssetViewBuilder, get_assets
+    from scrappers.history import get_remote_client
+    assets = get_assets()
+    if args.assets:
+        names = [asset['name'] for asset in assets]
+        unknown = [name for name in args.assets if name not in names]
+        if unknown:
+            raise SystemExit('Unknown assets: {}, add them to config/assets.json first'.format(', '.join(unknown)))
+        assets = [asset for asset in assets if asset['name'] in args.assets]
+    builder = AssetViewBuilder(get_remote_client(args.server).reddit, assets, path=as_dir(args.output),
+                               ohlcv=as_dir(args.ohlcv), master=as_dir(args.master))
+    for asset in assets:
+        refreshed = builder.refresh(asset, full=args.full)
+        if not args.silent:
+            print("Refreshed {}: {} hourly and {} daily buckets".format(asset['name'], refreshed['1h'],
+                                                                        refreshed['1d']))
+
+
+def add_history_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--subs', nargs='+', help='subs to process, all the subs from config by default')
+    parser.add_argument('--workers', type=int, default=4, help='subs, windows or requests processed concurrently')
+    parser.add_argument('--rate', type=float, default=1.0, help='pushshift requests per second')
+    parser.add_argument('--cache', choices=['record', 'replay'], help='cache pushshift responses on disk')
+    parser.add_argument('--server', choices=['localhost', 'local_network', 'public'], default='localhost',
+                        help='Mongo server')
+    parser.add_argument('--silent', action='store_true')
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='hesoyam', description='Hesoyam scrappers and loaders')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    command = commands.add_parser('live', help='scrap hot submissions of all the subs with the Reddit API')
+    command.add_argument('--workers', type=int, default=1, help='subs and submissions scrapped concurrently')
+    command.add_argument('--silent', action='store_true')
+    command.set_defaults(handler=live)
+
+    command = commands.add_parser('daemon', help='poll new submissions and snapshot hot listings continuously')
+    command.add_argument('--workers', type=int, default=4, help='polls and snapshots run concurrently')
+    command.add_argument('--silent', action='store_true')
+    command.set_defaults(handler=daemon)
+
+    command = commands.add_parser('backfill', help='scrap submission history from pushshift')
+    add_history_arguments(command)
+    command.add_argument('--shards', type=int, default=1, help='time windows every sub is split into')
+    command.add_argument('--gaps', action='store_true', help='scrap only periods missing from coverage')
+    command.set_defaults(handler=backfill)
+
+    command = commands.add_parser('hydrate', help='fetch comments of scrapped history submissions')
+    add_history_arguments(command)
+    command.add_argument('--restart', action='store_true', help='scan from the start instead of resuming')
+    command.set_defaults(handler=hydrate)
+
+    command = commands.add_parser('migrate-comments', help='move embedded comments to comments collections')
+    add_history_arguments(command)
+    command.add_argument('--page-size', type=int, default=100, help='posts held in memory at once')
+    command.set_defaults(handler=migrate_comments)
+
+    command = commands.add_parser('load-bittrex', help='consolidate Bittrex hourly market files')
+    command.add_argument('--path', help='directory with market files')
+    command.add_argument('--output', help='master csv, or master directory with --incremental')
+    command.add_argument('--workers', type=int, default=8, help='files read in parallel')
+    command.add_argument('--chunksize', type=int, help='stream files in chunks of that many rows')
+    command.add_argument('--incremental', action='store_true', help='update Parquet master, parsing only changed files')
+    command.set_defaults(handler=load_bittrex)
+
+    command = commands.add_parser('load-prices', help='update price documents of Bittrex markets from the master')
+    command.add_argument('--master', help='directory of the master data set')
+    command.add_argument('--server', choices=['localhost', 'local_network', 'public'], default='localhost',
+                         help='Mongo server')
+    command.add_argument('--full', action='store_true', help='replace all the candles instead of the trailing ones')
+    command.set_defaults(handler=load_prices)
+
+    command = commands.add_parser('load-coinmarketcap', help='build OHLCV store from coinmarketcap data')
+    command.add_argument('--path', help='path of coinmarket.csv')
+    command.add_argument('--output', help='directory of the store')
+    command.set_defaults(handler=load_coinmarketcap)
+
+    command = commands.add_parser('refresh-views', help='refresh per asset views of reddit activity and prices')
+    command.add_argument('--assets', nargs='+', help='assets to refresh, all the assets from config by default')
+    command.add_argument('--full', action='store_true', help='rebuild views instead of refreshing touched buckets')
+    command.add_argument('--server', choices=['localhost', 'local_network', 'public'], default='localhost',
+                         help='Mongo server')
+    command.add_argument('--output', help='directory of the views')
+    command.add_argument('--ohlcv', help='directory of the coinmarketcap OHLCV store')
+    command.add_argument('--master', help='directory of the Bittrex master data set')
+    command.add_argument('--silent', action='store_true')
+    command.set_defaults(handler=refresh_views)
+    return parser
+
+
+def main(argv: [] = None) -> int:
+    args = get_parser().parse_args(argv)
+    args.handler(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,27 +1,45 @@
+import copy
 import json
+import threading
 from pathlib import Path
 
 credentials_path = str(Path(__file__).parent) + '/credentials.json'
 data_path = str(Path(__file__).parent) + '/data/'
 config_path = str(Path(__file__).parent) + '/config/'
 
+# Parsed files are cached in-process, callers get copies so they can't change the cache
+_cache = {}
+_lock = threading.Lock()
+
+
+def load_json(path: str) -> dict:
+    with _lock:
+        if path not in _cache:
+            with open(path) as f:
+                _cache[path] = json.load(f)
+        return _cache[path]
+
+
+def clear_cache() -> None:
+    with _lock:
+        _cache.clear()
+
 
 def get_credentials(site_name: str):
-    with open(credentials_path) as f:
-        creds = json.load(f)
-    return {
+    creds = load_json(credentials_path)
+    return copy.deepcopy({
         'reddit': creds['reddit'],
         'mongo': creds['mongo'],
-    }.get(site_name, {})
+    }.get(site_name, {}))
 
 
 def get_config(site_name: str):
-    path = config_path + site_name + '.json'
-    with open(path) as f:
-        return json.load(f)
+    return copy.deepcopy(load_json(config_path + site_name + '.json'))
 
 
 def update_config(new_config, site_name: str):
     path = config_path + site_name + '.json'
-    with open(path, 'w') as f:
-        return json.dump(new_config, f, indent=4)
+    with _lock:
+        with open(path, 'w') as f:
+            json.dump(new_config, f, indent=4)
+        _cache[path] = copy.deepcopy(new_config)
@@ -1,12 +1,52 @@
+import hashlib
+import json
 import os
-from datetime import datetime
-import time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+import metrics
 from credsmanager import data_path
 
+master_path = data_path + 'bittrex_master/'
+manifest_name = 'manifest.json'
+date_format: str = "%Y-%m-%d %I-%p"
+epoch = pd.Timestamp(0, tz='UTC')
+coinmarketcap_dtypes = {
+    'Symbol': 'category',
+    'Date': str,
+    'Open': 'float64',
+    'High': 'float64',
+    'Low': 'float64',
+    'Close': 'float64',
+    'Volume': 'float64',
+    'MarketCap': 'float64'
+}
+bittrex_dtypes = {
+    'Date': str,
+    'Symbol': str,
+    'Open': 'float64',
+    'High': 'float64',
+    'Low': 'float64',
+    'Close': 'float64'
+}
 
-def load_coinmarketcap_data() -> None:
-    df: pd.DataFrame = pd.read_csv(data_path + "coinmarket.csv")
+loaded_rows = metrics.registry.counter('loader_rows_total', 'Rows parsed by loaders', ('loader',))
+read_bytes = metrics.registry.counter('loader_read_bytes_total', 'Bytes of files parsed by loaders', ('loader',))
+bittrex_rows = loaded_rows.labels('bittrex')
+bittrex_bytes = read_bytes.labels('bittrex')
+
+
+@metrics.traced('coinmarketcap.load')
+def load_coinmarketcap_data(path: str = None) -> pd.DataFrame:
+    """
+    Loads coinmarketcap daily OHLCV history
+    :param path: path of coinmarket.csv
+    :return:
+    """
+    path = path or data_path + "coinmarket.csv"
+    df: pd.DataFrame = pd.read_csv(path, dtype=coinmarketcap_dtypes)
+    if metrics.registry.enabled:
+        loaded_rows.labels('coinmarketcap').inc(len(df))
+        read_bytes.labels('coinmarketcap').inc(os.path.getsize(path))
     df.drop(['CoinId', 'Id'], axis=1, inplace=True)
     df.rename(columns={
         'Id': 'id',
@@ -19,28 +59,160 @@ def load_coinmarketcap_data() -> None:
         'Volume': 'volume',
         'MarketCap': 'marketCap'
     }, inplace=True)
-    print(df.head())
     df['date'] = pd.to_datetime(df['date'])
-    print(df.tail())
+    return df
+
+
+@metrics.traced('bittrex.load')
+def load_bittrex_data(path: str = None, output: str = None, workers: int = 8, chunksize: int = None) -> None:
+    """
+    Consolidates all the Bittrex hourly market files into one master csv, with dates
+    converted to UTC epoch seconds. Files are read in parallel and concatenated once.
+    With chunksize set, files are streamed in chunks of that many rows instead,
+    so peak memory does not depend on the size of the data set
+    :param path: directory with market files
+    :param output: path of master csv
+    :param workers: number of files read in parallel
+    :param chunksize: number of rows held in memory at once in streaming mode
+    :return:
+    """
+    path = path or data_path + 'bittrex/'
+    output = output or data_path + 'bittrex_master.csv'
+    paths = [path + filename for filename in sorted(os.listdir(path))]
+    if chunksize is not None:
+        stream_bittrex_data(paths, output, chunksize)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        frames = list(executor.map(read_bittrex_file, paths))
+    master_df: pd.DataFrame = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    master_df.to_csv(output, index=False)
+
+
+def stream_bittrex_data(paths: [], output: str, chunksize: int) -> None:
+    # Files quote volume in different currencies, so the master has the union of their columns
+    columns = []
+    for path in paths:
+        for column in get_bittrex_columns(path):
+            if column not in columns:
+                columns.append(column)
+    with open(output, 'w') as f:
+        pd.DataFrame(columns=columns).to_csv(f, index=False)
+        for path in paths:
+            file_columns = get_bittrex_columns(path)
+            bittrex_bytes.inc(os.path.getsize(path))
+            for df in pd.read_csv(path, skiprows=1, dtype=bittrex_dtypes, chunksize=chunksize):
+                bittrex_rows.inc(len(df))
+                df.columns = file_columns
+                df['date'] = to_utc(df['date'])
+                df.reindex(columns=columns).to_csv(f, index=False, header=False)
+
+
+@metrics.traced('bittrex.update_master')
+def update_bittrex_master(path: str = None, master: str = None, workers: int = 8) -> None:
+    """
+    Incrementally updates the master data set, stored as one Parquet part per market file.
+    A manifest keyed by file name keeps size, mtime and sha256 of every processed file,
+    only new or changed files are parsed and only their parts are rewritten. Parts of
+    removed files are dropped. read_bittrex_master returns the same frame as a full rebuild
+    :param path: directory with market files
+    :param master: directory of the master data set
+    :param workers: number of files read in parallel
+    :return:
+    """
+    path = path or data_path + 'bittrex/'
+    master = master or master_path
+    os.makedirs(master, exist_ok=True)
+    manifest = load_manifest(master)
+    filenames = sorted(os.listdir(path))
+    changed = []
+    for filename in filenames:
+        stat = os.stat(path + filename)
+        entry = manifest.get(filename)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            continue
+        digest = file_hash(path + filename)
+        if entry is not None and entry['sha256'] == digest:
+            entry['mtime'] = stat.st_mtime
+            continue
+        changed.append(filename)
+        manifest[filename] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': digest,
+            'part': filename + '.parquet'
+        }
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        frames = executor.map(read_bittrex_file, [path + filename for filename in changed])
+        for filename, df in zip(changed, frames):
+            part = master + manifest[filename]['part']
+            df.to_parquet(part + '.tmp', index=False)
+            os.replace(part + '.tmp', part)
+    for filename in set(manifest) - set(filenames):
+        part = master + manifest.pop(filename)['part']
+        if os.path.isfile(part):
+            os.remove(part)
+    save_manifest(master, manifest)
+
+
+def read_bittrex_master(master: str = None) -> pd.DataFrame:
+    """
+    Reads the master data set built by update_bittrex_master
+    :param master: directory of the master data set
+    :return:
+    """
+    master = master or master_path
+    manifest = load_manifest(master)
+    frames = [pd.read_parquet(master + manifest[filename]['part']) for filename in sorted(manifest)]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def load_manifest(master: str) -> dict:
+    if not os.path.isfile(master + manifest_name):
+        return {}
+    with open(master + manifest_name) as f:
+        return json.load(f)
+
+
+def save_manifest(master: str, manifest: dict) -> None:
+    with open(master + manifest_name + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(master + manifest_name + '.tmp', master + manifest_name)
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@metrics.traced('bittrex.read_file')
+def read_bittrex_file(path: str) -> pd.DataFrame:
+    df: pd.DataFrame = pd.read_csv(path, skiprows=1, dtype=bittrex_dtypes)
+    if metrics.registry.enabled:
+        bittrex_rows.inc(len(df))
+        bittrex_bytes.inc(os.path.getsize(path))
+    df.columns = normalize_columns(list(df.columns.values))
+    df['date'] = to_utc(df['date'])
+    return df
 
 
-def load_bittrex_data() -> None:
-    path: str = data_path + 'bittrex/'
-    master_df: pd.DataFrame = pd.DataFrame()
+def get_bittrex_columns(path: str) -> []:
+    return normalize_columns(list(pd.read_csv(path, skiprows=1, nrows=0).columns.values))
 
-    for filename in os.listdir(path):
-        df: pd.DataFrame = pd.read_csv(path + filename, skiprows=1)
-        columns: [] = list(df.columns.values)
-        columns = list(map(lambda n: (n.lower().replace(' ', '_')), columns))
-        columns[-2] = 'volume_self'
-        df.columns = columns
-        master_df = pd.concat([master_df, df], ignore_index=True)
 
-    master_df['date'] = master_df['date'].apply(to_utc)
-    master_df.to_csv(data_path + 'bittrex_master.csv', index=False)
+def normalize_columns(columns: []) -> []:
+    columns = list(map(lambda n: (n.lower().replace(' ', '_')), columns))
+    columns[-2] = 'volume_self'
+    return columns
 
 
-def to_utc(date_str: str) -> str:
-    date_format: str = "%Y-%m-%d %H-%p"
-    date = datetime.strptime(date_str, date_format)
-    return str(time.mktime(date.timetuple()))
+def to_utc(dates: pd.Series) -> pd.Series:
+    """
+    Converts Bittrex date strings like 2018-12-31 11-PM, given in UTC, to epoch seconds
+    :param dates:
+    :return:
+    """
+    dates = pd.to_datetime(dates, format=date_format, utc=True)
+    return (dates - epoch) // pd.Timedelta(seconds=1)
@@ -0,0 +1,243 @@
+import numpy as np
+import pandas as pd
+from pymongo import UpdateOne
+from pymongo.database import Database
+import metrics
+from loaders.bittrex import load_manifest, master_path, read_bittrex_master
+
+hour = 3600
+day = 86400
+
+bulk_write_seconds = metrics.registry.histogram('mongo_bulk_write_seconds', 'Latency of Mongo bulk writes')
+
+
+def resample(markets: np.ndarray, timestamps: np.ndarray, open: np.ndarray, high: np.ndarray,
+             low: np.ndarray, close: np.ndarray, volume: np.ndarray, interval: int) -> dict:
+    """
+    Builds candles of given interval for all the markets at once. Rows are sorted
+    by market and time, candle boundaries are found with a vectorized comparison
+    and every column is reduced with numpy ufunc reduceat
+    :param markets: integer market codes
+    :param timestamps: epoch seconds
+    :param interval: candle length in seconds
+    :return: dict of candle columns sorted by market and timestamp
+    """
+    if len(timestamps) == 0:
+        return empty_candles()
+    buckets = timestamps - timestamps % interval
+    order = np.lexsort((timestamps, buckets, markets))
+    markets = markets[order]
+    buckets = buckets[order]
+    boundaries = (markets[1:] != markets[:-1]) | (buckets[1:] != buckets[:-1])
+    starts = np.flatnonzero(np.concatenate(([True], boundaries)))
+    ends = np.concatenate((starts[1:], [len(order)])) - 1
+    return {
+        'market': markets[starts],
+        'timestamp': buckets[starts],
+        'open': open[order][starts],
+        'high': np.maximum.reduceat(high[order], starts),
+        'low': np.minimum.reduceat(low[order], starts),
+        'close': close[order][ends],
+        'volume': np.add.reduceat(volume[order], starts)
+    }
+
+
+def empty_candles() -> dict:
+    return {
+        'market': np.empty(0, dtype=np.int64),
+        'timestamp': np.empty(0, dtype=np.int64),
+        'open': np.empty(0),
+        'high': np.empty(0),
+        'low': np.empty(0),
+        'close': np.empty(0),
+        'volume': np.empty(0)
+    }
+
+
+def concat(parts: []) -> dict:
+    return {column: np.concatenate([part[column] for part in parts]) for column in parts[0]}
+
+
+def select(columns: dict, mask: np.ndarray) -> dict:
+    return {column: values[mask] for column, values in columns.items()}
+
+
+class CandleBuilder:
+    """
+    Incremental candle builder for one interval. The last candle of every market is
+    open and may still change, so rows of open candles are kept. Each update only
+    resamples those rows together with the new ones, closed candles are never recomputed.
+    Rows of a market have to arrive in time order
+    """
+
+    def __init__(self, interval: int):
+        self.interval = interval
+        self.closed = []
+        self.open = empty_candles()
+        self.pending = None
+
+    def update(self, markets: np.ndarray, timestamps: np.ndarray, open: np.ndarray, high: np.ndarray,
+               low: np.ndarray, close: np.ndarray, volume: np.ndarray) -> dict:
+        """
+        Adds rows and rebuilds open candles of their markets together with the new ones
+        :return: candles rebuilt by this update, sorted by market and timestamp
+        """
+        if len(markets) == 0:
+            return empty_candles()
+        rows = {
+            'market': markets,
+            'timestamp': timestamps,
+            'open': open,
+            'high': high,
+            'low': low,
+            'close': close,
+            'volume': volume
+        }
+        if self.pending is not None:
+            rows = concat([self.pending, rows])
+        candles = resample(rows['market'], rows['timestamp'], rows['open'], rows['high'],
+                           rows['low'], rows['close'], rows['volume'], self.interval)
+        last = np.concatenate((candles['market'][1:] != candles['market'][:-1], [True]))
+        self.closed.append(select(candles, ~last))
+        self.open = select(candles, last)
+        # Open candles are sorted by market, so each row finds its market's open candle by binary search
+        position = np.searchsorted(self.open['market'], rows['market'])
+        buckets = rows['timestamp'] - rows['timestamp'] % self.interval
+        self.pending = select(rows, buckets == self.open['timestamp'][position])
+        return candles
+
+    def candles(self) -> dict:
+        """
+        Returns all the closed and open candles sorted by market and timestamp
+        :return:
+        """
+        candles = concat(self.closed + [self.open])
+        order = np.lexsort((candles['timestamp'], candles['market']))
+        return select(candles, order)
+
+
+@metrics.traced('candles.bittrex')
+def bittrex_candles(df: pd.DataFrame, intervals: [] = (hour, day)) -> tuple:
+    """
+    Resamples Bittrex master frame to candles of all the given intervals
+    :param df: frame returned by read_bittrex_master
+    :param intervals: candle lengths in seconds
+    :return: market names and list of candle dicts, one per interval
+    """
+    symbols = df['symbol'].astype('category')
+    markets = symbols.cat.codes.to_numpy().astype(np.int64)
+    timestamps = df['date'].to_numpy(dtype=np.int64)
+    columns = [df[column].to_numpy(dtype=np.float64) for column in ['open', 'high', 'low', 'close', 'volume_self']]
+    return list(symbols.cat.categories), [resample(markets, timestamps, *columns, interval) for interval in intervals]
+
+
+def to_documents(candles: dict, market_names: []) -> dict:
+    """
+    Converts candle arrays to price arrays of exchange documents
+    :param candles:
+    :param market_names: market name of every market code
+    :return: dict of market name to list of candle dicts
+    """
+    if len(candles['market']) == 0:
+        return {}
+    starts = np.flatnonzero(np.concatenate(([True], candles['market'][1:] != candles['market'][:-1])))
+    ends = np.concatenate((starts[1:], [len(candles['market'])]))
+    documents = {}
+    for start, end in zip(starts, ends):
+        documents[market_names[candles['market'][start]]] = [{
+            'open': float(candles['open'][i]),
+            'high': float(candles['high'][i]),
+            'low': float(candles['low'][i]),
+            'close': float(candles['close'][i]),
+            'volume': float(candles['volume'][i]),
+            'timestamp': int(candles['timestamp'][i])
+        } for i in range(start, end)]
+    return documents
+
+
+@metrics.traced('candles.load_price_documents')
+def load_price_documents(database: Database, exchange: str, market_names: [], hourly: dict, daily: dict) -> None:
+    """
+    Bulk loads hourly and daily candles into price field of exchange documents, one per market.
+    Stored candles of a market from its first given candle on are replaced by the given ones,
+    so only trailing and new candles have to be passed
+    :param database:
+    :param exchange: collection name, e.g. bittrex
+    :param market_names:
+    :param hourly: hourly candles
+    :param daily: daily candles
+    :return:
+    """
+    documents = {'price.hourly': to_documents(hourly, market_names), 'price.daily': to_documents(daily, market_names)}
+    operations = []
+    for market in sorted(set(documents['price.hourly']) | set(documents['price.daily'])):
+        candles = {field: by_market[market] for field, by_market in documents.items() if market in by_market}
+        # $pull and $push of the same field can not be in one update, the bulk write is ordered
+        operations.append(UpdateOne({'market': market}, {'$pull': {
+            field: {'timestamp': {'$gte': values[0]['timestamp']}} for field, values in candles.items()
+        }}))
+        operations.append(UpdateOne({'market': market}, {'$push': {
+            field: {'$each': values} for field, values in candles.items()
+        }}, upsert=True))
+    if len(operations) > 0:
+        with bulk_write_seconds.time():
+            database[exchange].bulk_write(operations, ordered=True)
+
+
+def get_last_candles(database: Database, exchange: str) -> dict:
+    """
+    Returns start of the last stored hourly and daily candle of every market
+    :param database:
+    :param exchange: collection name
+    :return: dict of interval to dict of market name to timestamp
+    """
+    last = {hour: {}, day: {}}
+    projection = {'_id': 0, 'market': 1, 'price.hourly': {'$slice': -1}, 'price.daily': {'$slice': -1}}
+    for document in database[exchange].find({}, projection):
+        price = document.get('price', {})
+        for interval, field in [(hour, 'hourly'), (day, 'daily')]:
+            if len(price.get(field, [])) > 0:
+                last[interval][document['market']] = price[field][-1]['timestamp']
+    return last
+
+
+@metrics.traced('candles.update_bittrex_prices')
+def update_bittrex_prices(database: Database, master: str = None, exchange: str = 'bittrex',
+                          full: bool = False) -> int:
+    """
+    Updates price documents of Bittrex markets from the master data set built by
+    update_bittrex_master. Only candles from the last stored one of every market on are
+    rebuilt and written, the last one as it may have been open when it was stored.
+    Master parts are read one at a time and fed to a CandleBuilder per interval
+    :param database:
+    :param master: directory of the master data set
+    :param exchange: collection of exchange documents
+    :param full: rebuild and replace all the candles
+    :return: number of written hourly candles
+    """
+    master = master or master_path
+    if full:
+        market_names, (hourly, daily) = bittrex_candles(read_bittrex_master(master))
+        load_price_documents(database, exchange, market_names, hourly, daily)
+        return len(hourly['timestamp'])
+    last = get_last_candles(database, exchange)
+    builders = {hour: CandleBuilder(hour), day: CandleBuilder(day)}
+    market_names = []
+    manifest = load_manifest(master)
+    for filename in sorted(manifest):
+        df = pd.read_parquet(master + manifest[filename]['part'])
+        symbols = df['symbol'].astype('category')
+        local_codes = symbols.cat.codes.to_numpy().astype(np.int64)
+        codes = local_codes + len(market_names)
+        market_names.extend(symbols.cat.categories)
+        timestamps = df['date'].to_numpy(dtype=np.int64)
+        columns = [df[column].to_numpy(dtype=np.float64) for column in ['open', 'high', 'low', 'close', 'volume_self']]
+        for interval, builder in builders.items():
+            cuts = np.array([last[interval].get(symbol, np.iinfo(np.int64).min) for symbol in symbols.cat.categories],
+                            dtype=np.int64)
+            mask = timestamps >= cuts[local_codes]
+            builder.update(codes[mask], timestamps[mask], *[column[mask] for column in columns])
+    hourly = builders[hour].candles()
+    daily = builders[day].candles()
+    load_price_documents(database, exchange, market_names, hourly, daily)
+    return len(hourly['timestamp'])
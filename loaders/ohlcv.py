@@ -0,0 +1,88 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import metrics
+from credsmanager import data_path
+from loaders.bittrex import load_coinmarketcap_data
+
+ohlcv_path = data_path + 'ohlcv/'
+index_name = 'index.json'
+column_types = {
+    'date': np.int64,
+    'open': np.float32,
+    'high': np.float32,
+    'low': np.float32,
+    'close': np.float32,
+    # float64 holds every whole number up to 2 ** 53 exactly, and NaN where the value is missing
+    'volume': np.float64,
+    'marketCap': np.float64
+}
+
+
+@metrics.traced('ohlcv.build')
+def build_ohlcv_store(df: pd.DataFrame = None, path: str = None) -> None:
+    """
+    Builds persistent OHLCV store from coinmarketcap data. Every column is saved as
+    a separate .npy array, sorted by symbol and date, and index.json keeps the
+    [start, end) row range of every symbol. Missing values are stored as NaN, so they
+    are not mistaken for a real zero
+    :param df: coinmarketcap frame, loaded with load_coinmarketcap_data if None
+    :param path: directory of the store
+    :return:
+    """
+    df = load_coinmarketcap_data() if df is None else df
+    path = path or ohlcv_path
+    os.makedirs(path, exist_ok=True)
+    symbols = df['symbol'].astype('category')
+    codes = symbols.cat.codes.to_numpy()
+    dates = (pd.to_datetime(df['date'], utc=True) - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+    dates = dates.to_numpy(dtype=np.int64)
+    order = np.lexsort((dates, codes))
+    for column, dtype in column_types.items():
+        values = dates if column == 'date' else df[column].to_numpy(dtype=np.float64)
+        np.save(path + column + '.npy', values[order].astype(dtype))
+    sorted_codes = codes[order]
+    index = {}
+    for code, symbol in enumerate(symbols.cat.categories):
+        start, end = np.searchsorted(sorted_codes, [code, code + 1])
+        if end > start:
+            index[symbol] = [int(start), int(end)]
+    with open(path + index_name + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + index_name + '.tmp', path + index_name)
+
+
+class OhlcvStore:
+    """
+    Read only view of the store built by build_ohlcv_store. Columns are memory mapped,
+    so opening the store reads only the index and queries touch only the pages they return
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or ohlcv_path
+        with open(self.path + index_name) as f:
+            self.index = json.load(f)
+        self.columns = {column: np.load(self.path + column + '.npy', mmap_mode='r') for column in column_types}
+
+    @property
+    def symbols(self) -> []:
+        return list(self.index)
+
+    def query(self, symbol: str, start: int = None, end: int = None) -> dict:
+        """
+        Returns rows of symbol with date in [start, end) as zero copy views of the store
+        :param symbol:
+        :param start: epoch seconds, inclusive
+        :param end: epoch seconds, exclusive
+        :return: dict of column name to numpy array
+        """
+        if symbol not in self.index:
+            return {column: values[0:0] for column, values in self.columns.items()}
+        lo, hi = self.index[symbol]
+        dates = self.columns['date'][lo:hi]
+        if start is not None:
+            lo += int(np.searchsorted(dates, start, side='left'))
+        if end is not None:
+            hi = self.index[symbol][0] + int(np.searchsorted(dates, end, side='left'))
+        return {column: values[lo:hi] for column, values in self.columns.items()}
@@ -0,0 +1,197 @@
+import time
+import numpy as np
+
+bid = 0
+ask = 1
+
+
+def apply_deltas(prices: np.ndarray, sizes: np.ndarray, delta_prices: np.ndarray,
+                 delta_sizes: np.ndarray) -> tuple:
+    """
+    Applies batch of deltas to one side of the book. The last delta of a price level
+    wins, size 0 removes the level. All the work is done with vectorized numpy calls
+    :param prices: sorted price levels
+    :param sizes: size of every price level
+    :param delta_prices: prices of deltas, in the order they happened
+    :param delta_sizes: new sizes of price levels
+    :return: new sorted prices and sizes
+    """
+    if len(delta_prices) == 0:
+        return prices, sizes
+    # np.unique keeps the first occurrence, so the deltas are reversed to keep the last one
+    levels, last = np.unique(delta_prices[::-1], return_index=True)
+    level_sizes = delta_sizes[::-1][last]
+    kept = ~np.isin(prices, levels)
+    added = level_sizes > 0
+    new_prices = np.concatenate((prices[kept], levels[added]))
+    new_sizes = np.concatenate((sizes[kept], level_sizes[added]))
+    order = np.argsort(new_prices, kind='mergesort')
+    return new_prices[order], new_sizes[order]
+
+
+class DeltaLog:
+    """
+    Append only columnar log of order book deltas. Columns are numpy arrays
+    that grow by doubling, so appends are amortized O(1)
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.size = 0
+        self.timestamp = np.empty(capacity, dtype=np.int64)
+        self.side = np.empty(capacity, dtype=np.int8)
+        self.price = np.empty(capacity, dtype=np.float64)
+        self.amount = np.empty(capacity, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, timestamps: np.ndarray, sides: np.ndarray, prices: np.ndarray, amounts: np.ndarray) -> None:
+        count = len(timestamps)
+        if self.size + count > len(self.timestamp):
+            capacity = max(len(self.timestamp) * 2, self.size + count)
+            for column in ['timestamp', 'side', 'price', 'amount']:
+                values = getattr(self, column)
+                grown = np.empty(capacity, dtype=values.dtype)
+                grown[:self.size] = values[:self.size]
+                setattr(self, column, grown)
+        end = self.size + count
+        self.timestamp[self.size:end] = timestamps
+        self.side[self.size:end] = sides
+        self.price[self.size:end] = prices
+        self.amount[self.size:end] = amounts
+        self.size = end
+
+    def position(self, timestamp: int) -> int:
+        """
+        Returns index of the first delta after timestamp
+        :param timestamp:
+        :return:
+        """
+        return int(np.searchsorted(self.timestamp[:self.size], timestamp, side='right'))
+
+
+class OrderBook:
+    """
+    Order book history of one market: snapshots of sorted price level arrays and
+    a columnar log of deltas between them. Every compact_every deltas the current
+    book is stored as a new snapshot, so a book at any time is rebuilt by replaying
+    at most compact_every deltas from the nearest earlier snapshot.
+    Deltas have to be added in time order
+    """
+
+    def __init__(self, compact_every: int = 10000):
+        self.compact_every = compact_every
+        self.deltas = DeltaLog()
+        self.snapshot_timestamps = []
+        self.snapshots = []
+        self.bids = (np.empty(0), np.empty(0))
+        self.asks = (np.empty(0), np.empty(0))
+        self.applied = 0
+
+    def add_snapshot(self, timestamp: int, bids: np.ndarray, asks: np.ndarray) -> None:
+        """
+        Adds full snapshot of the book
+        :param timestamp:
+        :param bids: array of [price, size] rows
+        :param asks: array of [price, size] rows
+        :return:
+        """
+        bids = np.asarray(bids, dtype=np.float64).reshape(-1, 2)
+        asks = np.asarray(asks, dtype=np.float64).reshape(-1, 2)
+        bid_order = np.argsort(bids[:, 0], kind='mergesort')
+        ask_order = np.argsort(asks[:, 0], kind='mergesort')
+        self.bids = (bids[bid_order, 0], bids[bid_order, 1])
+        self.asks = (asks[ask_order, 0], asks[ask_order, 1])
+        self.applied = len(self.deltas)
+        self.store_snapshot(timestamp)
+
+    def store_snapshot(self, timestamp: int) -> None:
+        self.snapshot_timestamps.append(timestamp)
+        self.snapshots.append((len(self.deltas), self.bids, self.asks))
+
+    def add_deltas(self, timestamps: np.ndarray, sides: np.ndarray, prices: np.ndarray, sizes: np.ndarray) -> None:
+        """
+        Appends deltas to the log and applies them to the current book
+        :param timestamps:
+        :param sides: bid or ask
+        :param prices:
+        :param sizes: new size of the price level, 0 removes it
+        :return:
+        """
+        self.deltas.append(timestamps, sides, prices, sizes)
+        start = self.applied
+        end = len(self.deltas)
+        self.bids, self.asks = self.replay(self.bids, self.asks, start, end)
+        self.applied = end
+        last_snapshot = self.snapshots[-1][0] if self.snapshots else 0
+        if end - last_snapshot >= self.compact_every:
+            self.store_snapshot(int(self.deltas.timestamp[end - 1]))
+
+    def replay(self, bids: tuple, asks: tuple, start: int, end: int) -> tuple:
+        sides = self.deltas.side[start:end]
+        prices = self.deltas.price[start:end]
+        amounts = self.deltas.amount[start:end]
+        is_bid = sides == bid
+        bids = apply_deltas(bids[0], bids[1], prices[is_bid], amounts[is_bid])
+        asks = apply_deltas(asks[0], asks[1], prices[~is_bid], amounts[~is_bid])
+        return bids, asks
+
+    def book_at(self, timestamp: int) -> tuple:
+        """
+        Rebuilds the book as it was at timestamp
+        :param timestamp:
+        :return: ((bid prices, bid sizes), (ask prices, ask sizes)), prices ascending
+        """
+        index = int(np.searchsorted(self.snapshot_timestamps, timestamp, side='right')) - 1
+        if index < 0:
+            start, bids, asks = 0, (np.empty(0), np.empty(0)), (np.empty(0), np.empty(0))
+        else:
+            start, bids, asks = self.snapshots[index]
+        return self.replay(bids, asks, start, max(start, self.deltas.position(timestamp)))
+
+    def to_document(self) -> dict:
+        """
+        Converts history to orderbook field of exchange document
+        :return:
+        """
+        size = len(self.deltas)
+        return {
+            'snapshots': [{
+                'timestamp': int(timestamp),
+                'bids': np.column_stack(bids).tolist(),
+                'asks': np.column_stack(asks).tolist()
+            } for timestamp, (_, bids, asks) in zip(self.snapshot_timestamps, self.snapshots)],
+            'deltas': {
+                'timestamp': self.deltas.timestamp[:size].tolist(),
+                'side': self.deltas.side[:size].tolist(),
+                'price': self.deltas.price[:size].tolist(),
+                'size': self.deltas.amount[:size].tolist()
+            }
+        }
+
+
+def benchmark(levels: int = 1000, deltas: int = 1000000, batch: int = 1000) -> float:
+    """
+    Measures how many deltas per second OrderBook applies
+    :param levels: number of price levels per side
+    :param deltas: total number of deltas
+    :param batch: deltas applied at once
+    :return: deltas per second
+    """
+    rng = np.random.default_rng(0)
+    book = OrderBook()
+    prices = np.round(np.linspace(100, 200, levels * 2), 2)
+    book.add_snapshot(0, np.column_stack((prices[:levels], rng.random(levels))),
+                      np.column_stack((prices[levels:], rng.random(levels))))
+    timestamps = np.arange(1, deltas + 1, dtype=np.int64)
+    sides = rng.integers(0, 2, deltas).astype(np.int8)
+    delta_prices = np.where(sides == bid, rng.choice(prices[:levels], deltas), rng.choice(prices[levels:], deltas))
+    sizes = np.where(rng.random(deltas) < 0.1, 0, rng.random(deltas))
+    start = time.perf_counter()
+    for i in range(0, deltas, batch):
+        book.add_deltas(timestamps[i:i + batch], sides[i:i + batch], delta_prices[i:i + batch], sizes[i:i + batch])
+    return deltas / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    print("Applied {:.0f} deltas/s".format(benchmark()))
@@ -0,0 +1,355 @@
+import os
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+from pymongo.database import Database
+import credsmanager as m
+import metrics
+from checkpoints import CheckpointStore
+from credsmanager import data_path
+from loaders.bittrex import load_manifest, master_path
+from loaders.candles import day, hour, resample
+from loaders.ohlcv import OhlcvStore, index_name, ohlcv_path
+
+views_path = data_path + 'views/'
+resolutions = {'1h': hour, '1d': day}
+social_columns = ['posts', 'comments', 'score']
+price_columns = ['open', 'high', 'low', 'close', 'volume']
+# Posts inserted that long before the newest seen one are scanned again, so inserts
+# that were still in flight during the last refresh, with lower ObjectIds, are not missed
+id_slack = timedelta(minutes=1)
+
+refreshed_buckets = metrics.registry.counter('view_buckets_refreshed_total', 'View buckets recomputed',
+                                             ('resolution',))
+
+
+def get_assets() -> []:
+    """
+    Returns assets from config/assets.json, every one linking exchange symbols
+    and subreddits as in config/documents/asset.json
+    :return:
+    """
+    return m.get_config('assets')['assets']
+
+
+def get_view_name(asset_name: str, resolution: str) -> str:
+    return '{}_{}.npz'.format(asset_name.replace(' ', '_'), resolution)
+
+
+def empty_view() -> dict:
+    view = {'timestamp': np.empty(0, dtype=np.int64)}
+    view.update({column: np.empty(0, dtype=np.int64) for column in social_columns})
+    view.update({column: np.empty(0) for column in price_columns})
+    return view
+
+
+def merge_buckets(view: dict, updates: dict) -> dict:
+    """
+    Returns view with rows of updates replacing columns of the same buckets. Columns
+    missing from updates keep their values, new buckets get zero counts and NaN prices
+    :param view: view columns sorted by timestamp
+    :param updates: timestamp and some of the view columns, sorted by timestamp
+    :return:
+    """
+    timestamps = np.union1d(view['timestamp'], updates['timestamp'])
+    old = np.searchsorted(timestamps, view['timestamp'])
+    new = np.searchsorted(timestamps, updates['timestamp'])
+    merged = {'timestamp': timestamps}
+    for column, values in view.items():
+        if column == 'timestamp':
+            continue
+        if np.issubdtype(values.dtype, np.integer):
+            merged[column] = np.zeros(len(timestamps), dtype=values.dtype)
+        else:
+            merged[column] = np.full(len(timestamps), np.nan)
+        merged[column][old] = values
+        if column in updates:
+            merged[column][new] = updates[column]
+    return merged
+
+
+def aggregate_posts(created: np.ndarray, comments: np.ndarray, scores: np.ndarray, buckets: np.ndarray,
+                    interval: int) -> dict:
+    """
+    Counts posts, comments and score of posts created in every one of given buckets
+    :param created: created_utc of posts
+    :param comments: num_comments of posts
+    :param scores: score of posts
+    :param buckets: sorted bucket starts, buckets without posts get zeros
+    :param interval: bucket length in seconds
+    :return: social columns of buckets
+    """
+    position = np.searchsorted(buckets, created - created % interval)
+    inside = position < len(buckets)
+    inside[inside] = buckets[position[inside]] == (created - created % interval)[inside]
+    position = position[inside]
+    return {
+        'timestamp': buckets,
+        'posts': np.bincount(position, minlength=len(buckets)).astype(np.int64),
+        'comments': np.bincount(position, weights=comments[inside], minlength=len(buckets)).astype(np.int64),
+        'score': np.bincount(position, weights=scores[inside], minlength=len(buckets)).astype(np.int64)
+    }
+
+
+def to_ranges(buckets: np.ndarray, interval: int) -> []:
+    """
+    Joins sorted adjacent buckets into [start, end) ranges, so each is read with one query
+    :param buckets:
+    :param interval:
+    :return:
+    """
+    if len(buckets) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(buckets) != interval) + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(buckets)])) - 1
+    return [(int(buckets[start]), int(buckets[end]) + interval) for start, end in zip(starts, ends)]
+
+
+class AssetViewBuilder:
+    """
+    Keeps materialized views of every asset at 1h and 1d resolution: posts, comments and
+    score sums of submissions from the asset's subreddits, joined with OHLCV prices, in
+    buckets aligned on epoch multiples of the resolution. Every view is a .npz file,
+    replaced atomically on refresh.
+
+    Refresh recomputes only the buckets touched since the last run. Hourly buckets of posts
+    inserted into <sub>_history since then, found by ObjectId, are read back from Mongo
+    with one range query per run of adjacent hours; daily buckets are summed from the
+    hourly view. Later score changes of already counted posts are picked up when their
+    bucket is touched again, or with a full rebuild. Prices come from the Bittrex master
+    (1h and 1d) and the coinmarketcap OHLCV store (1d, preferred); candles are rebuilt
+    only when the asset's master part or the store changed
+    """
+
+    def __init__(self, database: Database, assets: [] = None, path: str = None,
+                 checkpoints: CheckpointStore = None, ohlcv: str = None, master: str = None):
+        self.database = database
+        self.assets = assets if assets is not None else get_assets()
+        self.path = path or views_path
+        self.checkpoints = checkpoints if checkpoints is not None else CheckpointStore()
+        self.ohlcv_path = ohlcv or ohlcv_path
+        self.master = master or master_path
+        os.makedirs(self.path, exist_ok=True)
+
+    def load_view(self, asset_name: str, resolution: str) -> dict:
+        path = self.path + get_view_name(asset_name, resolution)
+        if not os.path.isfile(path):
+            return empty_view()
+        with np.load(path) as f:
+            return {column: f[column] for column in f.files}
+
+    def save_view(self, asset_name: str, resolution: str, view: dict) -> None:
+        path = self.path + get_view_name(asset_name, resolution)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **view)
+        os.replace(path + '.tmp', path)
+
+    @metrics.traced('views.refresh_all')
+    def refresh_all(self, full: bool = False) -> None:
+        for asset in self.assets:
+            self.refresh(asset, full=full)
+
+    @metrics.traced('views.refresh')
+    def refresh(self, asset: dict, full: bool = False) -> dict:
+        """
+        Refreshes both views of asset
+        :param asset: asset from config/assets.json
+        :param full: rebuild views from scratch, rescanning all the posts and prices
+        :return: number of refreshed buckets per resolution
+        """
+        name = asset['name']
+        views = {resolution: empty_view() if full else self.load_view(name, resolution)
+                 for resolution in resolutions}
+        scope = 'views/' + name
+        marks = {}
+        hours = self.get_touched_hours(asset, full, marks)
+        refreshed = {resolution: 0 for resolution in resolutions}
+        if len(hours) > 0:
+            hourly = self.aggregate_hours(asset, hours)
+            views['1h'] = merge_buckets(views['1h'], hourly)
+            days = np.unique(hours - hours % day)
+            daily = self.sum_days(views['1h'], days)
+            views['1d'] = merge_buckets(views['1d'], daily)
+            refreshed['1h'] += len(hours)
+            refreshed['1d'] += len(days)
+        for resolution, candles in self.get_changed_prices(asset, full, marks).items():
+            views[resolution] = merge_buckets(views[resolution], candles)
+            refreshed[resolution] += len(candles['timestamp'])
+        for resolution, view in views.items():
+            if refreshed[resolution] > 0 or full:
+                self.save_view(name, resolution, view)
+            refreshed_buckets.labels(resolution).inc(refreshed[resolution])
+        # Marks are saved after the views, so a crash makes the next run redo the work instead of losing it
+        for key, value in marks.items():
+            self.checkpoints.set(scope, key, value)
+        return refreshed
+
+    def get_touched_hours(self, asset: dict, full: bool, marks: dict) -> np.ndarray:
+        """
+        Returns sorted hourly buckets with posts inserted since the last refresh
+        :param asset:
+        :param full:
+        :param marks: updated with the newest ObjectId seen in every history collection
+        :return:
+        """
+        scope = 'views/' + asset['name']
+        touched = []
+        for sub_name in asset['media']['reddit'].get('subreddits', []):
+            collection = sub_name + '_history'
+            mark = None if full else self.checkpoints.get(scope, collection)
+            query = {} if mark is None else {'_id': {'$gt': ObjectId(mark)}}
+            created = []
+            newest = None
+            for post in self.database[collection].find(query, {'_id': 1, 'created_utc': 1}):
+                created.append(post['created_utc'])
+                if newest is None or post['_id'] > newest:
+                    newest = post['_id']
+            if newest is not None:
+                marks[collection] = str(ObjectId.from_datetime(newest.generation_time - id_slack))
+            created = np.array(created, dtype=np.int64)
+            touched.append(np.unique(created - created % hour))
+        return np.unique(np.concatenate(touched)) if touched else np.empty(0, dtype=np.int64)
+
+    def aggregate_hours(self, asset: dict, hours: np.ndarray) -> dict:
+        """
+        Recomputes social columns of hourly buckets from all the posts of asset's subs
+        :param asset:
+        :param hours: sorted bucket starts
+        :return:
+        """
+        created, comments, scores = [], [], []
+        for sub_name in asset['media']['reddit'].get('subreddits', []):
+            collection = self.database[sub_name + '_history']
+            for start, end in to_ranges(hours, hour):
+                for post in collection.find({'created_utc': {'$gte': start, '$lt': end}},
+                                            {'_id': 0, 'created_utc': 1, 'num_comments': 1, 'score': 1}):
+                    created.append(post['created_utc'])
+                    comments.append(post.get('num_comments', 0))
+                    scores.append(post.get('score', 0))
+        return aggregate_posts(np.array(created, dtype=np.int64), np.array(comments, dtype=np.int64),
+                               np.array(scores, dtype=np.int64), hours, hour)
+
+    @staticmethod
+    def sum_days(hourly: dict, days: np.ndarray) -> dict:
+        """
+        Sums social columns of hourly view into given daily buckets
+        :param hourly: hourly view
+        :param days: sorted day starts
+        :return:
+        """
+        daily = {'timestamp': days}
+        position = np.searchsorted(days, hourly['timestamp'] - hourly['timestamp'] % day)
+        inside = position < len(days)
+        inside[inside] = days[position[inside]] == (hourly['timestamp'] - hourly['timestamp'] % day)[inside]
+        for column in social_columns:
+            daily[column] = np.bincount(position[inside], weights=hourly[column][inside],
+                                        minlength=len(days)).astype(np.int64)
+        return daily
+
+    def get_changed_prices(self, asset: dict, full: bool, marks: dict) -> dict:
+        """
+        Returns price columns of both resolutions if any price source of asset changed since
+        the last refresh. Hourly prices come from Bittrex, daily ones from coinmarketcap,
+        falling back to Bittrex candles on days missing from the store
+        :param asset:
+        :param full:
+        :param marks: updated with versions of the price sources
+        :return: dict of resolution to price columns
+        """
+        scope = 'views/' + asset['name']
+        exchanges = asset.get('exchanges', {})
+        versions = {}
+        symbol = exchanges.get('bittrex', {}).get('symbol')
+        part = self.get_bittrex_part(symbol) if symbol is not None else None
+        if part is not None:
+            versions['bittrex'] = part['sha256']
+        daily_symbol = exchanges.get('coinmarketcap', {}).get('symbol')
+        if daily_symbol is not None and os.path.isfile(self.ohlcv_path + index_name):
+            versions['coinmarketcap'] = os.stat(self.ohlcv_path + index_name).st_mtime
+        if not full and all(self.checkpoints.get(scope, source) == version for source, version in versions.items()):
+            return {}
+        marks.update(versions)
+        changed = {}
+        if part is not None:
+            df = pd.read_parquet(self.master + part['part'])
+            df = df[df['symbol'] == symbol]
+            columns = [df[column].to_numpy(dtype=np.float64) for column in ['open', 'high', 'low', 'close',
+                                                                            'volume_self']]
+            markets = np.zeros(len(df), dtype=np.int64)
+            timestamps = df['date'].to_numpy(dtype=np.int64)
+            for resolution, interval in resolutions.items():
+                changed[resolution] = resample(markets, timestamps, *columns, interval)
+                del changed[resolution]['market']
+        if 'coinmarketcap' in versions:
+            rows = OhlcvStore(self.ohlcv_path).query(daily_symbol)
+            daily = {'timestamp': rows['date'] - rows['date'] % day}
+            for column in price_columns:
+                daily[column] = rows[column].astype(np.float64)
+            changed['1d'] = merge_buckets(changed['1d'], daily) if '1d' in changed else daily
+        return changed
+
+    def get_bittrex_part(self, symbol: str) -> dict:
+        """
+        Returns manifest entry of the master part holding market of symbol
+        :param symbol:
+        :return:
+        """
+        for filename, entry in load_manifest(self.master).items():
+            # Market files are named like Bittrex_XRPBTC_1h.csv
+            if '_{}_'.format(symbol) in filename:
+                return entry
+        return None
+
+
+class AssetViews:
+    """
+    Read side of the materialized views. Views are loaded once and kept in memory until
+    their file changes, so queries are a binary search and zero copy slices
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or views_path
+        self.views = {}
+
+    def get_view(self, asset_name: str, resolution: str) -> dict:
+        path = self.path + get_view_name(asset_name, resolution)
+        if not os.path.isfile(path):
+            return empty_view()
+        version = os.stat(path).st_mtime_ns
+        cached = self.views.get(path)
+        if cached is None or cached[0] != version:
+            with np.load(path) as f:
+                cached = (version, {column: f[column] for column in f.files})
+            self.views[path] = cached
+        return cached[1]
+
+    def query(self, asset_name: str, resolution: str = '1h', start: int = None, end: int = None) -> dict:
+        """
+        Returns buckets of asset view with timestamp in [start, end)
+        :param asset_name:
+        :param resolution: 1h or 1d
+        :param start: epoch seconds, inclusive
+        :param end: epoch seconds, exclusive
+        :return: dict of column name to numpy array
+        """
+        if resolution not in resolutions:
+            raise ValueError('Unknown resolution {}, expected one of {}'.format(resolution, list(resolutions)))
+        view = self.get_view(asset_name, resolution)
+        lo = 0 if start is None else int(np.searchsorted(view['timestamp'], start, side='left'))
+        hi = len(view['timestamp']) if end is None else int(np.searchsorted(view['timestamp'], end, side='left'))
+        return {column: values[lo:hi] for column, values in view.items()}
+
+    def frame(self, asset_name: str, resolution: str = '1h', start: int = None, end: int = None) -> pd.DataFrame:
+        """
+        Returns buckets of asset view as a frame indexed by UTC bucket start
+        :param asset_name:
+        :param resolution:
+        :param start:
+        :param end:
+        :return:
+        """
+        columns = self.query(asset_name, resolution, start, end)
+        index = pd.to_datetime(columns.pop('timestamp'), unit='s', utc=True)
+        return pd.DataFrame(columns, index=index)
@@ -0,0 +1,391 @@
+import atexit
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of latency histogram buckets
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Metric:
+    """
+    Base of all the metrics. A metric with label names only holds children,
+    one per tuple of label values, created on the first use by labels().
+    Every update returns immediately while the registry is disabled
+    """
+
+    kind = None
+
+    def __init__(self, registry: 'Registry', name: str, help: str, labels: tuple = ()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def new_child(self) -> 'Metric':
+        return type(self)(self.registry, self.name, self.help)
+
+    def labels(self, *values) -> 'Metric':
+        """
+        Returns child of the metric for given label values. Hot paths with fixed
+        label values should keep the child instead of looking it up every time
+        :param values: values of label names, in order
+        :return:
+        """
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def samples(self) -> []:
+        """
+        Returns (suffix, labels, value) of every sample of the metric and its children
+        :return:
+        """
+        if not self.label_names:
+            return self.own_samples({})
+        samples = []
+        for values, child in list(self.children.items()):
+            samples.extend(child.own_samples(dict(zip(self.label_names, values))))
+        return samples
+
+    def own_samples(self, labels: dict) -> []:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.value += amount
+
+    def own_samples(self, labels: dict) -> []:
+        return [('', labels, self.value)]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        if not self.registry.enabled:
+            return
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+    def own_samples(self, labels: dict) -> []:
+        return [('', labels, self.value)]
+
+
+class Timer:
+    def __init__(self, histogram: 'Histogram'):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        return None
+
+
+null_timer = NullTimer()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: tuple = latency_buckets, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def new_child(self) -> 'Histogram':
+        return Histogram(self.registry, self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value: float) -> None:
+        if not self.registry.enabled:
+            return
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """
+        Returns context manager observing how long its block took
+        :return:
+        """
+        if not self.registry.enabled:
+            return null_timer
+        return Timer(self)
+
+    def own_samples(self, labels: dict) -> []:
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            samples.append(('_bucket', dict(labels, le=format_value(bound)), cumulative))
+        samples.append(('_sum', labels, total))
+        samples.append(('_count', labels, count))
+        return samples
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels.items()]
+    return '{' + ','.join(escaped) + '}'
+
+
+class Registry:
+    """
+    Collection of named metrics. Metrics are created once, usually at module level,
+    and may be updated from any thread. The registry starts disabled, so instrumented
+    code only pays for one attribute check per update until enable is called
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get_metric(self, cls: type, name: str, help: str, labels: tuple, **kwargs) -> Metric:
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(self, name, help, labels, **kwargs)
+            metric = self.metrics[name]
+        if not isinstance(metric, cls):
+            raise ValueError('Metric {} is already registered as {}'.format(name, metric.kind))
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.get_metric(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: tuple = ()) -> Gauge:
+        return self.get_metric(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = latency_buckets) -> Histogram:
+        return self.get_metric(Histogram, name, help, labels, buckets=buckets)
+
+    def to_prometheus(self) -> str:
+        """
+        Returns all the metrics in Prometheus text exposition format
+        :return:
+        """
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP {} {}'.format(name, metric.help))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                lines.append('{}{}{} {}'.format(name, suffix, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self) -> dict:
+        """
+        Returns snapshot of all the metrics, keyed by metric name
+        :return:
+        """
+        snapshot = {}
+        for name, metric in sorted(self.metrics.items()):
+            snapshot[name] = {
+                'type': metric.kind,
+                'samples': [{'name': name + suffix, 'labels': labels, 'value': value}
+                            for suffix, labels, value in metric.samples()]
+            }
+        return snapshot
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram('stage_seconds', 'Duration of pipeline stages', ('stage',))
+stage_active = registry.gauge('stage_active', 'Number of pipeline stages running now', ('stage',))
+
+
+class Span:
+    """
+    Context manager tracing one run of a pipeline stage, e.g. scrapping of one sub.
+    Running spans are counted in stage_active, finished ones observed in stage_seconds
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        stage_active.labels(self.stage).inc()
+        return self
+
+    def __exit__(self, *args) -> None:
+        stage_active.labels(self.stage).dec()
+        stage_seconds.labels(self.stage).observe(time.perf_counter() - self.start)
+
+
+def span(stage: str):
+    """
+    Returns span of given stage, or a no-op context manager when metrics are disabled
+    :param stage:
+    :return:
+    """
+    if not registry.enabled:
+        return null_timer
+    return Span(stage)
+
+
+def traced(stage: str):
+    """
+    Decorator running every call of the function in a span of given stage
+    :param stage:
+    :return:
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def enable() -> None:
+    registry.enabled = True
+
+
+def disable() -> None:
+    registry.enabled = False
+
+
+def serve(port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """
+    Serves metrics in Prometheus text format on http://host:port/metrics from a daemon thread
+    :param port:
+    :param host:
+    :return: running server, call shutdown to stop it
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class SnapshotWriter:
+    """
+    Periodically writes json snapshot of all the metrics to path, replacing it atomically
+    """
+
+    def __init__(self, path: str, interval: float = 10.0):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self) -> None:
+        snapshot = {'timestamp': time.time(), 'metrics': registry.to_dict()}
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError:
+            logging.exception('Failed to write metrics snapshot to {}'.format(self.path))
+
+    def close(self) -> None:
+        """
+        Stops the writer and writes the final snapshot
+        :return:
+        """
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+
+def configure(config: dict) -> None:
+    """
+    Enables metrics and starts exporters specified by metrics config, e.g.
+    {"enabled": true, "port": 9100, "snapshotPath": "metrics.json", "snapshotInterval": 10}
+    :param config: metrics section of a config file
+    :return:
+    """
+    if not config or not config.get('enabled', False):
+        return
+    enable()
+    if config.get('port') is not None:
+        serve(config['port'])
+    if config.get('snapshotPath') is not None:
+        writer = SnapshotWriter(config['snapshotPath'], config.get('snapshotInterval', 10.0))
+        atexit.register(writer.close)
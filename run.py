@@ -1,8 +1,5 @@
-from scrappers.reddit import RedditScrapper
+import sys
+from cli import main
 
-
-scrapper = RedditScrapper()
-scrapper.connect()
-scrapper.create_dirs()
-scrapper.create_sub_files()
-scrapper.start(silent=False)
+# Kept for existing cron jobs, same as: python cli.py live
+sys.exit(main(['live'] + sys.argv[1:]))
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Callable, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from credsmanager import data_path
+
+cache_path = data_path + 'http_cache/'
+
+
+class CacheMiss(LookupError):
+    """
+    Raised in replay mode for queries that are not cached
+    """
+
+
+def normalize_url(url: str) -> str:
+    """
+    Returns canonical form of url, with lowercase scheme and host and sorted query parameters
+    :param url:
+    :return:
+    """
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+
+
+class ResponseCache:
+    """
+    Content addressed on-disk cache of API responses. Bodies are stored zlib compressed
+    under the sha256 of the normalized query url, an SQLite index keeps their size, last
+    access and expiry time. When the cache grows over max_bytes, least recently used
+    entries are evicted.
+
+    Pages of data older than settle seconds never change, so they never expire. Only
+    pages reaching the recent edge of time get recent_ttl, and responses without
+    timestamps get untimed_ttl. In replay mode nothing is fetched, expired entries are
+    still served and missing ones raise CacheMiss
+    """
+
+    def __init__(self, path: str = cache_path, max_bytes: int = 10 * 1024 ** 3, recent_ttl: float = 3600,
+                 untimed_ttl: float = 7 * 86400, settle: float = 86400, replay: bool = False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.recent_ttl = recent_ttl
+        self.untimed_ttl = untimed_ttl
+        self.settle = settle
+        self.replay = replay
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.connection = sqlite3.connect(path + 'index.db', timeout=30, check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS entries ('
+                                'key TEXT PRIMARY KEY, '
+                                'size INTEGER NOT NULL, '
+                                'accessed REAL NOT NULL, '
+                                'expires REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self.total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def get_file(self, key: str) -> str:
+        return self.path + key[:2] + '/' + key + '.z'
+
+    def get_json(self, url: str, fetch: Callable[[str], bytes]) -> Any:
+        """
+        Returns parsed response for url, from the cache or fetched and cached
+        :param url:
+        :param fetch: function returning response body of url
+        :return:
+        """
+        key = hashlib.sha256(normalize_url(url).encode()).hexdigest()
+        body = self.load(key)
+        if body is not None:
+            return json.loads(body.decode())
+        if self.replay:
+            raise CacheMiss(url)
+        body = fetch(url)
+        response = json.loads(body.decode())
+        self.store(key, body, self.get_expiry(url, response))
+        return response
+
+    def load(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT expires FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None or (not self.replay and row[0] is not None and row[0] < now):
+                return None
+            try:
+                with open(self.get_file(key), 'rb') as f:
+                    body = f.read()
+            except FileNotFoundError:
+                return None
+            self.connection.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+        return zlib.decompress(body)
+
+    def store(self, key: str, body: bytes, expires: Optional[float]) -> None:
+        compressed = zlib.compress(body)
+        path = self.get_file(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(compressed)
+        os.replace(path + '.tmp', path)
+        with self.lock:
+            row = self.connection.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            self.total += len(compressed) - (row[0] if row is not None else 0)
+            self.connection.execute('INSERT OR REPLACE INTO entries (key, size, accessed, expires) '
+                                    'VALUES (?, ?, ?, ?)', (key, len(compressed), time.time(), expires))
+            if self.total > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes least recently used entries until the cache is below 90% of max_bytes.
+        Has to be called with lock held
+        :return:
+        """
+        target = self.max_bytes * 0.9
+        rows = self.connection.execute('SELECT key, size FROM entries ORDER BY accessed')
+        evicted = []
+        for key, size in rows:
+            if self.total <= target:
+                break
+            evicted.append((key,))
+            self.total -= size
+        self.connection.executemany('DELETE FROM entries WHERE key = ?', evicted)
+        for key, in evicted:
+            try:
+                os.remove(self.get_file(key))
+            except FileNotFoundError:
+                pass
+
+    def get_expiry(self, url: str, response: Any) -> Optional[float]:
+        """
+        Returns expiry time of response, None if it never expires
+        :param url:
+        :param response: parsed response
+        :return:
+        """
+        now = time.time()
+        params = dict(parse_qsl(urlsplit(url).query))
+        data = response.get('data', []) if isinstance(response, dict) else []
+        timestamps = [item['created_utc'] for item in data if isinstance(item, dict) and 'created_utc' in item]
+        if 'before' in params:
+            newest = int(params['before'])
+        elif 'after' in params and 'limit' in params and len(data) < int(params['limit']):
+            # Page that is not full reached the newest data
+            newest = now
+        elif len(timestamps) == 0:
+            return now + self.untimed_ttl
+        else:
+            newest = max(timestamps)
+        return None if newest < now - self.settle else now + self.recent_ttl
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
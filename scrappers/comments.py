@@ -0,0 +1,194 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+
+import metrics
+
+comment_ids_template = "https://api.pushshift.io/reddit/submission/comment_ids/{}"
+comments_template = "https://api.pushshift.io/reddit/comment/search?ids={}"
+
+# Posts with fewer comments than this are marked as scrapped without fetching
+min_comments = 6
+
+_done = object()
+
+# Where hydrated comments are stored: embedded in their posts or in a <sub>_comments collection
+comments_storages = ['embedded', 'collection']
+
+hydrated_posts = metrics.registry.counter('hydrated_posts_total', 'Posts hydrated with comments')
+failed_posts = metrics.registry.counter('hydration_failures_total', 'Posts whose comment requests failed')
+fetched_comments = metrics.registry.counter('comments_fetched_total', 'Comments fetched from pushshift')
+queue_depth = metrics.registry.gauge('hydrator_queue_depth', 'Items waiting in hydrator stage queues', ('queue',))
+
+
+def ensure_comment_indexes(collection: Collection) -> None:
+    """
+    Creates indexes of a comments collection: unique comment id, so inserts are idempotent,
+    and (link_id, created_utc) for reading comments of a post in order
+    :param collection:
+    :return:
+    """
+    collection.create_index('id', unique=True)
+    collection.create_index([('link_id', ASCENDING), ('created_utc', ASCENDING)])
+
+
+class CommentHydrator:
+    """
+    Staged producer/consumer pipeline that hydrates posts with their comments:
+        1. posts are streamed from the given iterable
+        2. comment ids of each post are fetched concurrently
+        3. ids from many posts are packed into full comment search requests
+        4. fetched comments are routed back to their parent posts
+    Hydrated posts are yielded as (post_id, comments) tuples, so the caller
+    can write them in bulk
+    """
+
+    def __init__(self, make_request: Callable[[str], Any], workers: int = 4,
+                 batch_size: int = 1000, queue_size: int = 1000):
+        self.make_request = make_request
+        self.workers = workers
+        self.batch_size = batch_size
+        self.posts = queue.Queue(maxsize=queue_size)
+        self.ids = queue.Queue(maxsize=queue_size)
+        self.results = queue.Queue(maxsize=queue_size)
+        self.pending = {}
+        self.lock = threading.Lock()
+        # Bounds the number of comment batches waiting for or in flight
+        self.batch_slots = threading.BoundedSemaphore(workers * 2)
+        self.failed = 0
+        self.error = None
+
+    def hydrate(self, posts: Iterable[dict]) -> Iterator[tuple]:
+        """
+        Runs the pipeline over posts and yields (post_id, comments) for every post
+        that was hydrated. Posts whose requests failed are skipped and counted in failed.
+        When reading posts fails, posts read before are still hydrated, then the
+        error is raised, so the caller does not take the partial run as finished
+        :param posts: iterable of post documents with id and num_comments fields
+        :return: generator of (post_id, comments) tuples
+        """
+        id_workers = [threading.Thread(target=self.fetch_ids, daemon=True) for _ in range(self.workers)]
+        stages = [threading.Thread(target=self.produce, args=(posts,), daemon=True),
+                  threading.Thread(target=self.pack, args=(id_workers,), daemon=True)] + id_workers
+        for stage in stages:
+            stage.start()
+        while True:
+            result = self.results.get()
+            if result is _done:
+                break
+            yield result
+        for stage in stages:
+            stage.join()
+        if self.error is not None:
+            raise self.error
+
+    def produce(self, posts: Iterable[dict]) -> None:
+        try:
+            for post in posts:
+                if post['num_comments'] < min_comments:
+                    hydrated_posts.inc()
+                    self.results.put((post['id'], []))
+                else:
+                    self.posts.put(post['id'])
+        except Exception as e:
+            logging.exception('Failed to stream posts')
+            self.error = e
+        finally:
+            for _ in range(self.workers):
+                self.posts.put(_done)
+
+    def fetch_ids(self) -> None:
+        while True:
+            post_id = self.posts.get()
+            if post_id is _done:
+                self.ids.put(_done)
+                return
+            try:
+                ids = self.make_request(comment_ids_template.format(post_id))['data']
+            except Exception:
+                logging.exception('Failed to get comment ids of post {}'.format(post_id))
+                with self.lock:
+                    self.failed += 1
+                failed_posts.inc()
+                continue
+            if len(ids) == 0:
+                hydrated_posts.inc()
+                self.results.put((post_id, []))
+            else:
+                self.ids.put((post_id, ids))
+
+    def pack(self, id_workers: []) -> None:
+        finished_workers = 0
+        batch = []
+        batch_posts = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while finished_workers < len(id_workers):
+                item = self.ids.get()
+                if item is _done:
+                    finished_workers += 1
+                    continue
+                post_id, ids = item
+                # The extra reference keeps the post pending until all of its ids are packed,
+                # then every batch holding some of its ids keeps one reference
+                with self.lock:
+                    self.pending[post_id] = {'outstanding': 1, 'comments': [], 'failed': False}
+                for comment_id in ids:
+                    batch.append(comment_id)
+                    if post_id not in batch_posts:
+                        batch_posts.add(post_id)
+                        with self.lock:
+                            self.pending[post_id]['outstanding'] += 1
+                    if len(batch) == self.batch_size:
+                        self.submit_batch(executor, batch, batch_posts)
+                        batch = []
+                        batch_posts = set()
+                self.release(post_id)
+            if len(batch) > 0:
+                self.submit_batch(executor, batch, batch_posts)
+        self.results.put(_done)
+
+    def submit_batch(self, executor: ThreadPoolExecutor, batch: [], batch_posts: set) -> None:
+        self.batch_slots.acquire()
+        executor.submit(self.fetch_batch, batch, batch_posts)
+
+    def fetch_batch(self, batch: [], batch_posts: set) -> None:
+        try:
+            comments = self.make_request(comments_template.format(','.join(batch)))['data']
+        except Exception:
+            logging.exception('Failed to get batch of {} comments'.format(len(batch)))
+            with self.lock:
+                for post_id in batch_posts:
+                    self.pending[post_id]['failed'] = True
+            comments = []
+        finally:
+            self.batch_slots.release()
+        fetched_comments.inc(len(comments))
+        if metrics.registry.enabled:
+            queue_depth.labels('posts').set(self.posts.qsize())
+            queue_depth.labels('ids').set(self.ids.qsize())
+            queue_depth.labels('results').set(self.results.qsize())
+        with self.lock:
+            for comment in comments:
+                post = self.pending.get(comment['link_id'][3:])
+                if post is not None:
+                    post['comments'].append(comment)
+        for post_id in batch_posts:
+            self.release(post_id)
+
+    def release(self, post_id: str) -> None:
+        with self.lock:
+            post = self.pending[post_id]
+            post['outstanding'] -= 1
+            if post['outstanding'] > 0:
+                return
+            del self.pending[post_id]
+            if post['failed']:
+                self.failed += 1
+                failed_posts.inc()
+                return
+        hydrated_posts.inc()
+        self.results.put((post_id, post['comments']))
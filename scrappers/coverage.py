@@ -0,0 +1,108 @@
+import threading
+from bisect import bisect_left, bisect_right
+import numpy as np
+from pymongo.collection import Collection
+
+
+class CoverageIndex:
+    """
+    Sorted, merged [from, to] intervals of created_utc seconds that were already scrapped,
+    plus periods that are being scrapped right now. Touching intervals are merged, so
+    the gaps returned by missing are exactly the periods that still have to be fetched
+    """
+
+    def __init__(self, intervals: [] = None, ongoing: [] = None):
+        self.intervals = [list(interval) for interval in intervals or []]
+        self.ongoing = [list(interval) for interval in ongoing or []]
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_timestamps(cls, timestamps: np.ndarray, max_gap: int) -> 'CoverageIndex':
+        """
+        Builds index from created_utc of stored submissions. Consecutive submissions less
+        than max_gap seconds apart are assumed to be covered by the same scrapping run
+        :param timestamps: created_utc values, in any order
+        :param max_gap: longest period without submissions that is not treated as a gap
+        :return:
+        """
+        timestamps = np.sort(np.asarray(timestamps, dtype=np.int64))
+        if len(timestamps) == 0:
+            return cls()
+        breaks = np.flatnonzero(np.diff(timestamps) > max_gap)
+        starts = timestamps[np.concatenate(([0], breaks + 1))]
+        ends = timestamps[np.concatenate((breaks, [len(timestamps) - 1]))]
+        return cls(np.column_stack((starts, ends)).tolist())
+
+    @classmethod
+    def from_collection(cls, collection: Collection, max_gap: int) -> 'CoverageIndex':
+        cursor = collection.find({}, {'_id': 0, 'created_utc': 1}, batch_size=100000)
+        timestamps = np.fromiter((int(post['created_utc']) for post in cursor), dtype=np.int64)
+        return cls.from_timestamps(timestamps, max_gap)
+
+    def add(self, start: int, end: int) -> None:
+        """
+        Marks [start, end] as scrapped, merging it with overlapping and adjacent intervals
+        :param start:
+        :param end:
+        :return:
+        """
+        if end < start:
+            return
+        with self.lock:
+            starts = [interval[0] for interval in self.intervals]
+            ends = [interval[1] for interval in self.intervals]
+            lo = bisect_left(ends, start - 1)
+            hi = bisect_right(starts, end + 1)
+            if lo < hi:
+                start = min(start, self.intervals[lo][0])
+                end = max(end, self.intervals[hi - 1][1])
+            self.intervals[lo:hi] = [[start, end]]
+
+    def missing(self, start: int, end: int) -> []:
+        """
+        Returns periods in [start, end] that are not covered
+        :param start:
+        :param end:
+        :return: list of [from, to] gaps
+        """
+        gaps = []
+        with self.lock:
+            for interval_start, interval_end in self.intervals:
+                if interval_end < start:
+                    continue
+                if interval_start > end:
+                    break
+                if interval_start > start:
+                    gaps.append([start, interval_start - 1])
+                start = max(start, interval_end + 1)
+        if start <= end:
+            gaps.append([start, end])
+        return gaps
+
+    def begin(self, start: int, end: int) -> None:
+        with self.lock:
+            self.ongoing.append([start, end])
+
+    def finish(self, start: int, end: int) -> None:
+        with self.lock:
+            if [start, end] in self.ongoing:
+                self.ongoing.remove([start, end])
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {'intervals': [list(i) for i in self.intervals], 'ongoing': [list(i) for i in self.ongoing]}
+
+    def to_document(self, start: int, end: int) -> dict:
+        """
+        Converts index to media document periods for [start, end]
+        :param start:
+        :param end:
+        :return:
+        """
+        with self.lock:
+            ongoing = [{'dateFrom': date_from, 'dateTo': date_to} for date_from, date_to in self.ongoing]
+        return {
+            'missingDataPeriods': [{'dateFrom': date_from, 'dateTo': date_to}
+                                   for date_from, date_to in self.missing(start, end)],
+            'scrappingOngoingPeriods': ongoing
+        }
@@ -0,0 +1,249 @@
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from scrappers.reddit import RedditScrapper
+
+polls_total = metrics.registry.counter('daemon_polls_total', 'Polls of new submissions listings', ('sub',))
+poll_interval = metrics.registry.gauge('daemon_poll_interval_seconds', 'Current poll interval of a sub', ('sub',))
+snapshots_total = metrics.registry.counter('daemon_snapshots_total', 'Snapshots of hot listings', ('sub',))
+post_delay = metrics.registry.histogram('daemon_post_delay_seconds',
+                                        'Time from creation of a submission until it was scrapped',
+                                        buckets=(10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200))
+
+poll = 'poll'
+snapshot = 'snapshot'
+
+
+class SubSchedule:
+    """
+    Poll interval of a single sub, derived from its observed rate of new submissions.
+    The rate is an exponentially weighted average over polls, the interval is chosen so
+    that about target_posts new submissions are waiting at every poll
+    """
+
+    def __init__(self, name: str, min_interval: float, max_interval: float, target_posts: int,
+                 smoothing: float = 0.3):
+        self.name = name
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_posts = target_posts
+        self.smoothing = smoothing
+        self.rate = None
+        self.interval = min_interval
+        self.last_poll = None
+        self.retry = {}
+
+    def observe(self, count: int, now: float, created_times: []) -> float:
+        """
+        Updates the rate with submissions found by a poll and returns the next interval
+        :param count: number of new submissions
+        :param now: unix time of the poll
+        :param created_times: created_utc of the new submissions, the first poll
+        has no previous one, so the window is measured from the oldest of them
+        :return: seconds until the next poll
+        """
+        if self.last_poll is not None:
+            window = now - self.last_poll
+        elif len(created_times) > 0:
+            window = now - min(created_times)
+        else:
+            window = 0
+        self.last_poll = now
+        if window > 0:
+            rate = count / window
+            self.rate = rate if self.rate is None else self.smoothing * rate + (1 - self.smoothing) * self.rate
+        if not self.rate:
+            self.interval = self.max_interval
+        else:
+            self.interval = min(self.max_interval, max(self.min_interval, self.target_posts / self.rate))
+        return self.interval
+
+
+class ScrapperDaemon:
+    """
+    Scraps subs continuously. Every sub is polled on its own interval: its new listing
+    is read until seen_streak submissions in a row are already in the seen index, and only
+    the unseen ones are scrapped. Busy subs are polled more often than quiet ones, see SubSchedule.
+    Scores of hot listings are snapshotted separately, every snapshot_interval seconds,
+    with a single listing request per sub and no comments.
+    Polls and snapshots run in a pool of workers, sharing the rate budget of the scrapper
+    """
+
+    def __init__(self, scrapper: RedditScrapper, workers: int = 4, min_interval: float = 30,
+                 max_interval: float = 1800, target_posts: int = 20, snapshot_interval: float = 3600,
+                 hot_limit: int = 100, new_limit: int = 1000, seen_streak: int = 10, max_retries: int = 3):
+        self.scrapper = scrapper
+        self.workers = workers
+        self.snapshot_interval = snapshot_interval
+        self.hot_limit = hot_limit
+        self.new_limit = new_limit
+        self.seen_streak = seen_streak
+        self.max_retries = max_retries
+        self.schedules = {sub['name']: SubSchedule(sub['name'], min_interval, max_interval, target_posts)
+                          for sub in scrapper.config['subreddits']}
+        self.tasks = []
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    @classmethod
+    def from_config(cls, scrapper: RedditScrapper, workers: int = 4) -> 'ScrapperDaemon':
+        """
+        Creates daemon with settings from the daemon section of reddit config, e.g.
+        {"minInterval": 30, "maxInterval": 1800, "targetPosts": 20, "snapshotInterval": 3600}
+        :param scrapper:
+        :param workers:
+        :return:
+        """
+        config = scrapper.config.get('daemon', {})
+        return cls(scrapper, workers=workers,
+                   min_interval=config.get('minInterval', 30),
+                   max_interval=config.get('maxInterval', 1800),
+                   target_posts=config.get('targetPosts', 20),
+                   snapshot_interval=config.get('snapshotInterval', 3600),
+                   hot_limit=config.get('hotLimit', 100),
+                   new_limit=config.get('newLimit', 1000),
+                   seen_streak=config.get('seenStreak', 10))
+
+    def schedule(self, delay: float, task: str, sub_name: str) -> None:
+        with self.lock:
+            heapq.heappush(self.tasks, (time.monotonic() + delay, self.sequence, task, sub_name))
+            self.sequence += 1
+
+    def next_task(self):
+        """
+        Waits until the earliest task is due and pops it
+        :return: (task, sub_name), or None when the daemon was stopped
+        """
+        while not self.stopped.is_set():
+            with self.lock:
+                timeout = self.tasks[0][0] - time.monotonic() if self.tasks else 1.0
+                if timeout <= 0:
+                    _, _, task, sub_name = heapq.heappop(self.tasks)
+                    return task, sub_name
+            # Waits are short so stop, e.g. from a signal handler, is noticed quickly
+            self.stopped.wait(min(timeout, 1.0))
+        return None
+
+    def run(self) -> None:
+        """
+        Runs polls and snapshots of all the subs until stop is called
+        :return:
+        """
+        for sub_name in self.schedules:
+            self.schedule(0, poll, sub_name)
+            self.schedule(0, snapshot, sub_name)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                item = self.next_task()
+                if item is None:
+                    break
+                pool.submit(self.run_task, *item)
+        if not self.scrapper.silent:
+            print("Daemon stopped")
+
+    def stop(self) -> None:
+        """
+        Stops scheduling, tasks that are running are finished
+        :return:
+        """
+        self.stopped.set()
+
+    def run_task(self, task: str, sub_name: str) -> None:
+        try:
+            if task == poll:
+                delay = self.poll(sub_name)
+            else:
+                delay = self.snapshot(sub_name)
+        except Exception:
+            logging.exception('Failed to {} sub {}'.format(task, sub_name))
+            delay = self.schedules[sub_name].interval if task == poll else self.snapshot_interval
+        if not self.stopped.is_set():
+            self.schedule(delay, task, sub_name)
+
+    def get_new_submissions(self, sub_name: str) -> ([], bool):
+        """
+        Reads new listing of sub until seen_streak already seen submissions in a row
+        :param sub_name:
+        :return: unseen submissions, oldest first, and whether the listing ended at new_limit
+        before the seen ones were reached, so older unseen submissions could be missed
+        """
+        blacklist = self.scrapper.load_blacklist(sub_name)
+        submissions = []
+        streak = 0
+        read = 0
+        for submission in self.scrapper.reddit.subreddit(sub_name).new(limit=self.new_limit):
+            read += 1
+            if submission.id in blacklist:
+                streak += 1
+                if streak == self.seen_streak:
+                    return submissions[::-1], False
+            else:
+                streak = 0
+                submissions.append(submission)
+        return submissions[::-1], read == self.new_limit and streak == 0
+
+    def poll(self, sub_name: str) -> float:
+        """
+        Scraps submissions of sub that were not seen yet, and ones that failed in previous polls
+        :param sub_name:
+        :return: seconds until the next poll
+        """
+        schedule = self.schedules[sub_name]
+        with metrics.span('daemon.poll'):
+            now = time.time()
+            submissions, overflowed = self.get_new_submissions(sub_name)
+            retried = [self.scrapper.reddit.submission(submission_id) for submission_id in schedule.retry
+                       if all(submission.id != submission_id for submission in submissions)]
+            rows = []
+            for submission in retried + submissions:
+                row = self.scrapper.scrap_submission(sub_name, submission)
+                if row is None:
+                    attempts = schedule.retry.get(submission.id, 0) + 1
+                    if attempts < self.max_retries:
+                        schedule.retry[submission.id] = attempts
+                    else:
+                        schedule.retry.pop(submission.id, None)
+                    continue
+                schedule.retry.pop(row['id'], None)
+                post_delay.observe(now - row['created_utc'])
+                rows.append(row)
+            with self.scrapper.sub_locks[sub_name]:
+                self.scrapper.update_submissions(sub_name, rows)
+                self.scrapper.update_blacklist(sub_name, [row['id'] for row in rows])
+        first_poll = schedule.last_poll is None
+        delay = schedule.observe(len(submissions), now, [submission.created_utc for submission in submissions])
+        if not first_poll and overflowed:
+            # More submissions arrived since the last poll than the listing returns
+            delay = schedule.interval = schedule.min_interval
+        polls_total.labels(sub_name).inc()
+        poll_interval.labels(sub_name).set(delay)
+        if not self.scrapper.silent:
+            print("Polled /r/{}: {} new submissions, next poll in {:.0f}s".format(sub_name, len(rows), delay))
+        return delay
+
+    def snapshot(self, sub_name: str) -> float:
+        """
+        Saves current rank, score and number of comments of submissions on hot listing of sub
+        :param sub_name:
+        :return: seconds until the next snapshot
+        """
+        with metrics.span('daemon.snapshot'):
+            timestamp = int(time.time())
+            rows = [{
+                'timestamp': timestamp,
+                'rank': rank,
+                'id': submission.id,
+                'score': submission.score,
+                'upvote_ratio': submission.upvote_ratio,
+                'num_comments': submission.num_comments
+            } for rank, submission in enumerate(self.scrapper.reddit.subreddit(sub_name).hot(limit=self.hot_limit),
+                                                start=1)]
+            with self.scrapper.sub_locks[sub_name]:
+                self.scrapper.storage.write_snapshot(sub_name, rows)
+        snapshots_total.labels(sub_name).inc()
+        return self.snapshot_interval
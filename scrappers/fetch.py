@@ -0,0 +1,200 @@
+import http.client
+import json
+import gzip
+import threading
+import time
+from collections import defaultdict
+from typing import Any
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+import metrics
+
+user_agent = "hesoyam/0.1"
+
+request_seconds = metrics.registry.histogram('http_request_seconds', 'Latency of HTTP requests', ('host',))
+wait_seconds = metrics.registry.histogram('rate_limit_wait_seconds', 'Time spent waiting for rate limits',
+                                          ('limiter',))
+token_bucket_wait = wait_seconds.labels('token_bucket')
+responses = metrics.registry.counter('http_responses_total', 'HTTP responses by status', ('host', 'status'))
+request_errors = metrics.registry.counter('http_errors_total', 'HTTP requests that failed without response',
+                                          ('host',))
+received_bytes = metrics.registry.counter('http_received_bytes_total', 'Bytes of HTTP responses received',
+                                          ('host',))
+sent_bytes = metrics.registry.counter('http_sent_bytes_total', 'Bytes of HTTP requests sent', ('host',))
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket rate limiter. Allows bursts of up to capacity
+    requests and refills at rate tokens per second
+    """
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Blocks until a token is available and takes it
+        :return:
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ConnectionPool:
+    """
+    Keeps idle keep-alive connections per host, so consecutive requests
+    to the same host skip the TCP/TLS handshake
+    """
+
+    def __init__(self, max_idle: int = 8, timeout: float = 60):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def get(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        with self.lock:
+            connections = self.idle[(scheme, netloc)]
+            if connections:
+                return connections.pop()
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def put(self, scheme: str, netloc: str, connection: http.client.HTTPConnection) -> None:
+        with self.lock:
+            connections = self.idle[(scheme, netloc)]
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def close(self) -> None:
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
+
+
+class Fetcher:
+    """
+    HTTP GET engine shared between scrapping threads. Limits the number of requests
+    in flight, rate limits them with a token bucket and reuses pooled connections
+    """
+
+    def __init__(self, max_connections: int = 4, requests_per_second: float = 1.0, burst: int = 1):
+        self.pool = ConnectionPool(max_idle=max_connections)
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    def get(self, url: str) -> bytes:
+        """
+        Sends GET request to url and returns the response body
+        :param url:
+        :return: decoded response body
+        """
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        headers = {
+            'User-Agent': user_agent,
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive'
+        }
+        with self.slots:
+            with token_bucket_wait.time():
+                self.bucket.acquire()
+            start = time.perf_counter()
+            # A pooled connection may have been closed by the server in the meantime,
+            # so a failure on the first attempt is retried once on a fresh connection
+            for attempt in range(2):
+                connection = self.pool.get(parts.scheme, parts.netloc)
+                try:
+                    connection.request('GET', path, headers=headers)
+                    response = connection.getresponse()
+                    body = response.read()
+                except (http.client.HTTPException, OSError):
+                    connection.close()
+                    if attempt == 1:
+                        request_errors.labels(parts.netloc).inc()
+                        raise
+                    continue
+                break
+        if metrics.registry.enabled:
+            request_seconds.labels(parts.netloc).observe(time.perf_counter() - start)
+            responses.labels(parts.netloc, response.status).inc()
+            received_bytes.labels(parts.netloc).inc(len(body))
+            sent_bytes.labels(parts.netloc).inc(len(path) + sum(len(k) + len(v) for k, v in headers.items()))
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(parts.scheme, parts.netloc, connection)
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason, response.headers, None)
+        if response.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def get_json(self, url: str) -> Any:
+        return json.loads(self.get(url).decode())
+
+    def close(self) -> None:
+        self.pool.close()
+
+
+class RateBudget:
+    """
+    Thread safe limiter driven by the rate limit headers of an API, shared by all the
+    clients that spend the same budget. Requests are spread evenly over the time left
+    until the reset, using the latest remaining count reported by any client
+    """
+
+    def __init__(self):
+        self.remaining = None
+        self.reset_at = None
+        self.next_at = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Blocks until the next request fits in the budget
+        :return:
+        """
+        with self.lock:
+            now = time.monotonic()
+            interval = 0.0
+            if self.remaining is not None:
+                if now >= self.reset_at:
+                    self.remaining = None
+                else:
+                    interval = (self.reset_at - now) / max(self.remaining, 1)
+                    self.remaining -= 1
+            at = max(now, self.next_at)
+            self.next_at = at + interval
+        if at > now:
+            time.sleep(at - now)
+
+    def update(self, remaining: float, reset: float) -> None:
+        """
+        Updates budget from response headers
+        :param remaining: requests left in the current window
+        :param reset: seconds until the window resets
+        :return:
+        """
+        with self.lock:
+            self.remaining = remaining
+            self.reset_at = time.monotonic() + reset
@@ -1,41 +1,93 @@
-import urllib.request
-import json
 from typing import Any
 from urllib.error import HTTPError
-from pymongo import MongoClient
+from pymongo import InsertOne, MongoClient, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
 import credsmanager as m
 import time
 import datetime
 import logging
-from datetime import datetime as dt
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
-from pymongo import UpdateOne
+import metrics
+from checkpoints import CheckpointStore
+from scrappers.coverage import CoverageIndex
+from scrappers.cache import ResponseCache
+from scrappers.comments import CommentHydrator, comment_ids_template, comments_storages, comments_template, \
+    ensure_comment_indexes
+from scrappers.fetch import Fetcher
+from scrappers.scan import KeysetScan, embedded_comments, ensure_indexes, pending_comments
+from scrappers.writer import BulkWriter, WriteTracker, duplicate_key
 
 query_template = "https://api.pushshift.io/reddit/search/submission/?" \
                  "subreddit={}&" \
                  "after={}&" \
                  "sort=asc&limit={}"
 
+window_query_template = query_template + "&before={}"
+
+scrapped_submissions = metrics.registry.counter('submissions_scrapped_total', 'Submissions scrapped',
+                                                ('scrapper',)).labels('history')
+scrapped_pages = metrics.registry.counter('pushshift_pages_total', 'Pages of submissions fetched from pushshift')
+
 
 def chunks(l, n):
     for i in range(0, len(l), n):
         yield l[i:i + n]
 
 
+class WindowMerger:
+    """
+    Dedupes submissions fetched by adjacent time windows. Windows overlap by one
+    second at each boundary, so only submissions created at a boundary are tracked
+    """
+
+    def __init__(self, boundaries: []):
+        self.boundaries = set(boundaries)
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def merge(self, page: []) -> []:
+        merged = []
+        with self.lock:
+            for post in page:
+                if post['created_utc'] in self.boundaries:
+                    if post['id'] in self.seen:
+                        continue
+                    self.seen.add(post['id'])
+                merged.append(post)
+        return merged
+
+
+# MongoClient is thread safe and keeps its own connection pool, so one client per server is shared
+clients = {}
+clients_lock = threading.Lock()
+
+
 def get_remote_client(server_type: str) -> MongoClient:
-    creds = m.get_credentials('mongo')
-    server_type = get_server_address(server_type)
-    connection_str = "mongodb://{}:{}@{}/{}".format(
-        creds['user'],
-        creds['password'],
-        server_type,
-        creds['db_name']
-    )
-    return MongoClient(connection_str)
-
-
-def get_server_address(host: str) -> str:
-    creds = m.get_credentials('mongo')
+    """
+    Returns shared client of server specified by type, one of: localhost, local_network, public
+    :param server_type:
+    :return:
+    """
+    with clients_lock:
+        if server_type not in clients:
+            creds = m.get_credentials('mongo')
+            connection_str = "mongodb://{}:{}@{}/{}".format(
+                creds['user'],
+                creds['password'],
+                get_server_address(server_type, creds),
+                creds['db_name']
+            )
+            clients[server_type] = MongoClient(connection_str)
+        return clients[server_type]
+
+
+def get_server_address(host: str, creds: dict = None) -> str:
+    creds = creds or m.get_credentials('mongo')
     if host == 'local_network':
         return creds['ip_local']
     if host == 'localhost':
@@ -45,75 +97,322 @@ def get_server_address(host: str) -> str:
 
 
 class HistoricalRedditScrapper:
-    def __init__(self):
+    def __init__(self, max_workers: int = 4, requests_per_second: float = 1.0, cache_mode: str = None,
+                 server_type: str = 'localhost'):
+        """
+        :param max_workers: number of subs, windows or requests processed concurrently
+        :param requests_per_second: pushshift rate limit
+        :param cache_mode: None, 'record' to cache responses on disk, 'replay' to only use the cache
+        :param server_type: Mongo server, one of: localhost, local_network, public
+        """
         self.config = m.get_config('reddit')
+        self.comments_storage = self.config.get('commentsStorage', 'embedded')
+        if self.comments_storage not in comments_storages:
+            raise ValueError('Unknown comments storage {}, expected one of {}'
+                             .format(self.comments_storage, ', '.join(comments_storages)))
+        self.checkpoints = CheckpointStore()
+        self.windows_lock = threading.Lock()
+        self.coverage_lock = threading.Lock()
+        self.coverages = {}
+        # Longest period without submissions in stored data that is not treated as a gap
+        self.coverage_gap = 6 * 3600
+        # Submissions younger than that may still be missing from pushshift
+        self.settle = 3600
         self.data_path = str(Path(__file__).parents[1]) + '/data_history/'
         self.start_date = '1451606400'
         self.silent = False
-        self.client = get_remote_client('localhost')
+        self.max_workers = max_workers
+        self.fetcher = Fetcher(max_connections=max_workers, requests_per_second=requests_per_second)
+        self.cache = ResponseCache(replay=cache_mode == 'replay') if cache_mode is not None else None
+        self.client = get_remote_client(server_type)
+        # Cursors move only past pages whose submissions were written
+        self.tracker = WriteTracker()
+        self.writer = BulkWriter(self.client.reddit, on_written=self.tracker.written)
 
-    @staticmethod
-    def make_request(query: str) -> Any:
+    def close(self) -> None:
+        """
+        Writes all the queued submissions and closes pooled connections
+        :return:
+        """
+        self.writer.close()
+        self.fetcher.close()
+        self.checkpoints.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def make_request(self, query: str) -> Any:
         """
-        Sends query to pushift.io api
+        Sends query to pushift.io api, reusing pooled keep-alive connections.
+        With cache enabled, the response is served from or recorded to disk
         :param query:
         :return:
         """
-        with urllib.request.urlopen(query) as url:
-            return json.loads(url.read().decode())
+        if self.cache is not None:
+            return self.cache.get_json(query, self.fetcher.get)
+        return self.fetcher.get_json(query)
 
-    def scrap_all(self) -> None:
-        for sub in self.config['subreddits']:
-            self.scrap_sub(sub['name'])
+    def scrap_all(self, shards: int = 1) -> None:
+        """
+        Scraps all the subs from config concurrently, at most max_workers at once.
+        Every sub keeps advancing its own currentAfterDate cursor
+        :param shards: if greater than 1, every sub is additionally split into time windows
+        :return:
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            if shards > 1:
+                futures = {executor.submit(self.scrap_sub_sharded, sub['name'], shards): sub['name']
+                           for sub in self.config['subreddits']}
+            else:
+                futures = {executor.submit(self.scrap_sub, sub['name']): sub['name']
+                           for sub in self.config['subreddits']}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    logging.exception('Failed to scrap sub {}'.format(futures[future]))
 
     def scrap_sub(self, sub_name: str) -> Any:
         index = self.get_sub_index(sub_name)
         if self.sub_first_scrap(index):
             self.update_after_date(index, self.start_date)
+        ensure_indexes(self.client.reddit[sub_name + '_history'])
+        self.load_coverage(index)
         if not self.silent:
             print("Starting to scrap : {}".format(sub_name))
         start = time.time()
-        while True:
+        stream = (sub_name, 'cursor')
+        with metrics.span('history.scrap_sub'):
             date = self.get_after_date(index)
-            scrapped_data = self.scrap_sub_after_date(index, date)
-            if len(scrapped_data) == 0:
-                break
-            new_after_date = scrapped_data[-1]['created_utc']
-            self.update_submissions(scrapped_data, sub_name)
-            self.update_after_date(index, new_after_date)
-            m.update_config(self.config, 'reddit')
+            while True:
+                scrapped_data = self.scrap_sub_after_date(index, date)
+                if len(scrapped_data) == 0:
+                    break
+                new_after_date = scrapped_data[-1]['created_utc']
+                self.store_page(stream, sub_name, scrapped_data,
+                                partial(self.commit_page, index, date, new_after_date))
+                date = new_after_date
+            self.writer.flush()
+        if self.finish_stream(stream):
+            self.update_coverage(index, int(date) + 1, int(time.time()))
         end = time.time()
         timestamp = str(datetime.timedelta(seconds=(end - start)))
         if not self.silent:
             print("Finished scrapping {} in {}".format(sub_name, timestamp))
 
-    def scrap_sub_after_date(self, index: int, date: str, limit: int = 1000) -> Any:
+    def scrap_sub_sharded(self, sub_name: str, shards: int = 4) -> None:
+        """
+        Splits [currentAfterDate, now] into time windows and scraps them in parallel.
+        Each window keeps its own resumable cursor in the checkpoint store. When all
+        windows are done, currentAfterDate is moved to the end of the last window,
+        even if no submissions were found there
+        :param sub_name:
+        :param shards: number of windows to split the range into
+        :return:
+        """
+        index = self.get_sub_index(sub_name)
+        if self.sub_first_scrap(index):
+            self.update_after_date(index, self.start_date)
+        ensure_indexes(self.client.reddit[sub_name + '_history'])
+        self.load_coverage(index)
+        windows = self.get_windows(index, shards)
+        merger = WindowMerger([window['after'] + 1 for window in windows[1:]])
+        if not self.silent:
+            print("Starting to scrap : {} in {} windows".format(sub_name, len(windows)))
+        start = time.time()
+        with metrics.span('history.scrap_sub_sharded'), ThreadPoolExecutor(max_workers=len(windows)) as executor:
+            futures = [executor.submit(self.scrap_window, index, windows, window, merger) for window in windows]
+            for future in as_completed(futures):
+                future.result()
+        if all(window['done'] for window in windows):
+            # The last window may have had no submissions, its end is still scanned
+            self.update_after_date(index, windows[-1]['before'] - 1)
+            self.checkpoints.delete(sub_name, 'windows')
+        end = time.time()
+        timestamp = str(datetime.timedelta(seconds=(end - start)))
+        if not self.silent:
+            print("Finished scrapping {} in {}".format(sub_name, timestamp))
+
+    def get_windows(self, index: int, shards: int) -> []:
+        """
+        Returns time windows of the sub specified by index. Unfinished windows stored
+        in checkpoints are resumed, otherwise new ones are created. A window covers submissions
+        created in (after, before), adjacent windows overlap by one second
+        :param index:
+        :param shards: number of windows, at most one per second of the range
+        :return: list of window dicts
+        """
+        sub_name = self.config['subreddits'][index]['name']
+        windows = self.checkpoints.get(sub_name, 'windows')
+        if windows is None:
+            start = int(self.get_after_date(index))
+            end = int(time.time())
+            # At most one window per second, so every window starts after the previous one
+            shards = max(1, min(shards, end - start))
+            step = (end - start) // shards
+            bounds = [start + i * step for i in range(shards)] + [end]
+            windows = [{
+                'after': bounds[i] - (1 if i > 0 else 0),
+                'before': bounds[i + 1] + 1,
+                'currentAfterDate': bounds[i] - (1 if i > 0 else 0),
+                'done': False
+            } for i in range(shards)]
+            self.checkpoints.set(sub_name, 'windows', windows)
+        return windows
+
+    def scrap_window(self, index: int, windows: [], window: dict, merger: WindowMerger) -> None:
+        sub_name = self.config['subreddits'][index]['name']
+        if window['done']:
+            return
+        stream = (sub_name, 'window', window['after'])
+        after_date = window['currentAfterDate']
+        while True:
+            scrapped_data = self.scrap_sub_after_date(index, after_date, before=window['before'])
+            if len(scrapped_data) == 0:
+                break
+            new_after_date = scrapped_data[-1]['created_utc']
+            self.store_page(stream, sub_name, merger.merge(scrapped_data),
+                            partial(self.commit_window_page, index, windows, window, after_date, new_after_date))
+            after_date = new_after_date
+        self.writer.flush()
+        if self.finish_stream(stream):
+            self.update_coverage(index, int(after_date) + 1, window['before'] - 1)
+            with self.windows_lock:
+                window['done'] = True
+                self.checkpoints.set(sub_name, 'windows', windows)
+
+    def commit_window_page(self, index: int, windows: [], window: dict, after_date: int,
+                           new_after_date: int) -> None:
+        """
+        Moves window cursor past a page whose submissions were all written
+        :param index:
+        :param windows: all the windows of the sub, saved together
+        :param window:
+        :param after_date: cursor the page was fetched with
+        :param new_after_date: created_utc of the last submission of the page
+        :return:
+        """
+        with self.windows_lock:
+            window['currentAfterDate'] = new_after_date
+            self.checkpoints.set(self.config['subreddits'][index]['name'], 'windows', windows)
+        self.update_coverage(index, int(after_date) + 1, new_after_date)
+
+    def scrap_sub_gaps(self, sub_name: str) -> None:
+        """
+        Scraps only the periods between start_date and now that are missing from
+        the sub's coverage index. The index is updated only with periods whose submissions
+        were confirmed written, so gaps left by failed writes are found by the next run
+        :param sub_name:
+        :return:
+        """
+        index = self.get_sub_index(sub_name)
+        ensure_indexes(self.client.reddit[sub_name + '_history'])
+        coverage = self.load_coverage(index, build=True)
+        gaps = coverage.missing(int(self.start_date) + 1, int(time.time()) - self.settle)
+        if not self.silent:
+            print("Starting to scrap : {} in {} missing periods".format(sub_name, len(gaps)))
+        for gap_start, gap_end in gaps:
+            coverage.begin(gap_start, gap_end)
+            stream = (sub_name, 'gap', gap_start)
+            after_date = gap_start - 1
+            with metrics.span('history.scrap_gap'):
+                while True:
+                    scrapped_data = self.scrap_sub_after_date(index, after_date, before=gap_end + 1)
+                    if len(scrapped_data) == 0:
+                        break
+                    new_after_date = scrapped_data[-1]['created_utc']
+                    self.store_page(stream, sub_name, scrapped_data,
+                                    partial(self.update_coverage, index, after_date + 1, new_after_date))
+                    after_date = new_after_date
+                self.writer.flush()
+            if self.finish_stream(stream):
+                self.update_coverage(index, after_date + 1, gap_end)
+            coverage.finish(gap_start, gap_end)
+            self.checkpoints.set(sub_name, 'coverage', coverage.to_dict())
+
+    def load_coverage(self, index: int, build: bool = False) -> CoverageIndex:
+        """
+        Loads coverage index of the sub specified by index. Runs on the scrapping thread
+        before any page is stored, so page commits on the writer thread only update it.
+        Ongoing periods of a stored index were left by a run that did not finish, so
+        they are dropped. If the index was never stored and build is set, it is built from
+        submissions already in the sub history collection
+        :param index:
+        :param build: whether to build a missing index, which scans the whole collection
+        :return: coverage index, or None if it was neither stored nor built
+        """
+        sub_name = self.config['subreddits'][index]['name']
+        with self.coverage_lock:
+            if sub_name in self.coverages:
+                return self.coverages[sub_name]
+        stored = self.checkpoints.get(sub_name, 'coverage')
+        if stored is not None:
+            coverage = CoverageIndex(stored['intervals'])
+        elif build:
+            collection = self.client.reddit[sub_name + '_history']
+            coverage = CoverageIndex.from_collection(collection, self.coverage_gap)
+        else:
+            return None
+        with self.coverage_lock:
+            return self.coverages.setdefault(sub_name, coverage)
+
+    def update_coverage(self, index: int, start: int, end: int) -> None:
+        """
+        Marks [start, end] as scrapped in coverage index of the sub specified by index.
+        The last settle seconds are left out, as pushshift may still ingest submissions
+        created then. Subs without a loaded index are skipped, gap scrapping builds theirs
+        from the stored submissions
+        :param index:
+        :param start:
+        :param end:
+        :return:
+        """
+        sub_name = self.config['subreddits'][index]['name']
+        with self.coverage_lock:
+            coverage = self.coverages.get(sub_name)
+        if coverage is None:
+            return
+        coverage.add(int(start), min(int(end), int(time.time()) - self.settle))
+        self.checkpoints.set(sub_name, 'coverage', coverage.to_dict())
+
+    def scrap_sub_after_date(self, index: int, date: str, limit: int = 1000, before: str = None) -> Any:
         """
         Scraps all the submissions from subreddit specified by sub_name that
-        were made after specified date
+        were made after specified date, and optionally before the before date
         :param index:
         :param limit:
         :param date: date string in UTC format
+        :param before: date string in UTC format
         :return: json with submissions
         """
-        start = time.time()
         sub_name = self.config['subreddits'][index]['name']
-        query = query_template.format(sub_name, date, limit)
-        data = HistoricalRedditScrapper.make_request(query)['data']
-        end = time.time()
-        timestamp = str(datetime.timedelta(seconds=(end - start)))
+        if before is None:
+            query = query_template.format(sub_name, date, limit)
+        else:
+            query = window_query_template.format(sub_name, date, limit, before)
+        data = self.make_request(query)['data']
+        scrapped_pages.inc()
+        scrapped_submissions.inc(len(data))
         if len(data) > 0:
-            self.print_summary(data, timestamp)
+            logging.debug('Scrapped %s submissions of %s from %s to %s', len(data), sub_name,
+                          data[0]['created_utc'], data[-1]['created_utc'])
         return data
 
     def sub_first_scrap(self, index: int) -> bool:
-        return 'currentAfterDate' not in self.config['subreddits'][index]
+        return self.get_after_date(index) is None
 
     def update_after_date(self, index: int, new_after_date: str) -> None:
-        self.config['subreddits'][index]['currentAfterDate'] = new_after_date
+        sub_name = self.config['subreddits'][index]['name']
+        self.checkpoints.set(sub_name, 'currentAfterDate', new_after_date)
 
     def get_after_date(self, index: int) -> str:
-        return self.config['subreddits'][index]['currentAfterDate']
+        """
+        Returns cursor of the sub specified by index. Subs scrapped before the checkpoint
+        store existed fall back to currentAfterDate from config
+        :param index:
+        :return:
+        """
+        sub = self.config['subreddits'][index]
+        return self.checkpoints.get(sub['name'], 'currentAfterDate', sub.get('currentAfterDate'))
 
     def get_sub_index(self, sub_name: str) -> int:
         for index, item in enumerate(self.config['subreddits']):
@@ -123,137 +422,271 @@ class HistoricalRedditScrapper:
             index = -1
         return index
 
-    def print_summary(self, scrapped_data, time_elapsed) -> None:
-        if self.silent:
-            return
-        size = len(scrapped_data)
-        from_date = dt.utcfromtimestamp(scrapped_data[0]['created_utc'])
-        to_date = dt.utcfromtimestamp(scrapped_data[-1]['created_utc'])
-        print("Scrapped {} submissions from {} to {} in {}".format(size, from_date, to_date, time_elapsed))
+    def store_page(self, stream, sub_name: str, posts: [], callback) -> None:
+        """
+        Queues upserts of a page of submissions, callback runs once all of them are written
+        and all the earlier pages of stream were committed
+        :param stream: key of pages committed in order, e.g. (sub_name, 'cursor')
+        :param sub_name:
+        :param posts:
+        :param callback:
+        :return:
+        """
+        self.tracker.track(stream, sub_name + '_history', [post['id'] for post in posts], callback)
+        self.update_submissions(posts, sub_name)
+
+    def commit_page(self, index: int, after_date: int, new_after_date: int) -> None:
+        self.update_after_date(index, new_after_date)
+        self.update_coverage(index, int(after_date) + 1, new_after_date)
+
+    def finish_stream(self, stream) -> bool:
+        """
+        Checks whether all the pages of stream were committed, after the writer was flushed.
+        Pages that failed are dropped, their cursor stays before them so the next run retries
+        :param stream:
+        :return:
+        """
+        failed = self.tracker.discard(stream)
+        if failed > 0:
+            logging.error('{} pages of {} were not confirmed written, they will be scrapped again'.format(failed, stream[0]))
+        return failed == 0
 
     def update_submissions(self, scrapped_data, sub_name: str):
-        self.db.update_db('reddit', sub_name + "_history", scrapped_data)
-        # database = self.mongo.reddit
-        # collection = database[sub_name + "_history"]
-        # collection.insert_many(scrapped_data)
+        for post in scrapped_data:
+            self.writer.upsert(sub_name + "_history", post['id'], post)
 
     def get_comments(self, submission_id: str):
         ids = self.get_comment_ids(submission_id)
         if len(ids) == 0:
-            return {}
-        start = time.time()
-        print("\tSubmission {} Num comments {}".format(submission_id, len(ids)))
-        query = "https://api.pushshift.io/reddit/comment/search?ids="
+            return []
         data = []
-        try:
-            for chunk in chunks(self.get_comment_ids(submission_id), 1000):
-                print("\tProcessing chunk of size {}".format(len(chunk)))
-                query = query + ','.join(chunk)
-                data = data + HistoricalRedditScrapper.make_request(query)['data']
-        except HTTPError:
-            return data
-        end = time.time()
-        print("\tScrapped in: {}".format(datetime.timedelta(seconds=(end - start))))
+        with metrics.span('history.get_comments'):
+            try:
+                for chunk in chunks(ids, 1000):
+                    data.extend(self.make_request(comments_template.format(','.join(chunk)))['data'])
+            except HTTPError:
+                logging.exception('Failed to get comments of submission {}'.format(submission_id))
         return data
 
     def get_comment_ids(self, submission_id: str):
-        query = "https://api.pushshift.io/reddit/submission/comment_ids/" + submission_id
-        return HistoricalRedditScrapper.make_request(query)['data']
+        return self.make_request(comment_ids_template.format(submission_id))['data']
 
     def get_all_comments(self):
-        client = MongoClient("mongodb://localhost:27017/")
-        db = client.reddit
         for sub in self.config['subreddits']:
-            collection = db[sub['name'] + '_history']
             print("Starting getting comments for sub " + sub['name'])
-            for post in collection.find({}, no_cursor_timeout=True):
-                print("Searching for comments for post {} from sub {}".format(post['id'], sub['name']))
-                if post['num_comments'] < 6:
-                    post['comments'] = []
-                    post['comments_scrapped'] = 1
-                    start = time.time()
-                    collection.save(post)
-                    end = time.time()
-                    print("\tUpdated in: {}".format(datetime.timedelta(seconds=(end - start))))
-                    continue
-                if 'comments' not in post:
-                    comments = self.get_comments(post['id'])
-                    post['comments'] = comments
-                    post['comments_scrapped'] = 1
-                    start = time.time()
-                    collection.save(post)
-                    end = time.time()
-                    print("\tUpdated in: {}".format(datetime.timedelta(seconds=(end - start))))
-                else:
-                    if post['comments_scrapped'] == 0:
-                        comments = self.get_comments(post['id'])
-                        post['comments'] = comments
-                        post['comments_scrapped'] = 1
-                        start = time.time()
-                        collection.save(post)
-                        end = time.time()
-                        print("\tUpdated in: {}".format(datetime.timedelta(seconds=(end - start))))
+            self.get_comments_from_sub(sub['name'])
 
     def remote_test(self):
-        creds = m.get_credentials('mongo')
-        connection_str = "mongodb://{}:{}@{}/{}".format(
-            creds['user'],
-            creds['password'],
-            creds['ip_local'],
-            creds['db_name']
-        )
-        client = MongoClient(connection_str)
-        print(client['reddit'].collection_names(()))
-
-    def get_comments_from_sub(self, sub_name: str, skip: int = 0):
-        client = get_remote_client('localhost')
-        collection = client.reddit[sub_name + '_history']
-        count = collection.count()
-        print("Connected!")
-        processed = skip
-        operations = []
-        for post in collection.find({}, no_cursor_timeout=True, batch_size=10000, skip=skip):
-            processed += 1
-            print("Searching for comments for post {} from sub {} from date {}. Processed {}/{}."
-                  .format(post['id']
-                          , sub_name
-                          , dt.utcfromtimestamp(post['created_utc'])
-                          , processed
-                          , count))
-            if post['num_comments'] < 6:
-                post['comments'] = []
-                post['comments_scrapped'] = 1
+        client = get_remote_client('local_network')
+        print(client['reddit'].list_collection_names())
+
+    def get_comments_from_sub(self, sub_name: str, resume: bool = True):
+        """
+        Hydrates all the posts from sub history collection that have no comments yet.
+        Posts are scanned in (created_utc, id) order and the last key before which all
+        the posts were written is checkpointed, so an interrupted run resumes from there.
+        Once the scan is exhausted the key is cleared, so posts stored later with older
+        created_utc, e.g. by gap or window scrapping, are found by the next run. When reading
+        posts from Mongo fails, the error is raised and the key is kept.
+        Comment ids of many posts are fetched concurrently and packed into full
+        comment search requests by CommentHydrator. Comments are stored as set
+        by commentsStorage in config, see store_comments
+        :param sub_name:
+        :param resume: whether to continue from the stored key or scan from the start
+        :return:
+        """
+        index = self.get_sub_index(sub_name)
+        collection = self.client.reddit[sub_name + '_history']
+        ensure_indexes(collection)
+        if self.comments_storage == 'collection':
+            ensure_comment_indexes(self.client.reddit[sub_name + '_comments'])
+        key = self.checkpoints.get(sub_name, 'commentsKey') if resume else None
+        scan = KeysetScan(collection, pending_comments, key=key,
+                          projection={'_id': 0, 'id': 1, 'created_utc': 1, 'num_comments': 1})
+        hydrator = CommentHydrator(self.make_request, workers=self.max_workers)
+        tracker = WriteTracker()
+        stored = queue.Queue()
+
+        def on_written(collection_name: str, ids: []):
+            tracker.written(collection_name, ids)
+            if collection_name == collection.name:
+                self.update_comments_key(index, scan, ids)
+
+        with metrics.span('history.hydrate_sub'), BulkWriter(self.client.reddit, on_written=on_written) as writer:
             try:
-                if 'comments' not in post or post['comments_scrapped'] == 0:
-                    comments = self.get_comments(post['id'])
-                    post['comments'] = comments
-                    post['comments_scrapped'] = 1
-                else:
+                for post_id, comments in hydrator.hydrate(scan):
+                    self.store_comments(writer, tracker, stored, sub_name, post_id, comments)
+                    self.flag_stored_posts(writer, stored, sub_name)
+            finally:
+                # Posts hydrated before a failed scan are still flagged, the key stays where it got
+                while True:
+                    writer.flush()
+                    if stored.empty():
+                        break
+                    self.flag_stored_posts(writer, stored, sub_name)
+        # The scan is exhausted here. Posts that failed are still pending, so a scan from the start retries them too
+        self.checkpoints.delete(sub_name, 'commentsKey')
+        if not self.silent:
+            print("Hydrated {}: written {}, failed writes {}, failed posts {}"
+                  .format(sub_name, writer.written, writer.failed, hydrator.failed + len(tracker.streams)))
+
+    def store_comments(self, writer: BulkWriter, tracker: WriteTracker, stored: queue.Queue, sub_name: str,
+                       post_id: str, comments: []) -> None:
+        """
+        Queues comments of a post. In embedded mode the comment list is set on the post.
+        In collection mode comments are inserted to the sub comments collection, and once
+        all of them are confirmed written the post is put on stored, to be flagged by
+        flag_stored_posts. A post whose comments failed to insert is never flagged as
+        scrapped, so it stays pending and is hydrated again by the next run
+        :param writer:
+        :param tracker: fed with writes of the writer
+        :param stored: queue of (post_id, comments_count) of posts with all comments written
+        :param sub_name:
+        :param post_id:
+        :param comments: comment documents returned by pushshift
+        :return:
+        """
+        if self.comments_storage == 'embedded':
+            writer.upsert(sub_name + '_history', post_id, {
+                'comments': comments,
+                'comments_scrapped': 1
+            })
+            return
+        tracker.track(post_id, sub_name + '_comments', [comment['id'] for comment in comments],
+                      partial(stored.put, (post_id, len(comments))))
+        for comment in comments:
+            writer.insert(sub_name + '_comments', comment)
+
+    @staticmethod
+    def flag_stored_posts(writer: BulkWriter, stored: queue.Queue, sub_name: str) -> None:
+        """
+        Queues updates flagging posts whose comments were written. Runs on the scrapping
+        thread, as the writer thread that confirms the comments can not queue to itself
+        :param writer:
+        :param stored:
+        :param sub_name:
+        :return:
+        """
+        while True:
+            try:
+                post_id, comments_count = stored.get_nowait()
+            except queue.Empty:
+                return
+            writer.upsert(sub_name + '_history', post_id, {
+                'comments_count': comments_count,
+                'comments_scrapped': 1
+            })
+
+    def get_stored_comments(self, sub_name: str, post_id: str) -> []:
+        """
+        Returns stored comments of a post, in order they were created
+        :param sub_name:
+        :param post_id:
+        :return: list of comment documents
+        """
+        if self.comments_storage == 'embedded':
+            post = self.client.reddit[sub_name + '_history'].find_one({'id': post_id}, {'_id': 0, 'comments': 1})
+            return post.get('comments', []) if post is not None else []
+        cursor = self.client.reddit[sub_name + '_comments'].find({'link_id': 't3_' + post_id}, {'_id': 0})
+        return list(cursor.sort('created_utc', 1))
+
+    def update_comments_key(self, index: int, scan: KeysetScan, written: []) -> None:
+        for post_id in written:
+            scan.done(post_id)
+        self.checkpoints.set(self.config['subreddits'][index]['name'], 'commentsKey', scan.committed_key)
+
+    def migrate_all_comments(self) -> None:
+        for sub in self.config['subreddits']:
+            if not self.silent:
+                print("Migrating comments of sub " + sub['name'])
+            self.migrate_comments(sub['name'])
+
+    def migrate_comments(self, sub_name: str, page_size: int = 100) -> None:
+        """
+        Moves comments embedded in posts of sub history collection to the sub comments
+        collection. Posts with embedded comments are streamed in (created_utc, id) order,
+        page_size at once. Comments of a page are inserted in bulk, then the embedded arrays
+        of posts whose comments were all stored are replaced by their count. Posts that failed
+        keep their comments and are migrated by the next run. Inserts are idempotent and the
+        key of the last migrated page is checkpointed, so an interrupted migration resumes
+        :param sub_name:
+        :param page_size: number of posts held in memory at once
+        :return:
+        """
+        collection = self.client.reddit[sub_name + '_history']
+        comments_collection = self.client.reddit[sub_name + '_comments']
+        ensure_indexes(collection)
+        ensure_comment_indexes(comments_collection)
+        scan = KeysetScan(collection, embedded_comments, key=self.checkpoints.get(sub_name, 'migrationKey'),
+                          page_size=page_size, projection={'_id': 0, 'id': 1, 'created_utc': 1, 'comments': 1})
+        migrated = 0
+        failed = 0
+        page = []
+        with metrics.span('history.migrate_comments'):
+            for post in scan:
+                page.append(post)
+                if len(page) < page_size:
                     continue
-                operations.append(UpdateOne({'id': post['id']}, {'$set': {
-                    'comments': post['comments'],
-                    'comments_scrapped': post['comments_scrapped']
-                }}))
-            except:
-                logging.exception('')
-                time.sleep(10)
-                continue
-
-            if len(operations) == 100:
-                start = time.time()
-                result = collection.bulk_write(operations)
-                end = time.time()
-                print("\tUpdated in: {}".format(datetime.timedelta(seconds=(end - start))))
-                print(result.bulk_api_result)
-                operations = []
+                page_migrated = self.migrate_page(collection, comments_collection, page)
+                migrated += page_migrated
+                failed += len(page) - page_migrated
+                # Posts that failed have to be scanned again, so the key is not moved past them
+                if failed == 0:
+                    self.checkpoints.set(sub_name, 'migrationKey', [page[-1]['created_utc'], page[-1]['id']])
+                page = []
+            if len(page) > 0:
+                page_migrated = self.migrate_page(collection, comments_collection, page)
+                migrated += page_migrated
+                failed += len(page) - page_migrated
+        if failed == 0:
+            self.checkpoints.delete(sub_name, 'migrationKey')
+        if not self.silent:
+            print("Migrated comments of {} posts from {}, failed posts {}".format(migrated, sub_name, failed))
+
+    @staticmethod
+    def migrate_page(collection: Collection, comments_collection: Collection, posts: []) -> int:
+        """
+        Migrates embedded comments of one page of posts
+        :param collection: sub history collection
+        :param comments_collection: sub comments collection
+        :param posts: post documents with id and comments fields
+        :return: number of posts migrated
+        """
+        operations = [InsertOne(comment) for post in posts for comment in post['comments']]
+        owners = [post['id'] for post in posts for _ in post['comments']]
+        failed = set()
         if len(operations) > 0:
-            collection.bulk_write(operations)
+            try:
+                comments_collection.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                failed = set(owners[error['index']] for error in e.details['writeErrors']
+                             if error['code'] != duplicate_key)
+            except Exception:
+                logging.exception('Failed to insert comments to {}'.format(comments_collection.name))
+                return 0
+        updates = [UpdateOne({'id': post['id']}, {
+            '$set': {'comments_count': len(post['comments'])},
+            '$unset': {'comments': ''}
+        }) for post in posts if post['id'] not in failed]
+        if len(updates) == 0:
+            return 0
+        try:
+            collection.bulk_write(updates, ordered=False)
+        except BulkWriteError as e:
+            return len(updates) - len(e.details['writeErrors'])
+        except Exception:
+            logging.exception('Failed to update posts of {}'.format(collection.name))
+            return 0
+        return len(updates)
 
 
-scrapper = HistoricalRedditScrapper()
-# print(scrapper.get_comment_ids_as_str("6xjaba"))
-# print(scrapper.get_comments("6xjaba"))
-# scrapper.get_all_comments()
-scrapper.get_comments_from_sub('Bitcoin', skip=100000)
-# print(len(scrapper.get_comments("4oiqj7")))
-# db.ArkEcosystem_history.find( { id: { $eq: "570e0o" } } )
+if __name__ == '__main__':
+    scrapper = HistoricalRedditScrapper()
+    metrics.configure(scrapper.config.get('metrics'))
+    # print(scrapper.get_comment_ids_as_str("6xjaba"))
+    # print(scrapper.get_comments("6xjaba"))
+    # scrapper.get_all_comments()
+    scrapper.get_comments_from_sub('Bitcoin')
+    scrapper.close()
+    # print(len(scrapper.get_comments("4oiqj7")))
+    # db.ArkEcosystem_history.find( { id: { $eq: "570e0o" } } )
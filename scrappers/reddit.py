@@ -1,50 +1,94 @@
 import praw
+import prawcore
 from praw.models.reddit.submission import Submission
 from praw.models.reddit.more import MoreComments
 import credsmanager as m
 from pathlib import Path
-import csv
-import json
 import os
 import time
 import datetime
-from collections import defaultdict
+import logging
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import metrics
+from scrappers.fetch import RateBudget, wait_seconds
+from scrappers.seen import SeenIndex
+from scrappers.storage import create_storage
 
-submission_header = [
-    "id",
-    "created_utc",
-    "title",
-    "selftext",
-    "score",
-    "upvote_ratio",
-    "permalink",
-    "num_comments",
-    "comments"
-]
+scrapped_submissions = metrics.registry.counter('submissions_scrapped_total', 'Submissions scrapped',
+                                                ('scrapper',)).labels('live')
+failed_submissions = metrics.registry.counter('submission_failures_total', 'Submissions that failed to scrap')
+sampled_comments = metrics.registry.counter('comments_sampled_total', 'Top and controversial comments sampled')
+request_seconds = metrics.registry.histogram('reddit_request_seconds', 'Latency of Reddit API requests')
+budget_wait = wait_seconds.labels('reddit_budget')
+
+
+class BudgetedRequestor(prawcore.Requestor):
+    """
+    Requestor that spends every request of a praw.Reddit instance from a shared RateBudget
+    and feeds the budget with ratelimit headers returned by Reddit
+    """
+
+    def __init__(self, *args, budget: RateBudget = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.budget = budget
+
+    def request(self, *args, **kwargs):
+        with budget_wait.time():
+            self.budget.acquire()
+        with request_seconds.time():
+            response = super().request(*args, **kwargs)
+        remaining = response.headers.get('x-ratelimit-remaining')
+        reset = response.headers.get('x-ratelimit-reset')
+        if remaining is not None and reset is not None:
+            self.budget.update(float(remaining), float(reset))
+        return response
 
 
 class RedditScrapper:
     def __init__(self):
         self.creds = m.get_credentials('reddit')
         self.config = m.get_config('reddit')
-        self.reddit = None
+        self.local = threading.local()
+        self.budget = RateBudget()
+        self.sub_locks = defaultdict(threading.RLock)
+        self.blacklists = {}
+        self.post_pool = None
         self.data_path = str(Path(__file__).parents[1]) + '/data/'
         self.connected = False
         self.silent = True
+        self.comments_sample = self.config.get('commentsSample', 5)
+        self.storage = create_storage(self.config.get('storage', 'csv'), self.data_path)
         return
 
-    def connect(self) -> None:
+    @property
+    def reddit(self) -> praw.Reddit:
         """
-        Connects to reddit using credentials, and returns praw.Reddit instance
+        praw.Reddit instance of the current thread. praw is not thread safe,
+        so every worker connects on its own, spending the shared rate budget
         :return:
         """
-        self.reddit = praw.Reddit(
+        if not hasattr(self.local, 'reddit'):
+            self.local.reddit = self.create_reddit()
+        return self.local.reddit
+
+    def create_reddit(self) -> praw.Reddit:
+        return praw.Reddit(
             client_id=self.creds['client_id'],
             client_secret=self.creds['client_secret'],
             password=self.creds['password'],
             user_agent=self.creds['user_agent'],
-            username=self.creds['username']
+            username=self.creds['username'],
+            requestor_class=BudgetedRequestor,
+            requestor_kwargs={'budget': self.budget}
         )
+
+    def connect(self) -> None:
+        """
+        Connects to reddit using credentials
+        :return:
+        """
         print("Connected as: ", self.reddit.user.me())
         self.connected = True
 
@@ -61,98 +105,100 @@ class RedditScrapper:
 
     def create_sub_files(self):
         """
-        Creates all the submission and blacklist files for each directory
+        Creates all the submission files for each directory
         :return:
         """
         for sub in self.config['subreddits']:
-            name = sub['name']
-            submissions_file = self.data_path + name + "/" + name + "_submissions.csv"
-            blacklist_file = self.data_path + name + "/" + name + "_blacklist.csv"
-            if not os.path.isfile(blacklist_file):
-                file = open(blacklist_file, 'a+')
-                writer = csv.writer(file, delimiter='|')
-                writer.writerow(["submission_id"])
-            if not os.path.isfile(submissions_file):
-                file = open(submissions_file, 'a+')
-                writer = csv.writer(file, delimiter='|')
-                writer.writerow(submission_header)
-            open(blacklist_file, 'a+')
-
-    def process_top(self, submission_id: str):
-        submission = self.reddit.submission(submission_id)
+            self.storage.create(sub['name'])
+
+    def sample_comments(self, comments) -> ([], bool):
+        """
+        Takes first comments_sample comments of comment forest in breadth first order,
+        like comments.list()[:comments_sample] does, without flattening the whole tree
+        :param comments: CommentForest of a submission
+        :return: list of comment dicts, and whether the whole tree was loaded and visited
+        """
+        sampled = []
+        complete = True
+        forests = deque([comments])
+        while len(forests) > 0:
+            for comment in forests.popleft():
+                if isinstance(comment, MoreComments):
+                    complete = False
+                    continue
+                if len(sampled) == self.comments_sample:
+                    return sampled, False
+                comm_dict = {}
+                comm_dict['created'] = comment.created
+                comm_dict['score'] = comment.score
+                comm_dict['body'] = comment.body
+                comm_dict['replies'] = len(comment.replies)
+                sampled.append(comm_dict)
+                forests.append(comment.replies)
+        return sampled, complete
+
+    def process_comments(self, submission: Submission):
+        """
+        Samples top and controversial comments of submission. The top tree is fetched once
+        through the passed submission, with the default comment limit, so replies counts mean
+        the same as in older data. The controversial sample needs at most one more request,
+        limited to comments_sample comments, so its replies count only the loaded replies.
+        When the whole tree holds at most one comment, both sorts are the same and the
+        controversial tree is not fetched
+        :param submission:
+        :return: dict with top and controversial comments
+        """
+        comments = {}
+        if submission.num_comments == 0:
+            comments['top'] = []
+            comments['controversial'] = []
+            return comments
         submission.comment_sort = 'top'
-        top = submission.comments.list()[:5]
-        top_comments = []
-        for comment in top:
-            if isinstance(comment, MoreComments):
-                continue
-            comm_dict = {}
-            comm_dict['created'] = comment.created
-            comm_dict['score'] = comment.score
-            comm_dict['body'] = comment.body
-            comm_dict['replies'] = len(comment.replies)
-            top_comments.append(comm_dict)
-        return top_comments
-
-    def process_controversial(self, submission_id: str):
-        submission = self.reddit.submission(submission_id)
-        submission.comment_sort = 'controversial'
-        controversial = submission.comments.list()[:5]
-        controversial_comments = []
-        for comment in controversial:
-            if isinstance(comment, MoreComments):
-                continue
-            comm_dict = {}
-            comm_dict['created'] = comment.created
-            comm_dict['score'] = comment.score
-            comm_dict['body'] = comment.body
-            comm_dict['replies'] = len(comment.replies)
-            controversial_comments.append(comm_dict)
-        return controversial_comments
-
-    def process_comments(self, submission_id: str):
-        top = self.process_top(submission_id)
-        controversial = self.process_controversial(submission_id)
-        comments = defaultdict()
+        top, complete = self.sample_comments(submission.comments)
+        if complete and len(top) <= 1:
+            controversial = top
+        else:
+            controversial_submission = self.reddit.submission(submission.id)
+            controversial_submission.comment_sort = 'controversial'
+            controversial_submission.comment_limit = self.comments_sample
+            controversial, _ = self.sample_comments(controversial_submission.comments)
         comments['top'] = top
         comments['controversial'] = controversial
-        return json.dumps(comments)
+        sampled_comments.inc(len(top) + len(controversial))
+        return comments
 
     def process_submission(self, sub_name: str, submission: Submission):
-        return [
-            submission.id,
-            submission.created_utc,
-            submission.title.replace('|', ' '),
-            submission.selftext.replace('|', ' '),
-            submission.score,
-            submission.upvote_ratio,
-            submission.permalink,
-            submission.num_comments,
-            self.process_comments(submission.id).replace('|', ' ')
-        ]
+        return {
+            'id': submission.id,
+            'created_utc': submission.created_utc,
+            'title': submission.title,
+            'selftext': submission.selftext,
+            'score': submission.score,
+            'upvote_ratio': submission.upvote_ratio,
+            'permalink': submission.permalink,
+            'num_comments': submission.num_comments,
+            'comments': self.process_comments(submission)
+        }
 
     def test(self):
         submission = self.reddit.submission(id='5or86n')
         self.process_comments(submission)
 
-    def load_blacklist(self, sub_name: str):
+    def load_blacklist(self, sub_name: str) -> SeenIndex:
         """
-        Loads all the submission ids from sub specified by name, that have already been scrapped.
-        Returns the set of blacklisted submissions
+        Opens index of all the submission ids from sub specified by name, that have already been scrapped.
+        On the first use, ids from the old blacklist CSV file are migrated to the index
         :param sub_name:
-        :return: set containing all submission_ids of blacklisted posts
+        :return: SeenIndex containing all submission_ids of blacklisted posts
         """
-        path = self.data_path + sub_name + "/" + sub_name + "_blacklist.csv"
-        posts = set()
-        try:
-            file = open(path, 'r')
-        except IOError:
-            file = open(path, 'w')
-            return posts
-        reader = csv.reader(file)
-        for post in reader:
-            posts.add(post[0])
-        return posts
+        with self.sub_locks[sub_name]:
+            if sub_name not in self.blacklists:
+                path = self.data_path + sub_name + "/" + sub_name
+                index = SeenIndex(path + "_seen", bloom=True)
+                if not index.exists and os.path.isfile(path + "_blacklist.csv"):
+                    index.migrate_csv(path + "_blacklist.csv")
+                self.blacklists[sub_name] = index
+            return self.blacklists[sub_name]
 
     def update_blacklist(self, sub_name: str, submission_ids: []):
         """
@@ -161,70 +207,94 @@ class RedditScrapper:
         :param submission_ids:
         :return:
         """
-        with open(self.data_path + sub_name + "/" + sub_name + "_blacklist.csv", 'a') as bl:
-            writer = csv.writer(bl)
-            for row in submission_ids:
-                writer.writerow([row])
+        self.load_blacklist(sub_name).add_many(submission_ids)
         return
 
     def update_submissions(self, sub_name: str, rows: []):
         """
-        Writes submissions data in rows[] list to submission file specified by sub_name
+        Writes submissions data in rows[] list to storage of sub specified by sub_name
         :param sub_name:
         :param rows:
         :return:
         """
-        path = self.data_path + sub_name + "/" + sub_name + "_submissions.csv"
-        with open(path, 'a') as file:
-            writer = csv.writer(file, delimiter='|')
-            writer.writerows(rows)
+        self.storage.write(sub_name, rows)
 
     def scrap_sub(self, sub_name: str):
         """
         Gets all the available submissions from subreddit specified by sub_name
-        and saves them to submission file
+        and saves them to submission file. When started with workers, submissions
+        are processed in the worker pool, but rows are still saved in listing order
         :param sub_name:
         :return:
         """
         if not self.silent:
             print("Starting scrapping sub: ", sub_name)
         scraping_start = time.time()
-        blacklist = self.load_blacklist(sub_name)
-        saved_submission_ids = []
-        saved_submissions = []
-        for submission in self.reddit.subreddit(sub_name).hot(limit=1000):
-            if submission.id not in blacklist:
-                start = time.time()
-                row = self.process_submission(sub_name, submission)
-
-                saved_submission_ids.append(submission.id)
-                saved_submissions.append(row)
-                end = time.time()
-                if not self.silent:
-                    message = "Scrapped submission: " \
-                              + "ID: " + row[0] \
-                              + " Title: " + self.format_title(row[2]) \
-                              + " in " + str(end - start)
-                    print(message)
-        self.update_submissions(sub_name, saved_submissions)
-        self.update_blacklist(sub_name, saved_submission_ids)
+        with metrics.span('live.scrap_sub'):
+            blacklist = self.load_blacklist(sub_name)
+            submissions = [submission for submission in self.reddit.subreddit(sub_name).hot(limit=1000)
+                           if submission.id not in blacklist]
+            if self.post_pool is None:
+                rows = [self.scrap_submission(sub_name, submission) for submission in submissions]
+            else:
+                futures = [self.post_pool.submit(self.scrap_submission, sub_name, submission)
+                           for submission in submissions]
+                rows = [future.result() for future in futures]
+            saved_submissions = [row for row in rows if row is not None]
+            saved_submission_ids = [row['id'] for row in saved_submissions]
+            with self.sub_locks[sub_name]:
+                self.update_submissions(sub_name, saved_submissions)
+                self.update_blacklist(sub_name, saved_submission_ids)
         scraping_end = time.time()
         if not self.silent:
             message = "Scraped /r/" + sub_name + " in " + str(scraping_end - scraping_start)
             print(message)
         return
 
-    def start(self, silent: bool):
+    def scrap_submission(self, sub_name: str, submission: Submission):
+        """
+        Processes single submission, returns None if it failed, so it
+        is not blacklisted and will be scrapped again in the next run
+        :param sub_name:
+        :param submission:
+        :return: submission row
+        """
+        try:
+            with metrics.span('live.scrap_submission'):
+                row = self.process_submission(sub_name, submission)
+        except (praw.exceptions.PRAWException, prawcore.PrawcoreException):
+            logging.exception('Failed to scrap submission {}'.format(submission.id))
+            failed_submissions.inc()
+            return None
+        scrapped_submissions.inc()
+        logging.debug('Scrapped submission %s of %s', row['id'], sub_name)
+        return row
+
+    def start(self, silent: bool, workers: int = 1):
         """
         Starts scraping subreddits
         :param silent:
+        :param workers: number of subs and of submissions scrapped concurrently
         :return:
         """
         self.silent = silent
         self.create_dirs()
         start = time.time()
-        for sub in self.config['subreddits']:
-            self.scrap_sub(sub['name'])
+        if workers > 1:
+            self.post_pool = ThreadPoolExecutor(max_workers=workers)
+            with ThreadPoolExecutor(max_workers=workers) as sub_pool:
+                futures = {sub_pool.submit(self.scrap_sub, sub['name']): sub['name']
+                           for sub in self.config['subreddits']}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception:
+                        logging.exception('Failed to scrap sub {}'.format(futures[future]))
+            self.post_pool.shutdown()
+            self.post_pool = None
+        else:
+            for sub in self.config['subreddits']:
+                self.scrap_sub(sub['name'])
         end = time.time()
         if not self.silent:
             message = "Finished scrapping subs in : " + str(datetime.timedelta(seconds=(end - start)))
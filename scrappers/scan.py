@@ -0,0 +1,90 @@
+import threading
+from collections import deque
+from typing import Iterator
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+
+scan_key = [('created_utc', ASCENDING), ('id', ASCENDING)]
+
+# Posts that were never hydrated with comments. Hydrated posts always have comments_scrapped set,
+# whether their comments are embedded or stored in a separate collection
+pending_comments = {'$or': [
+    {'comments_scrapped': {'$exists': False}},
+    {'comments_scrapped': 0}
+]}
+
+# Posts with comments embedded in the post document
+embedded_comments = {'comments': {'$exists': True}}
+
+
+def ensure_indexes(collection: Collection) -> None:
+    """
+    Creates indexes used by keyset scans and by updates keyed on submission id
+    :param collection:
+    :return:
+    """
+    collection.create_index(scan_key)
+    collection.create_index('id')
+
+
+class KeysetScan:
+    """
+    Resumable scan over a history collection in (created_utc, id) order. Pages are
+    fetched with a range query on the last seen key instead of skip(), so resuming
+    costs the same no matter how far the scan got.
+
+    Posts are reported back with done() once processed. committed_key is the key of
+    the last post before which every scanned post is done, so it is always safe to
+    persist and pass back as key on restart
+    """
+
+    def __init__(self, collection: Collection, query: dict, key: [] = None,
+                 page_size: int = 1000, projection: dict = None):
+        self.collection = collection
+        self.query = query
+        self.key = key
+        self.committed_key = key
+        self.page_size = page_size
+        self.projection = projection
+        self.pages = deque()
+        # Remaining ids of the page of every scanned post that is not done yet
+        self.owners = {}
+        self.lock = threading.Lock()
+
+    def page_query(self) -> dict:
+        if self.key is None:
+            return self.query
+        created_utc, post_id = self.key
+        return {'$and': [self.query, {'$or': [
+            {'created_utc': {'$gt': created_utc}},
+            {'created_utc': created_utc, 'id': {'$gt': post_id}}
+        ]}]}
+
+    def __iter__(self) -> Iterator[dict]:
+        while True:
+            page = list(self.collection.find(self.page_query(), self.projection)
+                        .sort(scan_key)
+                        .limit(self.page_size))
+            if len(page) == 0:
+                return
+            self.key = [page[-1]['created_utc'], page[-1]['id']]
+            remaining = set(post['id'] for post in page)
+            with self.lock:
+                self.pages.append((self.key, remaining))
+                for post_id in remaining:
+                    self.owners[post_id] = remaining
+            yield from page
+
+    def done(self, post_id: str) -> None:
+        """
+        Marks post as processed and advances committed_key past finished pages
+        :param post_id:
+        :return:
+        """
+        with self.lock:
+            remaining = self.owners.pop(post_id, None)
+            if remaining is None:
+                return
+            remaining.discard(post_id)
+            while len(self.pages) > 0 and len(self.pages[0][1]) == 0:
+                self.committed_key = self.pages.popleft()[0]
@@ -0,0 +1,202 @@
+import csv
+import hashlib
+import heapq
+import mmap
+import os
+import threading
+from array import array
+from bisect import bisect_left
+
+
+class BloomFilter:
+    """
+    Bloom filter over 64 bit integers, stored in a bytearray
+    """
+
+    def __init__(self, num_bits: int, num_hashes: int, bits: bytearray = None):
+        self.num_bits = max(8, num_bits)
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((self.num_bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity: int, bits_per_item: int = 10) -> 'BloomFilter':
+        return cls(capacity * bits_per_item, max(1, int(bits_per_item * 0.69)))
+
+    def capacity(self, bits_per_item: int = 10) -> int:
+        return self.num_bits // bits_per_item
+
+    def positions(self, value: int):
+        digest = hashlib.blake2b(value.to_bytes(8, 'little'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, value: int) -> None:
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value: int) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(value))
+
+    def save(self, path: str, count: int) -> None:
+        """
+        Saves filter with the number of ids it was filled with, so it can be checked on load
+        :param path:
+        :param count:
+        :return:
+        """
+        with open(path + '.tmp', 'wb') as f:
+            f.write(self.num_bits.to_bytes(8, 'little'))
+            f.write(self.num_hashes.to_bytes(8, 'little'))
+            f.write(count.to_bytes(8, 'little'))
+            f.write(self.bits)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path: str) -> ('BloomFilter', int):
+        with open(path, 'rb') as f:
+            num_bits = int.from_bytes(f.read(8), 'little')
+            num_hashes = int.from_bytes(f.read(8), 'little')
+            count = int.from_bytes(f.read(8), 'little')
+            return cls(num_bits, num_hashes, bytearray(f.read())), count
+
+
+class SeenIndex:
+    """
+    Persistent set of base36 submission ids, stored as 64 bit integers:
+        <prefix>.idx   - sorted ids, memory mapped and binary searched
+        <prefix>.tail  - ids appended since the last compaction, kept in memory
+        <prefix>.bloom - optional Bloom filter over the sorted ids
+    The tail is merged into the sorted file once it grows past compact_threshold ids.
+    A Bloom filter that does not cover exactly the sorted ids, e.g. left by compactions
+    without it, would give false negatives, so it is rebuilt on open
+    """
+
+    def __init__(self, prefix: str, bloom: bool = False, compact_threshold: int = 4096):
+        self.sorted_path = prefix + '.idx'
+        self.tail_path = prefix + '.tail'
+        self.bloom_path = prefix + '.bloom'
+        self.use_bloom = bloom
+        self.compact_threshold = compact_threshold
+        self.lock = threading.Lock()
+        self.exists = os.path.isfile(self.sorted_path) or os.path.isfile(self.tail_path)
+        self.tail = set()
+        if os.path.isfile(self.tail_path):
+            values = array('Q')
+            with open(self.tail_path, 'rb') as f:
+                values.frombytes(f.read())
+            self.tail = set(values)
+        self.file = None
+        self.map = None
+        self.view = None
+        self.ids = memoryview(b'').cast('Q')
+        self.bloom = None
+        self.open_sorted()
+
+    def open_sorted(self) -> None:
+        if not os.path.isfile(self.sorted_path) or os.path.getsize(self.sorted_path) == 0:
+            return
+        self.file = open(self.sorted_path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.ids = self.view.cast('Q')
+        if not self.use_bloom:
+            return
+        count = None
+        if os.path.isfile(self.bloom_path):
+            self.bloom, count = BloomFilter.load(self.bloom_path)
+        if count != len(self.ids):
+            self.bloom = BloomFilter.for_capacity(2 * len(self.ids))
+            for value in self.ids:
+                self.bloom.add(value)
+            self.bloom.save(self.bloom_path, len(self.ids))
+
+    def close_sorted(self) -> None:
+        self.ids.release()
+        self.ids = memoryview(b'').cast('Q')
+        if self.map is not None:
+            self.view.release()
+            self.map.close()
+            self.file.close()
+        self.view = None
+        self.map = None
+        self.file = None
+
+    def __contains__(self, submission_id: str) -> bool:
+        value = int(submission_id, 36)
+        with self.lock:
+            if value in self.tail:
+                return True
+            if self.bloom is not None and value not in self.bloom:
+                return False
+            position = bisect_left(self.ids, value)
+            return position < len(self.ids) and self.ids[position] == value
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.tail)
+
+    def add_many(self, submission_ids: []) -> None:
+        """
+        Appends submission ids to the tail of the index
+        :param submission_ids: base36 submission ids
+        :return:
+        """
+        values = array('Q', (int(submission_id, 36) for submission_id in submission_ids))
+        with self.lock:
+            with open(self.tail_path, 'ab') as f:
+                f.write(values.tobytes())
+            self.tail.update(values)
+            self.exists = True
+            if len(self.tail) > self.compact_threshold:
+                self.compact()
+
+    def compact(self) -> None:
+        """
+        Merges the tail into the sorted file. Has to be called with lock held
+        :return:
+        """
+        if len(self.tail) == 0:
+            return
+        merged = array('Q')
+        last = None
+        for value in heapq.merge(self.ids, sorted(self.tail)):
+            if value != last:
+                merged.append(value)
+                last = value
+        with open(self.sorted_path + '.tmp', 'wb') as f:
+            merged.tofile(f)
+        if self.use_bloom:
+            # The filter only grows, so only the tail is added to it. It is rebuilt with twice
+            # the capacity once full, which keeps the hashing amortized O(1) per id
+            bloom = self.bloom
+            values = self.tail
+            if bloom is None or bloom.capacity() < len(merged):
+                bloom = BloomFilter.for_capacity(2 * len(merged))
+                values = merged
+            for value in values:
+                bloom.add(value)
+            bloom.save(self.bloom_path, len(merged))
+        elif os.path.isfile(self.bloom_path):
+            os.remove(self.bloom_path)
+        self.close_sorted()
+        os.replace(self.sorted_path + '.tmp', self.sorted_path)
+        os.remove(self.tail_path)
+        self.tail = set()
+        self.open_sorted()
+
+    def migrate_csv(self, path: str) -> None:
+        """
+        One time import of ids from a blacklist CSV file
+        :param path:
+        :return:
+        """
+        with open(path, 'r') as f:
+            ids = [row[0] for row in csv.reader(f) if len(row) > 0 and row[0] != 'submission_id']
+        self.add_many(ids)
+        with self.lock:
+            self.compact()
+
+    def close(self) -> None:
+        with self.lock:
+            self.close_sorted()
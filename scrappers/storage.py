@@ -0,0 +1,238 @@
+import csv
+import json
+import os
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime as dt
+
+import metrics
+
+written_bytes = metrics.registry.counter('storage_written_bytes_total', 'Bytes written by submission storages',
+                                        ('storage',))
+csv_written_bytes = written_bytes.labels('csv')
+parquet_written_bytes = written_bytes.labels('parquet')
+
+submission_header = [
+    "id",
+    "created_utc",
+    "title",
+    "selftext",
+    "score",
+    "upvote_ratio",
+    "permalink",
+    "num_comments",
+    "comments"
+]
+
+# Scores of hot listing submissions at a point in time
+snapshot_header = [
+    "timestamp",
+    "rank",
+    "id",
+    "score",
+    "upvote_ratio",
+    "num_comments"
+]
+
+
+class CsvStorage:
+    """
+    Appends submissions as pipe delimited rows to data/<sub>/<sub>_submissions.csv,
+    with comments dumped to json
+    """
+
+    def __init__(self, data_path: str):
+        self.data_path = data_path
+
+    def get_path(self, sub_name: str) -> str:
+        return self.data_path + sub_name + "/" + sub_name + "_submissions.csv"
+
+    def create(self, sub_name: str) -> None:
+        path = self.get_path(sub_name)
+        if not os.path.isfile(path):
+            with open(path, 'a+') as file:
+                writer = csv.writer(file, delimiter='|')
+                writer.writerow(submission_header)
+
+    def write(self, sub_name: str, submissions: []) -> None:
+        """
+        Writes submission dicts to submission file specified by sub_name
+        :param sub_name:
+        :param submissions:
+        :return:
+        """
+        rows = []
+        for submission in submissions:
+            row = [submission[column] for column in submission_header]
+            row[2] = row[2].replace('|', ' ')
+            row[3] = row[3].replace('|', ' ')
+            row[8] = json.dumps(row[8]).replace('|', ' ')
+            rows.append(row)
+        with open(self.get_path(sub_name), 'a') as file:
+            start = file.tell()
+            writer = csv.writer(file, delimiter='|')
+            writer.writerows(rows)
+            csv_written_bytes.inc(file.tell() - start)
+
+    def write_snapshot(self, sub_name: str, rows: []) -> None:
+        """
+        Appends hot listing snapshot rows to data/<sub>/<sub>_hot.csv
+        :param sub_name:
+        :param rows: dicts with snapshot_header fields
+        :return:
+        """
+        path = self.data_path + sub_name + "/" + sub_name + "_hot.csv"
+        new_file = not os.path.isfile(path)
+        with open(path, 'a') as file:
+            start = file.tell()
+            writer = csv.writer(file, delimiter='|')
+            if new_file:
+                writer.writerow(snapshot_header)
+            writer.writerows([row[column] for column in snapshot_header] for row in rows)
+            csv_written_bytes.inc(file.tell() - start)
+
+
+class ParquetStorage:
+    """
+    Writes submissions to Parquet files partitioned by subreddit and day:
+        data/parquet/subreddit=<sub>/day=<YYYY-MM-DD>/<part>.parquet
+    and hot listing snapshots the same way under data/parquet_hot/.
+    Every write adds new part files, so nothing is ever rewritten. Needs pyarrow
+    """
+
+    def __init__(self, data_path: str):
+        try:
+            import pyarrow as pa
+            import pyarrow.dataset as ds
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('ParquetStorage requires pyarrow, install it with: pip install pyarrow')
+        self.pa = pa
+        self.ds = ds
+        self.pq = pq
+        self.root = data_path + 'parquet/'
+        self.snapshot_root = data_path + 'parquet_hot/'
+        comment = pa.struct([
+            ('created', pa.float64()),
+            ('score', pa.int64()),
+            ('body', pa.string()),
+            ('replies', pa.int64())
+        ])
+        self.schema = pa.schema([
+            ('id', pa.string()),
+            ('created_utc', pa.int64()),
+            ('title', pa.string()),
+            ('selftext', pa.string()),
+            ('score', pa.int64()),
+            ('upvote_ratio', pa.float64()),
+            ('permalink', pa.string()),
+            ('num_comments', pa.int64()),
+            ('comments', pa.struct([
+                ('top', pa.list_(comment)),
+                ('controversial', pa.list_(comment))
+            ]))
+        ])
+        self.snapshot_schema = pa.schema([
+            ('timestamp', pa.int64()),
+            ('rank', pa.int64()),
+            ('id', pa.string()),
+            ('score', pa.int64()),
+            ('upvote_ratio', pa.float64()),
+            ('num_comments', pa.int64())
+        ])
+        partitions = pa.schema([
+            ('subreddit', pa.string()),
+            ('day', pa.string())
+        ])
+        self.partitioning = ds.partitioning(partitions, flavor='hive')
+        self.dataset_schema = pa.unify_schemas([self.schema, partitions])
+
+    @staticmethod
+    def get_day(created_utc: float) -> str:
+        return dt.utcfromtimestamp(created_utc).strftime('%Y-%m-%d')
+
+    def create(self, sub_name: str) -> None:
+        os.makedirs(self.root + 'subreddit=' + sub_name, exist_ok=True)
+
+    def write(self, sub_name: str, submissions: []) -> None:
+        """
+        Writes submission dicts to one part file per day they were created on
+        :param sub_name:
+        :param submissions:
+        :return:
+        """
+        by_day = defaultdict(list)
+        for submission in submissions:
+            row = dict(submission)
+            row['created_utc'] = int(row['created_utc'])
+            by_day[self.get_day(row['created_utc'])].append(row)
+        for day, rows in by_day.items():
+            self.write_part(self.root + 'subreddit={}/day={}/'.format(sub_name, day),
+                            self.pa.Table.from_pylist(rows, schema=self.schema))
+
+    def write_snapshot(self, sub_name: str, rows: []) -> None:
+        """
+        Writes hot listing snapshot rows to a part file of the day they were taken on
+        :param sub_name:
+        :param rows: dicts with snapshot_header fields
+        :return:
+        """
+        if len(rows) == 0:
+            return
+        path = self.snapshot_root + 'subreddit={}/day={}/'.format(sub_name, self.get_day(rows[0]['timestamp']))
+        self.write_part(path, self.pa.Table.from_pylist(rows, schema=self.snapshot_schema))
+
+    def write_part(self, path: str, table) -> None:
+        os.makedirs(path, exist_ok=True)
+        name = '{}-{}.parquet'.format(time.time_ns(), uuid.uuid4().hex[:8])
+        self.pq.write_table(table, path + name)
+        if metrics.registry.enabled:
+            parquet_written_bytes.inc(os.path.getsize(path + name))
+
+    def read(self, sub_name: str = None, columns: [] = None, start: int = None, end: int = None):
+        """
+        Reads submissions as pyarrow Table. Only the requested columns are read,
+        and partitions and row groups outside of [start, end) are skipped
+        :param sub_name: subreddit to read, all of them if None
+        :param columns: columns to read, all of them if None
+        :param start: lower bound of created_utc, inclusive
+        :param end: upper bound of created_utc, exclusive
+        :return: pyarrow.Table
+        """
+        if not os.path.isdir(self.root):
+            return self.schema.empty_table()
+        ds = self.ds
+        dataset = ds.dataset(self.root, schema=self.dataset_schema, format='parquet',
+                             partitioning=self.partitioning)
+        predicate = None
+        conditions = []
+        if sub_name is not None:
+            conditions.append(ds.field('subreddit') == sub_name)
+        if start is not None:
+            conditions.append(ds.field('day') >= self.get_day(start))
+            conditions.append(ds.field('created_utc') >= start)
+        if end is not None:
+            conditions.append(ds.field('day') <= self.get_day(end))
+            conditions.append(ds.field('created_utc') < end)
+        for condition in conditions:
+            predicate = condition if predicate is None else predicate & condition
+        return dataset.to_table(columns=columns, filter=predicate)
+
+
+storages = {
+    'csv': CsvStorage,
+    'parquet': ParquetStorage
+}
+
+
+def create_storage(name: str, data_path: str):
+    """
+    Creates storage backend by name, one of: csv, parquet
+    :param name:
+    :param data_path:
+    :return:
+    """
+    if name not in storages:
+        raise ValueError('Unknown storage {}, expected one of {}'.format(name, ', '.join(storages)))
+    return storages[name](data_path)
@@ -0,0 +1,261 @@
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Callable
+from pymongo import InsertOne, UpdateOne
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError
+
+import metrics
+
+_flush = object()
+_close = object()
+
+# Inserting a document with an id that is already stored is not a failure
+duplicate_key = 11000
+
+bulk_write_seconds = metrics.registry.histogram('mongo_bulk_write_seconds', 'Latency of Mongo bulk writes')
+operations_total = metrics.registry.counter('mongo_operations_total', 'Mongo write operations by result',
+                                            ('result',))
+written_operations = operations_total.labels('written')
+failed_operations = operations_total.labels('failed')
+queue_depth = metrics.registry.gauge('writer_queue_depth', 'Operations queued in bulk writers')
+
+
+class BulkWriter:
+    """
+    Write-behind buffer for upserts keyed on submission id and for inserts. Operations
+    are queued by the scrappers and written by a background thread with unordered bulk_write,
+    whenever batch_size operations are buffered or flush_interval seconds passed.
+    The queue holds at most max_pending operations, after that upsert and insert block.
+    Inserts of every batch are written before its upserts, so documents inserted before
+    an upsert are stored by the time the upsert lands.
+    on_written(collection_name, ids) is called from the writer thread after ids were written
+    """
+
+    def __init__(self, database: Database, batch_size: int = 1000, flush_interval: float = 5.0,
+                 max_pending: int = 10000, on_written: Callable[[str, list], None] = None):
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_written = on_written
+        self.operations = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.written = 0
+        self.failed = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def upsert(self, collection_name: str, doc_id: str, fields: dict, unset: [] = None) -> None:
+        """
+        Queues $set of fields on document with given id, inserting it if missing
+        :param collection_name:
+        :param doc_id: submission id
+        :param fields:
+        :param unset: names of fields to remove from the document
+        :return:
+        """
+        update = {'$set': fields}
+        if unset:
+            update['$unset'] = {field: '' for field in unset}
+        self.put(collection_name, doc_id, UpdateOne({'id': doc_id}, update, upsert=True))
+
+    def insert(self, collection_name: str, doc: dict) -> None:
+        """
+        Queues insert of doc, keyed on its id field. If the collection has a unique index on id,
+        inserting a document that is already stored is skipped and counted as written
+        :param collection_name:
+        :param doc:
+        :return:
+        """
+        self.put(collection_name, doc['id'], InsertOne(doc))
+
+    def put(self, collection_name: str, doc_id: str, operation) -> None:
+        if self.closed:
+            raise RuntimeError('BulkWriter is closed')
+        self.operations.put((collection_name, doc_id, operation))
+        queue_depth.inc()
+        with self.lock:
+            self.queued += 1
+
+    def flush(self) -> None:
+        """
+        Blocks until all the operations queued so far are written
+        :return:
+        """
+        done = threading.Event()
+        self.operations.put((_flush, done, None))
+        done.wait()
+
+    def close(self) -> None:
+        """
+        Writes all the queued operations and stops the writer thread
+        :return:
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.operations.put((_close, None, None))
+        self.thread.join()
+
+    def run(self) -> None:
+        buffer = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self.operations.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+            if item is not None and item[0] is not _flush and item[0] is not _close:
+                queue_depth.dec()
+                buffer.append(item)
+                if len(buffer) < self.batch_size:
+                    continue
+            self.write(buffer)
+            buffer = []
+            deadline = time.monotonic() + self.flush_interval
+            if item is None:
+                continue
+            if item[0] is _flush:
+                item[1].set()
+            elif item[0] is _close:
+                return
+
+    def write(self, buffer: []) -> None:
+        inserts = defaultdict(list)
+        upserts = defaultdict(list)
+        for collection_name, doc_id, operation in buffer:
+            by_collection = inserts if isinstance(operation, InsertOne) else upserts
+            by_collection[collection_name].append((doc_id, operation))
+        for collection_name, items in list(inserts.items()) + list(upserts.items()):
+            operations = [operation for _, operation in items]
+            failed = set()
+            try:
+                with bulk_write_seconds.time():
+                    self.database[collection_name].bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                failed = set(error['index'] for error in e.details['writeErrors'] if error['code'] != duplicate_key)
+                if len(failed) > 0:
+                    logging.error('{} writes to {} failed'.format(len(failed), collection_name))
+            except Exception:
+                logging.exception('Bulk write of {} operations to {} failed'.format(len(operations), collection_name))
+                failed = set(range(len(operations)))
+            with self.lock:
+                self.written += len(operations) - len(failed)
+                self.failed += len(failed)
+            written_operations.inc(len(operations) - len(failed))
+            failed_operations.inc(len(failed))
+            if self.on_written is not None:
+                ids = [doc_id for i, (doc_id, _) in enumerate(items) if i not in failed]
+                try:
+                    self.on_written(collection_name, ids)
+                except Exception:
+                    logging.exception('on_written callback failed')
+
+
+class WriteGroup:
+    def __init__(self, stream, collection_name: str, ids: [], callback: Callable[[], None]):
+        self.stream = stream
+        self.collection_name = collection_name
+        self.remaining = set(ids)
+        self.callback = callback
+
+
+class WriteTracker:
+    """
+    Runs a callback once all the documents of a group, e.g. a page of submissions, were
+    written by a BulkWriter. Groups of the same stream commit in order: the callback of
+    a group runs only after callbacks of all the earlier groups of its stream, so a cursor
+    saved by the callbacks never moves past documents that are not stored. A group with
+    a failed write never commits, and blocks the later groups of its stream.
+    Pass written as on_written of the writer, and track a group before queueing its writes
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.pending = defaultdict(deque)
+        self.streams = defaultdict(deque)
+
+    def track(self, stream, collection_name: str, ids: [], callback: Callable[[], None]) -> None:
+        """
+        Registers group of documents, callback runs on the thread that completes the group
+        :param stream: hashable key of groups committed in order, e.g. (sub_name, 'cursor')
+        :param collection_name:
+        :param ids: ids of documents in the group, a group without ids completes at once
+        :param callback:
+        :return:
+        """
+        group = WriteGroup(stream, collection_name, ids, callback)
+        with self.lock:
+            self.streams[stream].append(group)
+            for doc_id in group.remaining:
+                self.pending[(collection_name, doc_id)].append(group)
+            if len(group.remaining) == 0:
+                self.commit(stream)
+
+    def written(self, collection_name: str, ids: []) -> None:
+        with self.lock:
+            ready = set()
+            for doc_id in ids:
+                groups = self.pending.get((collection_name, doc_id))
+                if not groups:
+                    continue
+                group = groups.popleft()
+                if len(groups) == 0:
+                    del self.pending[(collection_name, doc_id)]
+                group.remaining.discard(doc_id)
+                if len(group.remaining) == 0:
+                    ready.add(group.stream)
+            for stream in ready:
+                self.commit(stream)
+
+    def commit(self, stream) -> None:
+        groups = self.streams[stream]
+        while len(groups) > 0 and len(groups[0].remaining) == 0:
+            callback = groups.popleft().callback
+            try:
+                callback()
+            except Exception:
+                logging.exception('Write callback of {} failed'.format(stream))
+        if len(groups) == 0:
+            del self.streams[stream]
+
+    def pending_groups(self, stream) -> int:
+        """
+        Returns number of groups of stream that were not committed yet
+        :param stream:
+        :return:
+        """
+        with self.lock:
+            return len(self.streams.get(stream, ()))
+
+    def discard(self, stream) -> int:
+        """
+        Forgets groups of stream that were not committed, e.g. ones with failed writes
+        :param stream:
+        :return: number of discarded groups
+        """
+        with self.lock:
+            groups = self.streams.pop(stream, ())
+            for group in groups:
+                for doc_id in group.remaining:
+                    key = (group.collection_name, doc_id)
+                    others = self.pending.get(key)
+                    if others is None:
+                        continue
+                    others = deque(other for other in others if other is not group)
+                    if len(others) > 0:
+                        self.pending[key] = others
+                    else:
+                        del self.pending[key]
+            return len(groups)
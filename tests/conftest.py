@@ -0,0 +1,19 @@
+from functools import partial
+
+import pytest
+
+from checkpoints import CheckpointStore
+from scrappers import history
+from tests.fakes import FakeMongoClient
+
+
+@pytest.fixture
+def scrapper(tmp_path, monkeypatch):
+    client = FakeMongoClient()
+    monkeypatch.setattr(history, 'get_remote_client', lambda server_type: client)
+    monkeypatch.setattr(history, 'CheckpointStore', partial(CheckpointStore, str(tmp_path / 'checkpoints.db')))
+    scrapper = history.HistoricalRedditScrapper(max_workers=2)
+    scrapper.config = {'subreddits': [{'name': 'sub'}]}
+    scrapper.silent = True
+    yield scrapper
+    scrapper.close()
@@ -0,0 +1,161 @@
+"""
+In memory stand-ins for Mongo, shared by the tests and the offline benchmarks
+"""
+import threading
+
+from pymongo import InsertOne
+
+
+def matches(doc: dict, query: dict) -> bool:
+    """
+    Evaluates the subset of mongo query language used by the scrappers
+    :param doc:
+    :param query:
+    :return:
+    """
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(matches(doc, q) for q in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(doc, q) for q in condition):
+                return False
+        elif isinstance(condition, dict) and all(op.startswith('$') for op in condition):
+            for op, value in condition.items():
+                if op == '$exists':
+                    if (key in doc) != value:
+                        return False
+                elif key not in doc:
+                    return False
+                elif op == '$gt' and not doc[key] > value:
+                    return False
+                elif op == '$gte' and not doc[key] >= value:
+                    return False
+                elif op == '$lt' and not doc[key] < value:
+                    return False
+                elif op == '$lte' and not doc[key] <= value:
+                    return False
+        elif doc.get(key) != condition:
+            return False
+    return True
+
+
+class FakeCursor:
+    def __init__(self, docs: []):
+        self.docs = docs
+
+    def sort(self, key, direction: int = 1):
+        keys = [(key, direction)] if isinstance(key, str) else key
+        for name, order in reversed(keys):
+            self.docs.sort(key=lambda doc: doc.get(name), reverse=order < 0)
+        return self
+
+    def limit(self, count: int):
+        self.docs = self.docs[:count]
+        return self
+
+    def __iter__(self):
+        return iter(self.docs)
+
+
+class FakeBulkWriteResult:
+    def __init__(self, matched: int, upserted: int):
+        self.bulk_api_result = {'nMatched': matched, 'nModified': matched, 'nUpserted': upserted}
+
+
+class FakeCollection:
+    """
+    In memory stand-in for pymongo Collection, documents are indexed by their id field
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.docs = {}
+        self.lock = threading.Lock()
+
+    def create_index(self, *args, **kwargs) -> None:
+        return None
+
+    def find(self, query: dict = None, projection: dict = None, **kwargs) -> FakeCursor:
+        with self.lock:
+            docs = [doc for doc in self.docs.values() if matches(doc, query or {})]
+        if projection is not None and any(include for field, include in projection.items() if field != '_id'):
+            fields = [field for field, include in projection.items() if include and field != '_id']
+            docs = [{field: doc[field] for field in fields if field in doc} for doc in docs]
+        elif projection is not None:
+            excluded = [field for field, include in projection.items() if not include]
+            docs = [{field: value for field, value in doc.items() if field not in excluded} for doc in docs]
+        else:
+            docs = [dict(doc) for doc in docs]
+        return FakeCursor(docs)
+
+    def find_one(self, query: dict = None, projection: dict = None):
+        for doc in self.find(query, projection):
+            return doc
+        return None
+
+    def count_documents(self, query: dict) -> int:
+        with self.lock:
+            return sum(1 for doc in self.docs.values() if matches(doc, query))
+
+    def insert_many(self, docs: [], ordered: bool = True) -> None:
+        with self.lock:
+            for doc in docs:
+                self.docs[doc['id']] = dict(doc)
+
+    def bulk_write(self, operations: [], ordered: bool = True) -> FakeBulkWriteResult:
+        matched = 0
+        upserted = 0
+        with self.lock:
+            for operation in operations:
+                if isinstance(operation, InsertOne):
+                    # Stands for a collection with unique index on id, duplicates are skipped
+                    if operation._doc['id'] not in self.docs:
+                        self.docs[operation._doc['id']] = dict(operation._doc)
+                    continue
+                doc_id = operation._filter['id']
+                update = operation._doc
+                if doc_id in self.docs:
+                    matched += 1
+                elif operation._upsert:
+                    upserted += 1
+                    self.docs[doc_id] = {'id': doc_id}
+                else:
+                    continue
+                doc = self.docs[doc_id]
+                doc.update(update.get('$set', {}))
+                for field in update.get('$unset', {}):
+                    doc.pop(field, None)
+        return FakeBulkWriteResult(matched, upserted)
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = FakeCollection(name)
+            return self.collections[name]
+
+    def __getattr__(self, name: str) -> FakeCollection:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+
+class FakeMongoClient:
+    def __init__(self):
+        self.databases = {}
+
+    def __getitem__(self, name: str) -> FakeDatabase:
+        if name not in self.databases:
+            self.databases[name] = FakeDatabase()
+        return self.databases[name]
+
+    def __getattr__(self, name: str) -> FakeDatabase:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
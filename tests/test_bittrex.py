@@ -0,0 +1,79 @@
+import os
+
+import pandas as pd
+import pandas.testing as pdt
+
+from loaders.bittrex import load_bittrex_data, load_manifest, read_bittrex_master, to_utc, update_bittrex_master
+
+dates = ['2018-01-01 02-AM', '2018-01-01 01-AM', '2018-01-01 12-AM']
+
+
+def write_market(path, symbol: str, base: str, quote: str, close: float = 1.0) -> None:
+    df = pd.DataFrame({
+        'Date': dates,
+        'Symbol': symbol,
+        'Open': [close, close + 1, close + 2],
+        'High': [close + 3, close + 4, close + 5],
+        'Low': [close - 1, close, close + 1],
+        'Close': [close + 1, close + 2, close + 3],
+        'Volume ' + base: [10.0, 20.0, 30.0],
+        'Volume ' + quote: [1.0, 2.0, 3.0]
+    })
+    with open(str(path / 'Bittrex_{}_1h.csv'.format(symbol)), 'w') as f:
+        f.write('https://www.CryptoDataDownload.com\n')
+        df.to_csv(f, index=False)
+
+
+def write_markets(path) -> str:
+    path.mkdir()
+    write_market(path, 'XRPBTC', 'XRP', 'BTC')
+    write_market(path, 'ETHUSDT', 'ETH', 'USDT', close=100.0)
+    return str(path) + '/'
+
+
+def test_to_utc_reads_twelve_hour_dates_as_utc():
+    assert to_utc(pd.Series(['2018-12-31 11-PM', '2018-01-01 12-AM'])).tolist() == [1546297200, 1514764800]
+
+
+def test_streamed_master_equals_full_master(tmp_path):
+    path = write_markets(tmp_path / 'bittrex')
+    load_bittrex_data(path, str(tmp_path / 'full.csv'), workers=2)
+    load_bittrex_data(path, str(tmp_path / 'stream.csv'), chunksize=2)
+    full = pd.read_csv(str(tmp_path / 'full.csv'))
+    assert len(full) == 6
+    assert {'volume_self', 'volume_btc', 'volume_usdt'} <= set(full.columns)
+    pdt.assert_frame_equal(pd.read_csv(str(tmp_path / 'stream.csv')), full)
+
+
+def read_full_master(path: str, output: str) -> pd.DataFrame:
+    load_bittrex_data(path, output, workers=2)
+    return pd.read_csv(output)
+
+
+def test_incremental_master_equals_full_rebuild(tmp_path):
+    path = write_markets(tmp_path / 'bittrex')
+    master = str(tmp_path / 'master') + '/'
+    update_bittrex_master(path, master, workers=2)
+    pdt.assert_frame_equal(read_bittrex_master(master), read_full_master(path, str(tmp_path / 'full.csv')),
+                           check_dtype=False)
+    removed = master + load_manifest(master)['Bittrex_XRPBTC_1h.csv']['part']
+    write_market(tmp_path / 'bittrex', 'ETHUSDT', 'ETH', 'USDT', close=200.0)
+    write_market(tmp_path / 'bittrex', 'LTCBTC', 'LTC', 'BTC', close=50.0)
+    os.remove(path + 'Bittrex_XRPBTC_1h.csv')
+    update_bittrex_master(path, master, workers=2)
+    assert sorted(load_manifest(master)) == ['Bittrex_ETHUSDT_1h.csv', 'Bittrex_LTCBTC_1h.csv']
+    assert not os.path.isfile(removed)
+    pdt.assert_frame_equal(read_bittrex_master(master), read_full_master(path, str(tmp_path / 'full.csv')),
+                           check_dtype=False)
+
+
+def test_unchanged_files_are_not_parsed_again(tmp_path):
+    path = write_markets(tmp_path / 'bittrex')
+    master = str(tmp_path / 'master') + '/'
+    update_bittrex_master(path, master, workers=2)
+    part = master + load_manifest(master)['Bittrex_XRPBTC_1h.csv']['part']
+    os.remove(part)
+    # Same content with a new mtime is recognized by its hash
+    write_market(tmp_path / 'bittrex', 'XRPBTC', 'XRP', 'BTC')
+    update_bittrex_master(path, master, workers=2)
+    assert not os.path.isfile(part)
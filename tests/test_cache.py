@@ -0,0 +1,74 @@
+import json
+import time
+
+import pytest
+
+from scrappers.cache import CacheMiss, ResponseCache
+
+old_page = 'https://api.pushshift.io/reddit/search/submission/?subreddit=sub&after=100&before=200&limit=2'
+recent_page = 'https://api.pushshift.io/reddit/search/submission/?subreddit=sub&after={}&limit=2'
+
+
+class Fetch:
+    def __init__(self):
+        self.urls = []
+
+    def __call__(self, url: str) -> bytes:
+        self.urls.append(url)
+        return json.dumps({'data': [{'id': str(len(self.urls)), 'created_utc': 150}]}).encode()
+
+
+def create_cache(tmp_path, **kwargs) -> ResponseCache:
+    return ResponseCache(str(tmp_path) + '/', **kwargs)
+
+
+def test_settled_pages_never_expire(tmp_path):
+    cache = create_cache(tmp_path, recent_ttl=-1)
+    fetch = Fetch()
+    first = cache.get_json(old_page, fetch)
+    # Same query with parameters in another order is the same entry
+    reordered = 'https://API.pushshift.io/reddit/search/submission/?limit=2&before=200&after=100&subreddit=sub'
+    assert cache.get_json(reordered, fetch) == first
+    assert len(fetch.urls) == 1
+    cache.close()
+
+
+def test_recent_pages_expire_after_ttl(tmp_path):
+    url = recent_page.format(int(time.time()) - 60)
+    fetch = Fetch()
+    cache = create_cache(tmp_path, recent_ttl=-1)
+    cache.get_json(url, fetch)
+    cache.get_json(url, fetch)
+    assert len(fetch.urls) == 2
+    cache.close()
+    cache = create_cache(tmp_path, recent_ttl=3600)
+    cache.get_json(url, fetch)
+    cache.get_json(url, fetch)
+    assert len(fetch.urls) == 3
+    cache.close()
+
+
+def test_replay_serves_expired_entries_and_never_fetches(tmp_path):
+    url = recent_page.format(int(time.time()) - 60)
+    fetch = Fetch()
+    cache = create_cache(tmp_path, recent_ttl=-1)
+    recorded = cache.get_json(url, fetch)
+    cache.close()
+    cache = create_cache(tmp_path, replay=True)
+    assert cache.get_json(url, fetch) == recorded
+    with pytest.raises(CacheMiss):
+        cache.get_json(old_page, fetch)
+    assert len(fetch.urls) == 1
+    cache.close()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    fetch = Fetch()
+    cache = create_cache(tmp_path, max_bytes=120)
+    urls = [old_page.replace('subreddit=sub', 'subreddit=sub{}'.format(i)) for i in range(3)]
+    for url in urls:
+        cache.get_json(url, fetch)
+    assert cache.total <= 120
+    cache.get_json(urls[0], fetch)
+    assert len(fetch.urls) == 4
+    cache.close()
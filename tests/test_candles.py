@@ -0,0 +1,33 @@
+import numpy as np
+
+from loaders.candles import CandleBuilder, hour, resample
+
+
+def create_rows(count: int, markets: int = 3) -> []:
+    rng = np.random.default_rng(0)
+    timestamps = np.repeat(np.arange(count) * 600, markets)
+    close = 100 + rng.random(len(timestamps)).cumsum()
+    return [np.tile(np.arange(markets), count), timestamps, close - 1, close + 1, close - 2, close,
+            rng.random(len(timestamps))]
+
+
+def test_incremental_candles_equal_full_build():
+    rows = create_rows(200)
+    builder = CandleBuilder(hour)
+    for start, end in [(0, 7), (7, 7), (7, 100), (100, 301), (301, 600)]:
+        builder.update(*[column[start:end] for column in rows])
+    incremental = builder.candles()
+    full = resample(*rows, hour)
+    assert incremental.keys() == full.keys()
+    for column in full:
+        np.testing.assert_array_equal(incremental[column], full[column])
+
+
+def test_update_returns_rebuilt_candles_only():
+    rows = create_rows(12, markets=1)
+    builder = CandleBuilder(hour)
+    builder.update(*[column[:9] for column in rows])
+    rebuilt = builder.update(*[column[9:] for column in rows])
+    # Rows 6-8 share the open candle of the second hour with the new rows
+    assert rebuilt['timestamp'].tolist() == [hour]
+    assert builder.update(*[column[:0] for column in rows])['timestamp'].tolist() == []
@@ -0,0 +1,18 @@
+import pytest
+
+from scrappers.comments import CommentHydrator
+
+
+def failing_posts():
+    yield {'id': 'a', 'num_comments': 0}
+    yield {'id': 'b', 'num_comments': 1}
+    raise RuntimeError('cursor died')
+
+
+def test_hydrate_raises_error_of_post_stream_after_hydrating_read_posts():
+    hydrator = CommentHydrator(lambda url: {'data': []}, workers=2)
+    hydrated = []
+    with pytest.raises(RuntimeError):
+        for post_id, comments in hydrator.hydrate(failing_posts()):
+            hydrated.append(post_id)
+    assert hydrated == ['a', 'b']
@@ -0,0 +1,68 @@
+import time
+
+import numpy as np
+
+from scrappers.coverage import CoverageIndex
+
+
+def test_add_merges_overlapping_and_adjacent_intervals():
+    coverage = CoverageIndex()
+    coverage.add(10, 20)
+    coverage.add(30, 40)
+    coverage.add(21, 25)
+    assert coverage.intervals == [[10, 25], [30, 40]]
+    coverage.add(24, 31)
+    assert coverage.intervals == [[10, 40]]
+
+
+def test_add_ignores_empty_interval():
+    coverage = CoverageIndex([[0, 5]])
+    coverage.add(10, 9)
+    assert coverage.intervals == [[0, 5]]
+
+
+def test_missing_returns_gaps_between_intervals():
+    coverage = CoverageIndex([[10, 20], [30, 40]])
+    assert coverage.missing(0, 50) == [[0, 9], [21, 29], [41, 50]]
+    assert coverage.missing(12, 35) == [[21, 29]]
+    assert coverage.missing(12, 18) == []
+
+
+def test_missing_of_empty_index_is_whole_range():
+    assert CoverageIndex().missing(5, 8) == [[5, 8]]
+
+
+def test_from_timestamps_splits_on_long_gaps():
+    coverage = CoverageIndex.from_timestamps(np.array([100, 5, 10, 300, 110]), max_gap=50)
+    assert coverage.intervals == [[5, 10], [100, 110], [300, 300]]
+
+
+def test_ongoing_periods_are_kept_until_finished():
+    coverage = CoverageIndex()
+    coverage.begin(0, 10)
+    assert coverage.to_dict()['ongoing'] == [[0, 10]]
+    coverage.finish(0, 10)
+    assert coverage.to_dict()['ongoing'] == []
+
+
+def test_coverage_is_not_marked_inside_settle_window(scrapper):
+    scrapper.checkpoints.set('sub', 'coverage', {'intervals': [], 'ongoing': []})
+    scrapper.load_coverage(0)
+    now = int(time.time())
+    scrapper.update_coverage(0, now - 2 * scrapper.settle, now)
+    [[start, end]] = scrapper.checkpoints.get('sub', 'coverage')['intervals']
+    assert start == now - 2 * scrapper.settle
+    assert end <= int(time.time()) - scrapper.settle
+
+
+def test_stale_ongoing_periods_are_dropped_on_load(scrapper):
+    scrapper.checkpoints.set('sub', 'coverage', {'intervals': [[0, 10]], 'ongoing': [[11, 20]]})
+    assert scrapper.load_coverage(0).to_dict() == {'intervals': [[0, 10]], 'ongoing': []}
+
+
+def test_coverage_is_built_from_collection_only_for_gaps(scrapper):
+    scrapper.client.reddit['sub_history'].insert_many([{'id': 'a', 'created_utc': 100}])
+    assert scrapper.load_coverage(0) is None
+    scrapper.update_coverage(0, 0, 50)
+    assert scrapper.checkpoints.get('sub', 'coverage') is None
+    assert scrapper.load_coverage(0, build=True).intervals == [[100, 100]]
@@ -0,0 +1,49 @@
+import time
+
+from scrappers.history import WindowMerger
+
+
+def test_merger_dedupes_posts_at_window_boundaries():
+    merger = WindowMerger([100])
+    first = merger.merge([{'id': 'a', 'created_utc': 99}, {'id': 'b', 'created_utc': 100}])
+    second = merger.merge([{'id': 'b', 'created_utc': 100}, {'id': 'c', 'created_utc': 101}])
+    assert [post['id'] for post in first] == ['a', 'b']
+    assert [post['id'] for post in second] == ['c']
+
+
+def test_merger_keeps_distinct_posts_created_at_boundary():
+    merger = WindowMerger([100])
+    merged = merger.merge([{'id': 'a', 'created_utc': 100}]) + merger.merge([{'id': 'b', 'created_utc': 100}])
+    assert [post['id'] for post in merged] == ['a', 'b']
+
+
+def test_merger_passes_posts_off_boundaries():
+    merger = WindowMerger([100])
+    page = [{'id': 'a', 'created_utc': 50}, {'id': 'a', 'created_utc': 50}]
+    assert merger.merge(page) == page
+
+
+def test_windows_are_at_most_one_per_second(scrapper):
+    now = int(time.time())
+    scrapper.update_after_date(0, now - 2)
+    windows = scrapper.get_windows(0, 8)
+    assert 1 <= len(windows) <= 3
+    for window in windows:
+        assert window['before'] - window['after'] >= 2
+    for previous, window in zip(windows, windows[1:]):
+        assert window['after'] == previous['before'] - 2
+
+
+def test_cursor_moves_to_end_of_empty_last_window(scrapper, monkeypatch):
+    start = int(time.time()) - 1000
+    posts = [{'id': 'p{}'.format(i), 'created_utc': start + 1 + i} for i in range(10)]
+
+    def scrap_sub_after_date(index, date, limit=1000, before=None):
+        return [post for post in posts if int(date) < post['created_utc'] < int(before)][:limit]
+
+    monkeypatch.setattr(scrapper, 'scrap_sub_after_date', scrap_sub_after_date)
+    scrapper.update_after_date(0, start)
+    scrapper.scrap_sub_sharded('sub', shards=4)
+    assert int(scrapper.get_after_date(0)) >= start + 1000 - 1
+    assert scrapper.checkpoints.get('sub', 'windows') is None
+    assert len(scrapper.client.reddit['sub_history'].docs) == 10
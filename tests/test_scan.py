@@ -0,0 +1,42 @@
+from scrappers.scan import KeysetScan
+from tests.fakes import FakeCollection
+
+
+def create_collection(count: int) -> FakeCollection:
+    collection = FakeCollection('test_history')
+    collection.insert_many([{'id': 'p{:03d}'.format(i), 'created_utc': i} for i in range(count)])
+    return collection
+
+
+def test_scan_returns_posts_in_key_order():
+    scan = KeysetScan(create_collection(7), {}, page_size=3)
+    assert [post['id'] for post in scan] == ['p{:03d}'.format(i) for i in range(7)]
+
+
+def test_scan_resumes_after_key():
+    scan = KeysetScan(create_collection(7), {}, key=[3, 'p003'], page_size=3)
+    assert [post['id'] for post in scan] == ['p004', 'p005', 'p006']
+
+
+def test_committed_key_stops_before_unfinished_page():
+    scan = KeysetScan(create_collection(9), {}, page_size=3)
+    posts = list(scan)
+    for post in posts:
+        if post['id'] != 'p004':
+            scan.done(post['id'])
+    assert scan.committed_key == [2, 'p002']
+    scan.done('p004')
+    assert scan.committed_key == [8, 'p008']
+    assert len(scan.pages) == 0
+
+
+def test_done_ignores_unknown_and_repeated_ids():
+    scan = KeysetScan(create_collection(3), {}, page_size=3)
+    list(scan)
+    scan.done('unknown')
+    scan.done('p000')
+    scan.done('p000')
+    assert scan.committed_key is None
+    scan.done('p001')
+    scan.done('p002')
+    assert scan.committed_key == [2, 'p002']
@@ -0,0 +1,30 @@
+from scrappers.seen import SeenIndex
+
+
+def to_ids(numbers) -> []:
+    return [format(number, 'x') for number in numbers]
+
+
+def test_compaction_keeps_all_ids_across_reopen(tmp_path):
+    index = SeenIndex(str(tmp_path / 'sub'), bloom=True, compact_threshold=10)
+    index.add_many(to_ids(range(0, 50, 2)))
+    index.add_many(to_ids(range(1, 50, 2)))
+    assert len(index.tail) <= 10
+    index.close()
+    index = SeenIndex(str(tmp_path / 'sub'), bloom=True, compact_threshold=10)
+    assert all(submission_id in index for submission_id in to_ids(range(50)))
+    assert to_ids([50])[0] not in index
+    index.close()
+
+
+def test_outdated_bloom_filter_is_not_used(tmp_path):
+    prefix = str(tmp_path / 'sub')
+    index = SeenIndex(prefix, bloom=True, compact_threshold=10)
+    index.add_many(to_ids(range(20)))
+    index.close()
+    index = SeenIndex(prefix, bloom=False, compact_threshold=10)
+    index.add_many(to_ids(range(100, 120)))
+    index.close()
+    index = SeenIndex(prefix, bloom=True, compact_threshold=10)
+    assert all(submission_id in index for submission_id in to_ids(list(range(20)) + list(range(100, 120))))
+    index.close()
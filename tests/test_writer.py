@@ -0,0 +1,63 @@
+from scrappers.writer import BulkWriter, WriteTracker
+from tests.fakes import FakeDatabase
+
+
+def test_groups_of_stream_commit_in_order():
+    tracker = WriteTracker()
+    committed = []
+    tracker.track('s', 'c', ['a', 'b'], lambda: committed.append(1))
+    tracker.track('s', 'c', ['c'], lambda: committed.append(2))
+    tracker.written('c', ['c'])
+    assert committed == []
+    tracker.written('c', ['a', 'b'])
+    assert committed == [1, 2]
+    assert tracker.pending_groups('s') == 0
+
+
+def test_group_with_failed_write_blocks_stream():
+    tracker = WriteTracker()
+    committed = []
+    tracker.track('s', 'c', ['a'], lambda: committed.append(1))
+    tracker.track('s', 'c', ['b'], lambda: committed.append(2))
+    tracker.written('c', ['b'])
+    assert committed == []
+    assert tracker.discard('s') == 2
+    assert tracker.pending == {}
+
+
+def test_group_without_ids_commits_at_once():
+    tracker = WriteTracker()
+    committed = []
+    tracker.track('s', 'c', [], lambda: committed.append(1))
+    assert committed == [1]
+
+
+def test_writes_to_other_collections_are_ignored():
+    tracker = WriteTracker()
+    committed = []
+    tracker.track('s', 'c', ['a'], lambda: committed.append(1))
+    tracker.written('other', ['a'])
+    assert committed == []
+    tracker.written('c', ['a'])
+    assert committed == [1]
+
+
+def test_writer_confirms_only_stored_documents():
+    database = FakeDatabase()
+
+    def bulk_write(operations, ordered=True):
+        raise RuntimeError('connection lost')
+
+    database['broken'].bulk_write = bulk_write
+    tracker = WriteTracker()
+    committed = []
+    with BulkWriter(database, on_written=tracker.written) as writer:
+        tracker.track('s', 'ok', ['a'], lambda: committed.append('ok'))
+        tracker.track('t', 'broken', ['b'], lambda: committed.append('broken'))
+        writer.upsert('ok', 'a', {'score': 1})
+        writer.upsert('broken', 'b', {'score': 1})
+        writer.flush()
+    assert committed == ['ok']
+    assert (writer.written, writer.failed) == (1, 1)
+    assert database['ok'].docs['a']['score'] == 1
+    assert tracker.pending_groups('t') == 1